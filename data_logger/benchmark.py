@@ -0,0 +1,301 @@
+"""Benchmark the Poller and DataLogger under synthetic load.
+
+Every scenario polls synthetic items (see SyntheticSampler) and writes to an in-memory fake
+influx (see FakeInfluxDBClient), so no hardware, network or database is needed. Each scenario
+runs in a fresh process so its CPU and memory measurements are not disturbed by the others.
+
+usage:
+
+    $ python benchmark.py [--scenarios 10,1k] [--duration 10] [--output results.json]
+
+or to measure how quickly the data logger starts up (the time from launching the process until its
+first sample, for a config with only system.* items):
+
+    $ python benchmark.py --startup
+
+Results are emitted as JSON, so they can be compared between releases.
+"""
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import random
+import resource
+import subprocess
+import sys
+import time
+from threading import Thread, Lock
+from clock import monotonic
+from data_logger import DataLogger
+from metrics import metrics
+from sampler import Sampler
+
+DEFAULT_DURATION = 10.0  # seconds
+# the intervals of the items are spread across these
+MIXED_INTERVALS = (0.1, 0.5, 1, 5, 10, 60)
+
+# name -> scenario parameters
+SCENARIOS = {
+    "10": {"items": 10},
+    "100": {"items": 100},
+    "1k": {"items": 1000},
+    "10k": {"items": 10000},
+    "100k": {"items": 100000},
+    # network-like samples, slow and occasionally failing
+    "1k-net": {"items": 1000, "latency": "exponential", "mean_latency": 0.02, "failure_rate": 0.01},
+    # slow samples, which are sampled in batches
+    "10k-batch": {"items": 10000, "latency": "exponential", "mean_latency": 0.02, "batch": True},
+    # polled by 4 shard processes
+    "10k-sharded": {"items": 10000, "shards": 4},
+}
+DEFAULT_SCENARIOS = ("10", "100", "1k", "10k", "100k", "1k-net", "10k-batch", "10k-sharded")
+
+# the items of the startup benchmark, which only need the system sampler
+STARTUP_ITEMS = [{"name": "loadavg{0} {1}s".format(period, interval), "key": "system.loadavg{0}".format(period),
+                  "interval": interval}
+                 for period in (1, 5, 15) for interval in (1, 60)]
+# the modules of the standard samplers, to check which of them were loaded
+SAMPLER_MODULES = ("net_sampler", "sense_hat_sampler", "system_sampler", "wemo_sampler")
+STARTUP_TIMEOUT = 10.0  # seconds
+
+
+class SyntheticSampler:
+    """Returns random samples after a random delay, and fails some fraction of the time.
+
+    Args:
+        latency (str): the distribution of the delay, one of "none", "constant", "uniform", "exponential"
+        mean_latency (float): the mean delay (seconds)
+        failure_rate (float): the fraction of samples that fail
+        batch (bool): if True, batches of samples are supported and take one delay per batch
+    """
+
+    def __init__(self, latency="none", mean_latency=0.0, failure_rate=0.0, batch=False):
+        self._latency = latency
+        self._mean_latency = mean_latency
+        self._failure_rate = failure_rate
+        self._batch = batch
+
+    def _delay(self):
+        if self._latency == "constant":
+            time.sleep(self._mean_latency)
+        elif self._latency == "uniform":
+            time.sleep(random.uniform(0, 2 * self._mean_latency))
+        elif self._latency == "exponential":
+            time.sleep(random.expovariate(1.0 / self._mean_latency))
+
+    def _value(self):
+        if self._failure_rate and random.random() < self._failure_rate:
+            raise ValueError("synthetic failure")
+        return random.random()
+
+    def supports_batch(self, key):
+        return self._batch
+
+    def get_samples(self, requests):
+        self._delay()
+        results = {}
+        for request in requests:
+            try:
+                results[request] = self._value()
+            except ValueError as e:
+                results[request] = e
+        return results
+
+    def get_sample(self, key, arg):
+        self._delay()
+        return self._value()
+
+
+class SyntheticOnlySampler(Sampler):
+    """a Sampler with only the synthetic sampler, so none of the real samplers are started"""
+
+    def __init__(self, synthetic_sampler):
+        Sampler.__init__(self, {"synthetic": lambda: synthetic_sampler})
+
+
+class FakeInfluxDBClient:
+    """An in-memory stand in for InfluxDBClient, which counts what is written to it"""
+
+    def __init__(self):
+        self.points = 0
+        self.requests = 0
+        self.bytes = 0
+        self._lock = Lock()
+
+    def create_database(self, name):
+        pass
+
+    def switch_database(self, name):
+        pass
+
+    def request(self, url, method="GET", params=None, data=None, expected_response_code=200, headers=None):
+        with self._lock:
+            self.requests += 1
+            self.bytes += len(data)
+            self.points += data.count("\n") + 1
+
+
+def get_rss():
+    """return the resident set size of this process in bytes"""
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * resource.getpagesize()
+
+def get_cpu_time():
+    """return the CPU time of this process and its (running) child processes, eg shards, in seconds"""
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    cpu_time = usage.ru_utime + usage.ru_stime
+    for child in multiprocessing.active_children():
+        with open("/proc/{0}/stat".format(child.pid)) as f:
+            # utime and stime, in clock ticks. The command name may contain spaces, so split after it
+            fields = f.read().rsplit(")", 1)[1].split()
+        cpu_time += float(int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+    return cpu_time
+
+
+def run_scenario(name, duration):
+    """run the named scenario in this process, returning a dict of the results"""
+    params = SCENARIOS[name]
+    num_items = params["items"]
+    sampler = SyntheticSampler(params.get("latency", "none"), params.get("mean_latency", 0.0),
+                               params.get("failure_rate", 0.0), params.get("batch", False))
+    data_logger = DataLogger(SyntheticOnlySampler(sampler))
+    if params.get("shards"):
+        data_logger.configure({"database": "benchmark", "shards": params["shards"], "items": []})
+
+    rss_before = get_rss()
+    start = monotonic()
+    for i in range(num_items):
+        data_logger.add_item("synthetic {0}".format(i), "synthetic.value", MIXED_INTERVALS[i % len(MIXED_INTERVALS)], str(i))
+    setup_time = monotonic() - start
+    memory_per_item = float(get_rss() - rss_before) / num_items
+
+    # count the samples as they are collected
+    collected = [0]
+    process_results = data_logger._process_results
+    def count_results(samples):
+        collected[0] += len(samples)
+        process_results(samples)
+    data_logger._process_results = count_results
+
+    influx = FakeInfluxDBClient()
+    thread = Thread(target=data_logger.run, args=(influx,))
+    thread.daemon = True
+
+    cpu_before = get_cpu_time()
+    start = monotonic()
+    thread.start()
+    time.sleep(duration)
+    elapsed = monotonic() - start
+    cpu_time = get_cpu_time() - cpu_before
+
+    snapshot = metrics.snapshot()
+    dispatch_lag = snapshot["histograms"].get("dispatch_lag", {})
+    counters = snapshot["counters"]
+    samples = collected[0]
+    expected_samples = sum(duration / MIXED_INTERVALS[i % len(MIXED_INTERVALS)] for i in range(num_items))
+
+    return {
+        "scenario": name,
+        "params": params,
+        "duration": elapsed,
+        "setup_time": setup_time,
+        "samples": samples,
+        "expected_samples": expected_samples,
+        "throughput": samples / elapsed,
+        "jitter": dict((p, dispatch_lag.get(p)) for p in ("mean", "p50", "p90", "p99")),
+        "cpu_time": cpu_time,
+        "cpu_per_sample": cpu_time / samples if samples else None,
+        "memory_per_item": memory_per_item,
+        "polls_skipped": counters.get("polls_skipped", 0),
+        "samples_failed": counters.get("samples_failed", 0),
+        "points_written": influx.points,
+        "write_requests": influx.requests
+    }
+
+
+def run_startup(launch_time):
+    """Start a data logger with the STARTUP_ITEMS in this process, which was launched at the given time,
+    and return a dict of the startup timings (seconds since launch)
+    """
+    start_time = time.time()
+    data_logger = DataLogger()
+    data_logger.configure({"database": "benchmark", "items": STARTUP_ITEMS})
+    thread = Thread(target=data_logger.run, args=(FakeInfluxDBClient(),))
+    thread.daemon = True
+    thread.start()
+
+    deadline = monotonic() + STARTUP_TIMEOUT
+    sample_times = []
+    while not sample_times:
+        if monotonic() > deadline:
+            raise Exception("no sample within {0} seconds".format(STARTUP_TIMEOUT))
+        time.sleep(0.001)
+        sample_times = [item.last_sample_time for item in data_logger.get_items() if item.last_sample_time]
+
+    return {
+        "timestamp": time.time(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "import_time": start_time - launch_time,
+        "time_to_first_sample": min(sample_times) - launch_time,
+        "samplers_loaded": [module for module in SAMPLER_MODULES if module in sys.modules]
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="benchmark the data logger under synthetic load")
+    parser.add_argument("--scenarios", default=",".join(DEFAULT_SCENARIOS),
+                        help="comma separated scenarios, from: {0}".format(", ".join(sorted(SCENARIOS))))
+    parser.add_argument("--duration", type=float, default=DEFAULT_DURATION, help="seconds to run each scenario")
+    parser.add_argument("--output", help="write the results to this file as well as stdout")
+    parser.add_argument("--startup", action="store_true", help="measure the startup time instead of the scenarios")
+    parser.add_argument("--run", help=argparse.SUPPRESS)  # run a single scenario in this process
+    parser.add_argument("--run-startup", type=float, help=argparse.SUPPRESS)  # run the startup benchmark, given the launch time
+    args = parser.parse_args()
+
+    logging.basicConfig(format="%(asctime)s %(levelname)s %(message)s", level=logging.ERROR)
+
+    if args.run or args.run_startup:
+        if args.run:
+            json.dump(run_scenario(args.run, args.duration), sys.stdout)
+        else:
+            json.dump(run_startup(args.run_startup), sys.stdout)
+        sys.stdout.flush()
+        # exit without waiting for (or tearing down) the data logger's threads
+        os._exit(0)
+
+    if args.startup:
+        output = subprocess.check_output([sys.executable, os.path.abspath(__file__), "--run-startup", repr(time.time())])
+        report_json = json.dumps(json.loads(output), indent=2, sort_keys=True)
+        print(report_json)
+        if args.output:
+            with open(args.output, "w") as f:
+                f.write(report_json)
+        return
+
+    results = []
+    for name in args.scenarios.split(","):
+        if name not in SCENARIOS:
+            parser.error("unknown scenario: {0}".format(name))
+        output = subprocess.check_output([sys.executable, os.path.abspath(__file__),
+                                          "--run", name, "--duration", str(args.duration)])
+        results.append(json.loads(output))
+        sys.stderr.write("{0}: {1:.0f} samples/s\n".format(name, results[-1]["throughput"]))
+
+    report = {
+        "timestamp": time.time(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "results": results
+    }
+    report_json = json.dumps(report, indent=2, sort_keys=True)
+    print(report_json)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(report_json)
+
+
+if __name__ == "__main__":
+    main()
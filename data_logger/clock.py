@@ -0,0 +1,30 @@
+"""A monotonic clock for scheduling.
+
+Poll deadlines are kept on a monotonic clock so that wall clock adjustments (eg NTP
+stepping the clock on a Raspberry Pi after boot) don't cause bursts or gaps in polling.
+"""
+import ctypes
+import ctypes.util
+import os
+import time
+
+try:
+    # python 3.3+
+    monotonic = time.monotonic
+except AttributeError:
+    CLOCK_MONOTONIC = 1
+
+    class _timespec(ctypes.Structure):
+        _fields_ = [("tv_sec", ctypes.c_long), ("tv_nsec", ctypes.c_long)]
+
+    _librt = ctypes.CDLL(ctypes.util.find_library("rt") or "librt.so.1", use_errno=True)
+    _clock_gettime = _librt.clock_gettime
+    _clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(_timespec)]
+
+    def monotonic():
+        """return the value (in fractional seconds) of a monotonic clock"""
+        t = _timespec()
+        if _clock_gettime(CLOCK_MONOTONIC, ctypes.pointer(t)) != 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+        return t.tv_sec + t.tv_nsec * 1e-9
@@ -0,0 +1,288 @@
+"""The data logger's JSON config file, which is watched for changes (so it can be edited while the data
+logger is running) and to which changes made through the REST API are saved.
+
+Changes are noticed with inotify on Linux, or by polling the modification time elsewhere. The file is
+saved atomically (write a temp file then rename it), and bursts of changes are coalesced into one save.
+The data logger's own saves are recognised by their content, so they aren't reloaded.
+"""
+import ctypes
+import ctypes.util
+import json
+import logging
+import os
+import select
+import struct
+import time
+from collections import OrderedDict
+from threading import Thread, Event, Lock
+from poller import DEFAULT_MAX_BACKOFF
+
+# how long to wait after a change before saving, so a burst of changes is saved once (seconds)
+DEFAULT_SAVE_DELAY = 1.0
+# how long to wait after the file is changed before reading it, in case it is changed again (seconds)
+SETTLE_TIME = 0.1
+# how often the modification time of the file is checked, if inotify is not available (seconds)
+MTIME_POLL_INTERVAL = 2.0
+
+# inotify, see inotify(7)
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CLOEXEC = 0x00080000
+INOTIFY_EVENT = struct.Struct("iIII")  # wd, mask, cookie, len (followed by the name)
+
+# the order of the fields of a saved item, as in data_logger_config.json
+ITEM_FIELD_ORDER = ("interval", "name", "key", "arg", "deadband", "heartbeat", "max_backoff")
+
+
+def merge_items(base_items, our_items, file_items):
+    """Return the items of the file merged with our changes to the items (made through the REST API), given
+    base_items, the items when the file was last loaded or saved.
+
+    Items are matched by name. Our additions, deletions and changes are applied to the file's items, except to
+    items which have also been changed in the file, where the file's version wins.
+    """
+    def by_name(items):
+        return OrderedDict((item["name"], item) for item in items)
+
+    def settings(item):
+        # the unset (and default) settings may be left out of an item or included, eg "arg": null
+        if item is None:
+            return None
+        return dict((k, v) for k, v in item.items()
+                    if v is not None and not (k == "max_backoff" and v == DEFAULT_MAX_BACKOFF))
+
+    base, ours, merged = by_name(base_items), by_name(our_items), by_name(file_items)
+    file_versions = dict(merged)
+    for name in list(base) + [name for name in ours if name not in base]:
+        our_item = ours.get(name)
+        base_settings = settings(base.get(name))
+        if settings(our_item) == base_settings or settings(file_versions.get(name)) != base_settings:
+            continue
+        if our_item is None:
+            del merged[name]
+        else:
+            merged[name] = our_item
+    return list(merged.values())
+
+
+class Inotify:
+    """Watches a directory for files being written or moved into it, using inotify via ctypes"""
+
+    def __init__(self, directory):
+        """Raises OSError if inotify is not available"""
+        libc_name = ctypes.util.find_library("c")
+        if libc_name is None:
+            raise OSError("libc not found")
+        libc = ctypes.CDLL(libc_name, use_errno=True)
+        if not hasattr(libc, "inotify_init1"):
+            raise OSError("inotify not available")
+        self.fd = libc.inotify_init1(IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        # the directory is watched rather than the file, as the file is replaced when saved atomically
+        if libc.inotify_add_watch(self.fd, directory.encode("utf-8"), IN_CLOSE_WRITE | IN_MOVED_TO) < 0:
+            errno = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(errno, "inotify_add_watch failed: {0}".format(directory))
+
+    def wait(self, timeout=None):
+        """wait for files to change, returning the set of their names (empty on timeout)"""
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return set()
+        data = os.read(self.fd, 64 * 1024)
+        names = set()
+        offset = 0
+        while offset < len(data):
+            _, _, _, length = INOTIFY_EVENT.unpack_from(data, offset)
+            offset += INOTIFY_EVENT.size
+            names.add(data[offset:offset + length].rstrip(b"\0").decode("utf-8"))
+            offset += length
+        return names
+
+
+class ConfigFile:
+    """A ConfigFile loads, watches and saves the JSON config file"""
+
+    def __init__(self, filename, save_delay=DEFAULT_SAVE_DELAY):
+        self._filename = os.path.abspath(filename)
+        self._save_delay = save_delay
+        # the content last loaded or saved, so the data logger's own saves can be recognised
+        self._content = None
+        self._lock = Lock()
+        self._save_requested = Event()
+        self._get_items_config = None
+        self._saver = None
+        self._watcher = None
+        self._on_change = None
+
+    def load(self):
+        """return the config loaded from the file"""
+        with open(self._filename) as f:
+            content = f.read()
+        with self._lock:
+            self._content = content
+        return json.loads(content)
+
+    def watch(self, on_change):
+        """Start watching the file. When it changes (other than by save) on_change(config) is called with
+        the new config, from the watching thread.
+        """
+        self._on_change = on_change
+        self._watcher = Thread(target=self._watch, args=(on_change,), name="config watcher")
+        self._watcher.daemon = True
+        self._watcher.start()
+
+    def _watch(self, on_change):
+        directory, basename = os.path.split(self._filename)
+        try:
+            inotify = Inotify(directory)
+        except (OSError, AttributeError) as e:
+            logging.info("inotify not available ({0}), polling {1} for changes".format(e, self._filename))
+            inotify = None
+
+        last_stat = self._stat()
+        while True:
+            if inotify is not None:
+                if basename not in inotify.wait():
+                    continue
+                # wait for the writer to finish, including any further changes
+                while basename in inotify.wait(SETTLE_TIME):
+                    pass
+            else:
+                time.sleep(MTIME_POLL_INTERVAL)
+                stat = self._stat()
+                if stat == last_stat:
+                    continue
+                # wait for the writer to finish
+                while True:
+                    time.sleep(SETTLE_TIME)
+                    last_stat = self._stat()
+                    if last_stat == stat:
+                        break
+                    stat = last_stat
+
+            try:
+                self._reload(on_change)
+            except Exception as e:
+                logging.exception("failed to reload config {0}: {1}".format(self._filename, e))
+
+    def _stat(self):
+        try:
+            stat = os.stat(self._filename)
+            return stat.st_mtime, stat.st_size, stat.st_ino
+        except OSError:
+            return None
+
+    def _reload(self, on_change):
+        # the file is read with the lock held, so a save can't come between reading and applying it
+        with self._lock:
+            try:
+                content = self._read()
+            except IOError as e:
+                logging.error("failed to read config {0}: {1}".format(self._filename, e))
+                return
+            if content == self._content:
+                # unchanged, or our own save
+                return
+            try:
+                config = json.loads(content, object_pairs_hook=OrderedDict)
+            except ValueError as e:
+                logging.error("invalid config {0}, not reloaded: {1}".format(self._filename, e))
+                return
+            logging.info("config {0} changed, reloading".format(self._filename))
+            # changes to the items not saved yet are kept, rather than undone by the reload
+            merged = self._merge_unsaved_items(config)
+            on_change(config)
+            self._content = content
+            if merged:
+                self._write(config)
+
+    def _read(self):
+        with open(self._filename) as f:
+            return f.read()
+
+    def _merge_unsaved_items(self, config):
+        """Merge the changes to the items made since the file was last loaded or saved into the items of the
+        given config (as loaded from the file), returning True if there were any. Called with the lock held.
+        """
+        if self._get_items_config is None:
+            return False
+        base_items = json.loads(self._content).get("items", []) if self._content is not None else []
+        file_items = config.get("items", [])
+        items = merge_items(base_items, self._get_items_config(), file_items)
+        config["items"] = items
+        return items != file_items
+
+    def enable_save(self, get_items_config):
+        """Start the thread that saves the items when save is called, where get_items_config() returns the
+        current items config.
+        """
+        self._get_items_config = get_items_config
+        self._saver = Thread(target=self._save_when_requested, name="config saver")
+        self._saver.daemon = True
+        self._saver.start()
+
+    def save(self):
+        """Save the current items to the file soon, without blocking. The other settings in the file are
+        kept as they are. Does nothing unless enable_save has been called.
+        """
+        if self._saver is not None:
+            self._save_requested.set()
+
+    def _save_when_requested(self):
+        while True:
+            self._save_requested.wait()
+            # let a burst of changes finish, so they are saved at once
+            time.sleep(self._save_delay)
+            self._save_requested.clear()
+            try:
+                self._save_items()
+            except Exception as e:
+                logging.exception("failed to save config {0}: {1}".format(self._filename, e))
+
+    def _save_items(self):
+        """replace the items in the file with the current items"""
+        with self._lock:
+            try:
+                content = self._read()
+            except IOError:
+                content = None
+            if content is not None and content != self._content:
+                # the file has been edited since it was loaded or saved, and not reloaded yet, so the edits
+                # are merged with the unsaved changes rather than overwritten
+                try:
+                    config = json.loads(content, object_pairs_hook=OrderedDict)
+                except ValueError as e:
+                    logging.error("invalid config {0}, not saved: {1}".format(self._filename, e))
+                    return
+                logging.info("config {0} changed, merging with the unsaved changes".format(self._filename))
+                self._merge_unsaved_items(config)
+                if self._on_change is not None:
+                    self._on_change(config)
+                self._content = content
+            else:
+                # the rest of the file, and the order of the items already in it, are kept as they are
+                config = OrderedDict()
+                if self._content is not None:
+                    config = json.loads(self._content, object_pairs_hook=OrderedDict)
+                positions = dict((item["name"], i) for i, item in enumerate(config.get("items", [])))
+                config["items"] = sorted(self._get_items_config(),
+                                         key=lambda item: (positions.get(item["name"], len(positions)), item["name"]))
+            self._write(config)
+
+    def _write(self, config):
+        """write the config to the file atomically, by writing a temp file then renaming it. Called with the lock held"""
+        config["items"] = [OrderedDict((field, item[field]) for field in ITEM_FIELD_ORDER if field in item)
+                           for item in config.get("items", [])]
+        content = json.dumps(config, indent=2, separators=(",", ": ")) + "\n"
+        if content == self._content:
+            return
+        temp_path = os.path.join(os.path.dirname(self._filename), "." + os.path.basename(self._filename) + ".tmp")
+        with open(temp_path, "w") as f:
+            f.write(content)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(temp_path, self._filename)
+        self._content = content
+        logging.info("saved {0} items to config {1}".format(len(config["items"]), self._filename))
@@ -1,44 +1,172 @@
 from influxdb import InfluxDBClient
 import logging
 import json
-from poller import Poller
+import time
+from config_file import ConfigFile
+from history import DEFAULT_HISTORY_DEPTH
+from metrics import metrics
+from influx_writer import InfluxWriter, encode_line
+from oversampling import Oversample
+from rollup import Rollups
+from poller import Poller, ItemExistsError, ENGINE_THREADS, DEFAULT_MAX_BACKOFF
+from sharding import ShardedPoller
+from sink import DEFAULT_BATCH_SIZE, DEFAULT_FLUSH_INTERVAL, DEFAULT_QUEUE_SIZE
+from spool import Spool, DEFAULT_SEGMENT_SIZE, DEFAULT_MAX_SEGMENTS
+from sqlite_sink import SQLiteSink, DEFAULT_SQLITE_BATCH_SIZE, DEFAULT_RETENTION
+from sync import Syncer, DEFAULT_SYNC_BATCH_SIZE, DEFAULT_SYNC_INTERVAL
 
 CONFIG_FILENAME = "data_logger_config.json"
 DEFAULT_DATABASE = "rpdemo"
 DEFAULT_NUM_POLLING_THREADS = 4
+MEASUREMENT = "rpdemo"
+METRICS_MEASUREMENT = "rpdemo_internal"
+# how long a request to influx may take (seconds), so a stalled connection can't hang a sink or the sync
+DEFAULT_INFLUX_TIMEOUT = 30.0
 
 class DataLogger:
-    def __init__(self):
-        self._influx = None
-        self._poller = Poller()
+    def __init__(self, sampler=None):
+        self._writer = None
+        # the Sinks the points are written to, see sink.py. The first is the writer
+        self._sinks = []
+        self._sampler = sampler
+        self._poller = Poller(sampler)
 
         self._database_name = DEFAULT_DATABASE
         self._num_polling_threads = DEFAULT_NUM_POLLING_THREADS
+        self._polling_engine = ENGINE_THREADS
+        # WorkerPool options per sampler, see Poller.run
+        self._pools_config = {}
+        # InfluxWriter options, see influx_writer.py
+        self._writer_config = {}
+        self._history_depth = DEFAULT_HISTORY_DEPTH
+        # how often the internal metrics are written to influx (seconds), 0 to disable
+        self._self_metrics_interval = 0
+        self._next_self_metrics_time = None
+        # Spool options, see spool.py. The spool is disabled if this is None
+        self._spool_config = None
+        # the config of each sink, see _create_sink. If None the points are written to influx on localhost, using
+        # the writer and spool config
+        self._sinks_config = None
+        # the config of the sync of a SQLite archive to a central database, see _create_syncer. None to disable
+        self._sync_config = None
+        self._syncer = None
+        # the number of shard processes polling the items, see sharding.py. 0 to poll in this process
+        self._num_shards = 0
+        self._results_listeners = []
+        # Rollups options, see rollup.py. Rollups are disabled if this is None
+        self._rollups_config = None
+        self._rollups = None
+        # whether the raw samples are written to influx, as well as the rollups
+        self._write_raw = True
+        # the config file, if the config was loaded from one
+        self._config_file = None
+        self._loaded_config = {}
+        # whether changes to the items in the config file are applied while running
+        self._reload_config = True
+        # whether changes to the items made through the REST API are saved to the config file
+        self._save_items = True
 
     def load_config(self, filename):
-        config_str = open(filename).read()
-        logging.info(config_str)
-        config = json.loads(config_str)
+        """Configure the data logger from the given JSON config file, see configure.
+
+        If enabled (by the "reload_config" and "save_items" settings) the items are updated whenever the file
+        changes, and changes to the items are saved to the file.
+        """
+        self._config_file = ConfigFile(filename)
+        config = self._config_file.load()
+        logging.info(json.dumps(config))
+        self.configure(config)
+        # the other settings are only applied at startup, so changes to them are reported
+        self._loaded_config = config
+        if self._reload_config:
+            self._config_file.watch(self._config_changed)
+        if self._save_items:
+            self._config_file.enable_save(self._poller.get_items_config)
+
+    def _config_changed(self, config):
+        """apply the changes to the items of the reloaded config"""
+        try:
+            added, deleted, changed = self._poller.apply_items_config(config.get("items", []))
+        except (ValueError, KeyError, ItemExistsError) as e:
+            logging.error("config not reloaded: {0}".format(e))
+            return
+        logging.info("config reloaded: {0} items added, {1} deleted, {2} changed".format(
+            len(added), len(deleted), len(changed)))
+        for name in set(config) | set(self._loaded_config):
+            if name != "items" and config.get(name) != self._loaded_config.get(name):
+                logging.warn("config setting {0} has changed, restart to apply it".format(name))
+
+    def configure(self, config):
+        """configure the data logger given config as loaded from JSON, see data_logger_config.json"""
+        self._num_shards = config.get("shards", 0)
+        if self._num_shards:
+            # the shard processes are started now, before the app starts any threads
+            self._poller = ShardedPoller(self._num_shards, self._sampler)
+            for listener in self._results_listeners:
+                self._poller.add_results_listener(listener)
 
         self._database_name = config["database"]
         self._num_polling_threads = config.get("polling_threads", DEFAULT_NUM_POLLING_THREADS)
+        self._polling_engine = config.get("polling_engine", ENGINE_THREADS)
+        self._pools_config = config.get("pools", {})
+        self._writer_config = config.get("writer", {})
+        self._spool_config = config.get("spool")
+        self._sinks_config = config.get("sinks")
+        self._sync_config = config.get("sync")
+        self._rollups_config = config.get("rollups")
+        self._write_raw = self._rollups_config.get("raw", True) if self._rollups_config else True
+        self._history_depth = config.get("history_depth", DEFAULT_HISTORY_DEPTH)
+        self._poller.set_history_depth(self._history_depth)
+        self._self_metrics_interval = config.get("self_metrics_interval", 0)
+        self._reload_config = config.get("reload_config", True)
+        self._save_items = config.get("save_items", True)
         self._poller.set_items_config(config["items"])
 
     def get_config(self):
         config = {
             "database": self._database_name,
             "polling_threads": self._num_polling_threads,
+            "shards": self._num_shards,
+            "polling_engine": self._polling_engine,
+            "pools": self._pools_config,
+            "writer": self._writer_config,
+            "spool": self._spool_config,
+            "sinks": self._sinks_config,
+            "sync": self._sync_config,
+            "rollups": self._rollups_config,
+            "history_depth": self._history_depth,
+            "self_metrics_interval": self._self_metrics_interval,
+            "reload_config": self._reload_config,
+            "save_items": self._save_items,
             "items": self._poller.get_items_config()
         }
         return config
 
-    def add_item(self, name, key, interval, arg=None):
-        self._poller.add_item(name, key, arg, interval)
+    def add_item(self, name, key, interval, arg=None, deadband=None, heartbeat=None, max_backoff=DEFAULT_MAX_BACKOFF):
+        self._poller.add_item(name, key, arg, interval, deadband, heartbeat, max_backoff)
         logging.info("item added: {0}".format(name))
+        self._items_changed()
+
+    def add_items(self, items):
+        """add many items as one update, each a dict of name, key, interval and (optional) arg"""
+        self._poller.add_items(items)
+        logging.info("{0} items added".format(len(items)))
+        self._items_changed()
 
     def delete_item(self, name):
         self._poller.delete_item(name)
         logging.info("item deleted: {0}".format(name))
+        self._items_changed()
+
+    def delete_items(self, names):
+        self._poller.delete_items(names)
+        logging.info("{0} items deleted".format(len(names)))
+        self._items_changed()
+
+    def _items_changed(self):
+        """save the items to the config file (soon, so a burst of changes is saved once)"""
+        if self._config_file is not None:
+            self._config_file.save()
 
     def get_items(self):
         return self._poller.get_items()
@@ -46,6 +174,54 @@ class DataLogger:
     def get_item(self, name):
         return self._poller.get_item(name)
 
+    def get_items_page(self, cursor=None, limit=None):
+        """return up to limit items in order of name, after the item named cursor, see Poller.get_items_page"""
+        return self._poller.get_items_page(cursor, limit)
+
+    def get_items_version(self):
+        """return (items version, results version): the first changes whenever an item is added or deleted,
+        the second whenever new samples are collected
+        """
+        return self._poller.get_items_version(), self._poller.results_version
+
+    def add_results_listener(self, listener):
+        """register listener(samples) to be called with each list of new Samples, see Poller.add_results_listener"""
+        self._results_listeners.append(listener)
+        self._poller.add_results_listener(listener)
+
+    def get_history(self, name, since=None):
+        """return the recent samples of the item with the given name, with their min, max and mean
+
+        Raises KeyError if not found
+        """
+        return self._poller.get_history(name).summary(since)
+
+    def get_metrics(self):
+        """return a snapshot of the internal performance metrics"""
+        return metrics.snapshot()
+
+    def get_pool_stats(self):
+        """return the WorkerPool statistics of each sampler"""
+        return self._poller.get_pool_stats()
+
+    def get_writer_stats(self):
+        """return the statistics of the writer (the first sink), or None if the data logger is not running"""
+        if self._writer is None:
+            return None
+        return self._writer.get_stats()
+
+    def get_sinks_stats(self):
+        """return a dict of sink name -> the statistics of the sink, or None if the data logger is not running"""
+        if not self._sinks:
+            return None
+        return dict((sink.sink_name, sink.get_stats()) for sink in self._sinks)
+
+    def get_sync_stats(self):
+        """return the Syncer statistics, or None if the sync is not running"""
+        if self._syncer is None:
+            return None
+        return self._syncer.get_stats()
+
     def create_test_items(self):
         self._poller.add_item("loadavg1 1s", "system.loadavg1", None, 1)
         self._poller.add_item("loadavg1 5s", "system.loadavg1", None, 5)
@@ -63,33 +239,168 @@ class DataLogger:
         self._poller.add_item("sensehat humidity", "sensehat.humidity", None, 10)
         self._poller.add_item("sensehat pressure", "sensehat.pressure", None, 10)
 
-    def run(self):
-        self._influx = InfluxDBClient("localhost", 8086)
-        self._influx.create_database(self._database_name)
-        self._influx.switch_database(self._database_name)
+    def run(self, influx_client=None):
+        """Run the data logger, writing to the configured sinks (by default influx on localhost). Does not return.
 
-        self._poller.run(self._num_polling_threads, self._process_results)
+        Args:
+            influx_client (InfluxDBClient): optional, the client of the first influx sink, instead of connecting
+                to the configured host
+        """
+        sinks_config = self._sinks_config
+        if sinks_config is None:
+            sinks_config = [dict(self._writer_config, name="influx", type="influx", spool=self._spool_config)]
+        names = [sink_config.get("name", sink_config.get("type", "influx")) for sink_config in sinks_config]
+        if len(set(names)) != len(names):
+            raise ValueError("sink names must be unique: {0}".format(names))
 
-    def _build_points(self, items):
-        """build a list of influx data points from the given list of PollItems"""
-        fields = {}
-        for item in items:
-            fields[item.name] = item.last_value
+        # each sink writes from its own thread with its own queue, so a slow sink doesn't hold up polling or the others
+        for sink_config in sinks_config:
+            sink = self._create_sink(sink_config, influx_client)
+            if isinstance(sink, InfluxWriter):
+                influx_client = None
+            self._sinks.append(sink)
+        self._writer = self._sinks[0]
+        for sink in self._sinks:
+            sink.start()
 
-        point = {
-            "measurement": "rpdemo",
-            "fields": fields
-        }
+        if self._sync_config is not None:
+            self._syncer = self._create_syncer(self._sync_config)
+            self._syncer.start()
+
+        if self._rollups_config is not None:
+            # the rollups see every sample, including those not written (see PollItem.should_report)
+            self._rollups = Rollups(MEASUREMENT, self._rollups_config.get("windows"))
+            self._poller.add_results_listener(self._rollup_samples)
+
+        self._poller.run(self._num_polling_threads, self._process_results, self._polling_engine, self._pools_config)
+
+    def _create_sink(self, sink_config, influx_client=None):
+        """Create a Sink given its config, a dict of:
+
+            name: the name of the sink, default its type
+            type: "influx" (default) or "sqlite"
+            host, port, database: the influx server and database (influx only), default localhost:8086 and the
+                "database" config
+            gzip: whether to gzip the requests to influx (influx only)
+            timeout: the timeout of requests to influx in seconds (influx only), default DEFAULT_INFLUX_TIMEOUT
+            path: the database file (sqlite only)
+            retention, max_points: the bounds of the archive, by default 7 days and no maximum (sqlite only)
+            batch_size, flush_interval, queue_size: see Sink
+            overflow: "block", "drop-oldest" or "spill", see sink.py
+            spool: the Spool options, see spool.py. Each sink needs its own spool directory
+
+        Raises ValueError if the config is invalid
+        """
+        sink_type = sink_config.get("type", "influx")
+        name = sink_config.get("name", sink_type)
+        spool = None
+        spool_config = sink_config.get("spool")
+        if spool_config is not None:
+            # points are kept on disk while the sink is unavailable
+            spool = Spool(spool_config["directory"],
+                          segment_size=spool_config.get("segment_size", DEFAULT_SEGMENT_SIZE),
+                          max_segments=spool_config.get("max_segments", DEFAULT_MAX_SEGMENTS))
+        flush_interval = sink_config.get("flush_interval", DEFAULT_FLUSH_INTERVAL)
+        queue_size = sink_config.get("queue_size", DEFAULT_QUEUE_SIZE)
+        overflow = sink_config.get("overflow")
+
+        if sink_type == "influx":
+            database = sink_config.get("database", self._database_name)
+            client = influx_client or InfluxDBClient(sink_config.get("host", "localhost"), sink_config.get("port", 8086),
+                                                     timeout=sink_config.get("timeout", DEFAULT_INFLUX_TIMEOUT))
+            try:
+                client.create_database(database)
+            except Exception as e:
+                # influx may just be down, the writer will keep retrying (and spool the points meanwhile)
+                logging.error("failed to create influx database {0} for sink {1}: {2}".format(database, name, e))
+            client.switch_database(database)
+            return InfluxWriter(client, database,
+                                batch_size=sink_config.get("batch_size", DEFAULT_BATCH_SIZE),
+                                flush_interval=flush_interval,
+                                use_gzip=sink_config.get("gzip", False),
+                                queue_size=queue_size, spool=spool, name=name, overflow=overflow)
+        elif sink_type == "sqlite":
+            return SQLiteSink(sink_config["path"],
+                              batch_size=sink_config.get("batch_size", DEFAULT_SQLITE_BATCH_SIZE),
+                              flush_interval=flush_interval, queue_size=queue_size, spool=spool, name=name,
+                              overflow=overflow, retention=sink_config.get("retention", DEFAULT_RETENTION),
+                              max_points=sink_config.get("max_points"))
+        raise ValueError("unknown sink type: {0}".format(sink_type))
+
+    def _create_syncer(self, sync_config):
+        """Create the Syncer of a SQLite archive to a central database given its config, a dict of:
+
+            archive: the name of the sqlite sink to sync, default the first
+            host, port, ssl, username, password: the central influx server
+            timeout: the timeout of requests to the central server in seconds, default DEFAULT_INFLUX_TIMEOUT
+            database: the central database, default the "database" config
+            tags: the tags added to the points, default {"host": <hostname>}
+            checkpoint: the file where the sync progress is saved, default the archive path plus ".sync"
+            batch_size: the maximum number of points sent in one request
+            max_bytes_per_second: the bandwidth cap, default none
+            interval: seconds between checks for new points
+
+        Raises ValueError if there is no such archive
+        """
+        archives = [sink for sink in self._sinks if isinstance(sink, SQLiteSink)]
+        name = sync_config.get("archive")
+        if name is not None:
+            archives = [sink for sink in archives if sink.sink_name == name]
+        if not archives:
+            raise ValueError("sync requires a sqlite sink: {0}".format(name or "none configured"))
+        archive_path = archives[0].path
+        client = InfluxDBClient(sync_config["host"], sync_config.get("port", 8086),
+                                sync_config.get("username", "root"), sync_config.get("password", "root"),
+                                ssl=sync_config.get("ssl", False), verify_ssl=sync_config.get("ssl", False),
+                                timeout=sync_config.get("timeout", DEFAULT_INFLUX_TIMEOUT))
+        return Syncer(archive_path, client, sync_config.get("database", self._database_name),
+                      sync_config.get("checkpoint", archive_path + ".sync"),
+                      tags=sync_config.get("tags"),
+                      batch_size=sync_config.get("batch_size", DEFAULT_SYNC_BATCH_SIZE),
+                      max_bytes_per_second=sync_config.get("max_bytes_per_second"),
+                      interval=sync_config.get("interval", DEFAULT_SYNC_INTERVAL))
+
+    def _put_lines(self, lines):
+        """queue the points for writing to every sink"""
+        for sink in self._sinks:
+            sink.put(lines)
+
+    def _build_lines(self, samples):
+        """Build a list of influx line protocol points from the given list of Samples, one point per sample.
+
+        The point of an oversampled sample (see oversampling.py) also has the stddev, min, max and count fields.
+        Samples with no value the line protocol can represent (eg nan) are left out, see encode_line.
+        """
+        lines = (encode_line(MEASUREMENT, sample.value.fields(sample.name) if isinstance(sample.value, Oversample)
+                             else [(sample.name, sample.value)], int(sample.timestamp * 1000))
+                 for sample in samples)
+        return [line for line in lines if line is not None]
+
+    def _rollup_samples(self, samples):
+        """add the samples to the rollups, and queue the rollups of any windows that have closed for writing"""
+        lines = self._rollups.add(samples, time.time())
+        if lines:
+            self._put_lines(lines)
+
+    def _process_results(self, samples):
+        if not samples and self._rollups is not None:
+            # the rollup windows are closed when they end even if no samples arrive, eg if every item is deleted
+            self._rollup_samples([])
 
-        return [point]
+        # build influx points from the results and queue them for writing to influx DB
+        lines = self._build_lines(samples) if self._write_raw else []
 
-    def _process_results(self, items):
-        # build influx points from the results and write them to influx DB
-        points = self._build_points(items)
+        logging.debug("{0}".format(lines))
 
-        logging.debug("{0}".format(points))
+        if self._self_metrics_interval:
+            now = time.time()
+            if self._next_self_metrics_time is None or now >= self._next_self_metrics_time:
+                line = encode_line(METRICS_MEASUREMENT, metrics.flatten(), int(now * 1000))
+                if line is not None:
+                    lines.append(line)
+                self._next_self_metrics_time = now + self._self_metrics_interval
 
-        self._influx.write_points(points)
+        self._put_lines(lines)
 
 
 if __name__ == '__main__':
@@ -1,23 +1,78 @@
+import json
 import logging
-from threading import Thread
+import zlib
+from threading import Thread, Lock
 from data_logger import DataLogger
-from poller import ItemExistsError
-from flask import Flask, request, abort, jsonify, make_response, url_for
+from fanout import Fanout
+from metrics import metrics
+from poller import ItemExistsError, ITEM_FIELDS
+from profiler import Profiler, DEFAULT_DURATION, DEFAULT_INTERVAL
+from flask import Flask, Response, request, abort, jsonify, make_response, url_for, stream_with_context
+from werkzeug.urls import url_quote
 
 # Configure the logging before creating the Flask app otherwise it will
 logging.basicConfig(format="%(asctime)s %(levelname)s %(message)s", level=logging.INFO)
 
 app = Flask(__name__)
 
+# the fields of an item in the REST API: the public fields of the PollItem plus its url
+ALL_ITEM_FIELDS = ITEM_FIELDS + ("url",)
+# the item fields that change as the item is polled (rather than when it is added or deleted)
+DYNAMIC_ITEM_FIELDS = frozenset(["last_value", "last_sample_time", "poll_in_progress", "dispatch_lag", "failures"])
+# the number of items encoded per chunk of a streamed response
+STREAM_CHUNK_SIZE = 100
+# how often a comment is sent to idle /stream clients, so dead connections are noticed (seconds)
+STREAM_KEEPALIVE_INTERVAL = 15.0
+
 data_logger = DataLogger()
 
-def item_as_dict(poll_item):
-    """return a dict version of the given PollItem"""
-    # simply return all the fields of the PollItem, plus a url field
-    item_dict = poll_item.__dict__
-    item_dict["url"] = url_for("get_item", name=poll_item.name, _external=True)
+def encode_sample_event(sample):
+    """return the given Sample as a server-sent event"""
+    return "data: {0}\n\n".format(json.dumps({"name": sample.name, "timestamp": sample.timestamp, "value": sample.value}))
+
+# live samples for the /stream clients
+sample_fanout = Fanout(encode_sample_event)
+data_logger.add_results_listener(sample_fanout.publish)
+metrics.gauge("stream_subscribers", sample_fanout.get_num_subscribers)
+
+# the running (or last) Profiler, see /admin/profile
+profiler = None
+profiler_lock = Lock()
+
+def item_as_dict(poll_item, fields=ALL_ITEM_FIELDS, items_url=None):
+    """return a dict version of the given PollItem, with the given fields.
+
+    items_url is the url of the items list, if already known, from which the url of the item is built
+    """
+    # return the public fields of the PollItem, plus a url field
+    item_dict = poll_item.as_dict([field for field in fields if field != "url"])
+    if "url" in fields:
+        if items_url is None:
+            item_dict["url"] = url_for("get_item", name=poll_item.name, _external=True)
+        else:
+            # as url_for would, without its overhead for each of many items
+            item_dict["url"] = items_url + url_quote(poll_item.name)
     return item_dict
 
+def generate_items_json(poll_items, fields, items_url):
+    """generate the JSON list of the given PollItems, in chunks, so a large list needn't be built in memory"""
+    yield "["
+    for start in range(0, len(poll_items), STREAM_CHUNK_SIZE):
+        chunk = [json.dumps(item_as_dict(item, fields, items_url))
+                 for item in poll_items[start:start + STREAM_CHUNK_SIZE]]
+        yield ("," if start else "") + ",".join(chunk)
+    yield "]"
+
+def parse_fields(fields_arg):
+    """return the list of item fields given a comma separated list (all fields if None)"""
+    if fields_arg is None:
+        return ALL_ITEM_FIELDS
+    fields = fields_arg.split(",")
+    for field in fields:
+        if field not in ALL_ITEM_FIELDS:
+            abort(make_error_response("unknown field: {0}".format(field), 400))
+    return fields
+
 def item_valid(item):
     return "name" in item and "key" in item and "interval" in item
 
@@ -27,10 +82,47 @@ def make_error_response(error_message, error_code):
 
 @app.route("/items/", methods=["GET"])
 def get_items():
-    """Return a list of all the poll items"""
+    """Return a list of the poll items in order of name. Optional query parameters:
+
+        fields: comma separated fields of the items to return, eg "name,last_value". Default all fields
+        limit: the maximum number of items to return. If there are more, the response has a Link header
+            with the url of the next page
+        cursor: return the items after the item with this name, as given in the Link header
+
+    The response has an ETag, so a client can use If-None-Match to avoid fetching an unchanged list again.
+    The list is streamed, as it may be large.
+    """
+    fields = parse_fields(request.args.get("fields"))
+    limit = request.args.get("limit", type=int)
+    if limit is not None and limit < 1:
+        abort(make_error_response("limit must be at least 1", 400))
+    cursor = request.args.get("cursor")
+
     global data_logger
-    poll_items = data_logger.get_items()
-    return jsonify([item_as_dict(item) for item in poll_items])
+    items_version, results_version = data_logger.get_items_version()
+    if not DYNAMIC_ITEM_FIELDS.intersection(fields):
+        # the response only changes when items are added or deleted
+        results_version = 0
+    etag = "{0}-{1}-{2:x}".format(items_version, results_version, zlib.crc32(request.query_string) & 0xffffffff)
+    if request.if_none_match.contains(etag):
+        response = make_response("", 304)
+        response.set_etag(etag)
+        return response
+
+    poll_items = data_logger.get_items_page(cursor, limit + 1 if limit is not None else None)
+    next_url = None
+    if limit is not None and len(poll_items) > limit:
+        poll_items = poll_items[:limit]
+        next_url = url_for("get_items", cursor=poll_items[-1].name, limit=limit,
+                           fields=request.args.get("fields"), _external=True)
+
+    items_url = url_for("get_items", _external=True)
+    response = Response(stream_with_context(generate_items_json(poll_items, fields, items_url)),
+                        mimetype="application/json")
+    response.set_etag(etag)
+    if next_url is not None:
+        response.headers["Link"] = '<{0}>; rel="next"'.format(next_url)
+    return response
 
 @app.route("/items/<name>", methods=["GET"])
 def get_item(name):
@@ -42,12 +134,29 @@ def get_item(name):
     except KeyError as e:
         return make_error_response(e.message, 404)
 
+@app.route("/items/<name>/history", methods=["GET"])
+def get_item_history(name):
+    """return the recent samples of the item with the given name, optionally only those after
+    the "since" query parameter (seconds since the epoch)
+    """
+    since = request.args.get("since", type=float)
+    global data_logger
+    try:
+        history = data_logger.get_history(name, since)
+    except KeyError as e:
+        return make_error_response(e.message, 404)
+    history["name"] = name
+    return jsonify(history)
+
 @app.route("/items/", methods=["POST"])
 def add_item():
-    """Add a new poll item given its required fields"""
+    """Add a new poll item given its required fields, or a list of new poll items"""
     if not request.json:
         abort(make_error_response("request must be JSON", 400))
 
+    if isinstance(request.json, list):
+        return add_items(request.json)
+
     item = request.json
     logging.info(item)
     if not item_valid(item):
@@ -58,9 +167,40 @@ def add_item():
         data_logger.add_item(**item)
     except ItemExistsError as e:
         abort(make_error_response(e.message, 422))
+    except ValueError as e:
+        abort(make_error_response(e.message, 400))
 
     return jsonify(item), 201
 
+def add_items(items):
+    """add a list of new poll items, all or nothing"""
+    if not all(isinstance(item, dict) and item_valid(item) for item in items):
+        abort(make_error_response("incomplete item", 400))
+
+    global data_logger
+    try:
+        data_logger.add_items(items)
+    except ItemExistsError as e:
+        abort(make_error_response(e.message, 422))
+    except ValueError as e:
+        abort(make_error_response(e.message, 400))
+
+    return jsonify(items), 201
+
+@app.route("/items/", methods=["DELETE"])
+def delete_items():
+    """delete the items with the given list of names, all or nothing"""
+    names = request.json
+    if not isinstance(names, list) or not all(isinstance(name, basestring) for name in names):
+        abort(make_error_response("request must be a JSON list of item names", 400))
+
+    global data_logger
+    try:
+        data_logger.delete_items(names)
+        return jsonify({"result": True})
+    except KeyError as e:
+        return make_error_response(e.message, 404)
+
 @app.route("/items/<name>", methods=["DELETE"])
 def delete_item(name):
     """delete the item with the given name"""
@@ -71,16 +211,147 @@ def delete_item(name):
     except KeyError as e:
         return make_error_response(e.message, 404)
 
+@app.route("/stream", methods=["GET"])
+def stream_samples():
+    """Stream the samples of the items as they are collected, as server-sent events whose data is a
+    JSON object of name, timestamp and value.
+
+    The "items" query parameter is an optional comma separated list of the item names to stream,
+    by default all items. A client that can't keep up loses the oldest samples, and is sent a
+    "dropped" event with the number lost.
+    """
+    names = None
+    if request.args.get("items"):
+        names = request.args["items"].split(",")
+        global data_logger
+        for name in names:
+            try:
+                data_logger.get_item(name)
+            except KeyError as e:
+                return make_error_response(e.message, 404)
+
+    subscription = sample_fanout.subscribe(names)
+
+    def generate_events():
+        try:
+            dropped = 0
+            while True:
+                messages = subscription.get(STREAM_KEEPALIVE_INTERVAL)
+                if subscription.dropped != dropped:
+                    yield "event: dropped\ndata: {0}\n\n".format(subscription.dropped - dropped)
+                    dropped = subscription.dropped
+                if messages:
+                    yield "".join(messages)
+                else:
+                    yield ": keepalive\n\n"
+        finally:
+            sample_fanout.unsubscribe(subscription)
+
+    return Response(generate_events(), mimetype="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+@app.route("/metrics", methods=["GET"])
+def get_metrics():
+    """return the internal performance metrics of the data logger"""
+    global data_logger
+    return jsonify(data_logger.get_metrics())
+
+@app.route("/pools/stats", methods=["GET"])
+def get_pool_stats():
+    """return the statistics of the polling thread pool of each sampler"""
+    global data_logger
+    return jsonify(data_logger.get_pool_stats())
+
+@app.route("/writer/stats", methods=["GET"])
+def get_writer_stats():
+    """return the statistics of the influx writer"""
+    global data_logger
+    stats = data_logger.get_writer_stats()
+    if stats is None:
+        return make_error_response("data logger not running", 503)
+    return jsonify(stats)
+
+@app.route("/sync/stats", methods=["GET"])
+def get_sync_stats():
+    """return the statistics of the sync to the central database"""
+    global data_logger
+    stats = data_logger.get_sync_stats()
+    if stats is None:
+        return make_error_response("sync not running", 503)
+    return jsonify(stats)
+
+@app.route("/sinks/stats", methods=["GET"])
+def get_sinks_stats():
+    """return the statistics of each sink, by name"""
+    global data_logger
+    stats = data_logger.get_sinks_stats()
+    if stats is None:
+        return make_error_response("data logger not running", 503)
+    return jsonify(stats)
+
+@app.route("/admin/profile", methods=["POST"])
+def start_profile():
+    """Start profiling the threads of the data logger (polling threads, polling loop, Flask threads etc).
+    Optional query parameters:
+
+        duration: how long to profile for (seconds), default 30
+        interval: the time between samples of the thread stacks (seconds), default 0.01
+
+    Returns the state of the profile, see GET /admin/profile
+    """
+    global profiler
+    try:
+        new_profiler = Profiler(float(request.args.get("duration", DEFAULT_DURATION)),
+                                float(request.args.get("interval", DEFAULT_INTERVAL)))
+    except ValueError as e:
+        return make_error_response(e.message, 400)
+    with profiler_lock:
+        if profiler is not None and profiler.is_alive():
+            return make_error_response("a profile is already running", 409)
+        profiler = new_profiler
+        profiler.start()
+    return make_response(jsonify(profiler.get_summary()), 202)
+
+@app.route("/admin/profile", methods=["DELETE"])
+def stop_profile():
+    """stop the running profile early, returning its state"""
+    global profiler
+    if profiler is None:
+        return make_error_response("no profile", 404)
+    profiler.stop()
+    return jsonify(profiler.get_summary())
+
+@app.route("/admin/profile", methods=["GET"])
+def get_profile():
+    """return the state of the running (or last) profile: the functions most often running in each thread,
+    and the calls to and time spent in each sampler during the profile
+    """
+    global profiler
+    if profiler is None:
+        return make_error_response("no profile", 404)
+    return jsonify(profiler.get_summary())
+
+@app.route("/admin/profile/stacks", methods=["GET"])
+def get_profile_stacks():
+    """return the stacks of the running (or last) profile in the collapsed format of flame graph tools, eg
+    curl http://localhost:5000/admin/profile/stacks | flamegraph.pl > profile.svg
+    """
+    global profiler
+    if profiler is None:
+        return make_error_response("no profile", 404)
+    return Response(profiler.get_collapsed(), mimetype="text/plain")
+
 
 if __name__ == "__main__":
     data_logger.load_config("data_logger_config.json")
 
     # run the data logger in a thread, concurrently with the Flask service app
-    data_logger_thread = Thread(target=data_logger.run)
+    data_logger_thread = Thread(target=data_logger.run, name="data logger")
     # We haven't implemented a way to stop the data logger yet so make it
     # a daemon thread so it quits immediately when the main thread stops.
     data_logger_thread.daemon = True
     data_logger_thread.start()
 
-    # run the flask app in the main thread
-    app.run(debug=True)
+    # run the flask app in the main thread. The reloader would run this module again in a child process, with a
+    # second data logger writing to the same spool, archive and config file. Each request gets its own thread, as
+    # a /stream request never ends and would otherwise block every other request
+    app.run(debug=True, use_reloader=False, threaded=True)
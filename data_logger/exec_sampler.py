@@ -0,0 +1,230 @@
+"""Samples from site-specific helper programs (scripts), kept running between samples so each sample costs a
+line over a pipe rather than a fork and exec.
+
+An exec item's arg is the helper's command line, optionally followed by "|" and a parameter, and the key
+(after "exec.") is the name of the value, eg key "exec.temperature", arg "/opt/site/sensors.py|probe1". One
+helper process is started per command, and is shared by all the items with that command.
+
+The protocol is one line per request and one line per response, in the same order. A request is the name of
+the value, followed by a space and the parameter if there is one, eg "temperature probe1", so neither may contain
+a line break (items that do are rejected when they are added). A response is the value (parsed as a float if
+possible, so its type doesn't switch between int and float, otherwise a string), or "error: <message>" if the
+value can't be read. nan and inf are errors, since influx can't store them. Requests are pipelined: many can be
+written before the first response is read, so the helper should answer each request in turn (and flush its
+stdout). A helper that exits (or stops responding) is restarted by the next request.
+"""
+from collections import deque
+from subprocess import Popen, PIPE
+from threading import Thread, Event, Lock
+import logging
+import math
+import shlex
+from clock import monotonic
+
+# how long to wait for a response before the helper is considered hung, and killed (seconds)
+DEFAULT_RESPONSE_TIMEOUT = 5.0
+# the shortest time between starts of a helper, so a helper that fails immediately isn't restarted continuously
+MIN_RESTART_INTERVAL = 1.0
+ERROR_PREFIX = "error:"
+
+
+def parse_response(line):
+    """return the sample value of a response line, raising ValueError if it is an error response or not finite"""
+    line = line.rstrip("\r\n")
+    if line.startswith(ERROR_PREFIX):
+        raise ValueError(line[len(ERROR_PREFIX):].strip())
+    try:
+        value = float(line)
+    except ValueError:
+        return line
+    if math.isnan(value) or math.isinf(value):
+        raise ValueError("not a finite number: {0}".format(line))
+    return value
+
+
+def split_arg(key, arg):
+    """Return (command, parameter) of an exec item's arg.
+
+    Raises ValueError if there's no command, or the key or parameter contains a line break (which would send
+    more than one request line, so the responses would no longer match the requests)
+    """
+    command, _, parameter = (arg or "").partition("|")
+    if not command.strip():
+        raise ValueError("exec items require arg (the helper command)")
+    if any(c in text for text in (key, parameter) for c in "\r\n"):
+        raise ValueError("exec key and parameter must not contain line breaks: {0}".format(key))
+    return command.strip(), parameter.strip()
+
+
+def check_item(key, arg):
+    """raise ValueError if the key (after "exec.") and arg aren't valid for an exec item, see split_arg"""
+    split_arg(key, arg)
+
+
+class PendingResponse(object):
+    """The response to a request, once it has been read"""
+    __slots__ = ("helper", "line", "error", "_done")
+
+    def __init__(self, helper):
+        self.helper = helper
+        self.line = None
+        self.error = None
+        self._done = Event()
+
+    def set(self, line=None, error=None):
+        self.line = line
+        self.error = error
+        self._done.set()
+
+    def wait(self, timeout):
+        """Return the response line, raising an exception if the request failed or timed out.
+
+        If it timed out the helper is killed, since its later responses would no longer match the requests.
+        """
+        if not self._done.wait(timeout):
+            self.helper.kill()
+            raise IOError("no response from helper {0} after {1} seconds".format(self.helper.command, timeout))
+        if self.error is not None:
+            raise self.error
+        return self.line
+
+
+class Helper:
+    """One running helper process, and the requests waiting for its responses"""
+
+    def __init__(self, command):
+        self.command = command
+        self._process = Popen(shlex.split(command), stdin=PIPE, stdout=PIPE, close_fds=True)
+        # PendingResponses in the order of the requests. Appended by the writers and popped by the reader (a
+        # deque is thread-safe for that)
+        self._pending = deque()
+        # held while queueing the PendingResponses of requests and writing them, so the two stay in the same order.
+        # The reader doesn't take it: a writer blocked on a full stdin pipe waits for the helper to read, which may
+        # be waiting for the reader to empty its stdout pipe
+        self._write_lock = Lock()
+        self.alive = True
+        self._reader = Thread(target=self._read_responses, name="exec helper reader")
+        self._reader.daemon = True
+        self._reader.start()
+
+    def request(self, lines):
+        """write the request lines, returning a PendingResponse for each"""
+        # encoded before any PendingResponse is queued, so a line that can't be encoded can't leave one behind
+        # without its request
+        payload = b"".join((line.encode("utf-8") if isinstance(line, unicode) else line) + b"\n" for line in lines)
+        responses = [PendingResponse(self) for _ in lines]
+        with self._write_lock:
+            if not self.alive:
+                raise IOError("helper exited: {0}".format(self.command))
+            self._pending.extend(responses)
+            try:
+                self._process.stdin.write(payload)
+                self._process.stdin.flush()
+            except Exception as e:
+                # the responses of a partly written payload would no longer match the requests
+                self._fail(IOError("failed to write to helper {0}: {1}".format(self.command, e)))
+        return responses
+
+    def _read_responses(self):
+        stdout = self._process.stdout
+        for line in iter(stdout.readline, ""):
+            try:
+                response = self._pending.popleft()
+            except IndexError:
+                logging.warning("unexpected response from helper {0}: {1}".format(self.command, line.rstrip()))
+                continue
+            response.set(line)
+        # stdout may have been closed by a helper that is still running. Killing it also ends any write
+        # in progress, so the write lock can be taken
+        self.kill()
+        returncode = self._process.wait()
+        with self._write_lock:
+            self._fail(IOError("helper exited with {0}: {1}".format(returncode, self.command)))
+
+    def _fail(self, error):
+        """stop the helper and fail its pending requests. Called with the write lock held"""
+        if self.alive:
+            logging.warning(str(error))
+            self.alive = False
+            self.kill()
+        # the reader may be popping too, so pop until empty rather than checking first
+        while True:
+            try:
+                self._pending.popleft().set(error=error)
+            except IndexError:
+                break
+
+    def kill(self):
+        """kill the process, which makes the reader fail the pending requests"""
+        try:
+            self._process.kill()
+        except OSError:
+            pass
+
+
+class ExecSampler:
+    """Returns samples from helper programs, see above"""
+
+    def __init__(self, response_timeout=DEFAULT_RESPONSE_TIMEOUT):
+        self._response_timeout = response_timeout
+        self._helpers = {}  # command -> Helper
+        self._start_times = {}  # command -> when its helper was last started
+        self._lock = Lock()
+
+    def get_helper(self, command):
+        """return the running Helper of the command, starting it if necessary"""
+        helper = self._helpers.get(command)
+        if helper is not None and helper.alive:
+            return helper
+        with self._lock:
+            helper = self._helpers.get(command)
+            if helper is None or not helper.alive:
+                now = monotonic()
+                if now - self._start_times.get(command, -MIN_RESTART_INTERVAL) < MIN_RESTART_INTERVAL:
+                    raise IOError("helper restarting: {0}".format(command))
+                self._start_times[command] = now
+                logging.info("starting helper {0}".format(command))
+                helper = self._helpers[command] = Helper(command)
+        return helper
+
+    def get_sample(self, key, arg):
+        command, _ = split_arg(key, arg)
+        return self._get_value(self._request(command, [(key, arg)])[0])
+
+    def get_samples(self, requests):
+        """Return samples for a batch of (key, arg) requests.
+
+        The requests to each helper are written at once, then their responses read.
+        """
+        results = {}
+        by_command = {}  # command -> list of (key, arg)
+        for key, arg in requests:
+            try:
+                command, _ = split_arg(key, arg)
+                by_command.setdefault(command, []).append((key, arg))
+            except ValueError as e:
+                results[(key, arg)] = e
+
+        pending = []
+        for command, command_requests in by_command.items():
+            try:
+                pending.extend(zip(command_requests, self._request(command, command_requests)))
+            except Exception as e:
+                results.update((request, e) for request in command_requests)
+        for request, response in pending:
+            try:
+                results[request] = self._get_value(response)
+            except Exception as e:
+                results[request] = e
+        return results
+
+    def _request(self, command, requests):
+        """write the (key, arg) requests to the helper of the command, returning their PendingResponses"""
+        lines = []
+        for key, arg in requests:
+            _, parameter = split_arg(key, arg)
+            lines.append("{0} {1}".format(key, parameter) if parameter else key)
+        return self.get_helper(command).request(lines)
+
+    def _get_value(self, response):
+        return parse_response(response.wait(self._response_timeout))
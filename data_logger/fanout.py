@@ -0,0 +1,108 @@
+"""Fan-out of live Samples to many subscribers, eg the clients of GET /stream.
+
+Each subscriber has a bounded buffer: a subscriber that doesn't keep up loses its oldest messages
+(which are counted) rather than holding up the polling loop or using unbounded memory. Subscribers
+are indexed by the item names they are interested in, and each sample is encoded once however many
+subscribers receive it, so the cost of publishing a sample doesn't grow with the number of viewers.
+"""
+from collections import deque
+from threading import Condition, Lock
+
+# the default number of messages buffered for each subscriber
+DEFAULT_BUFFER_SIZE = 1000
+
+
+class Subscription:
+    """A Subscription is one subscriber's buffer of messages, see Fanout.subscribe"""
+
+    def __init__(self, names, buffer_size):
+        self.names = names
+        # the number of messages discarded because the buffer was full
+        self.dropped = 0
+        self._buffer = deque(maxlen=buffer_size)
+        self._condition = Condition()
+
+    def put(self, messages):
+        """add messages to the buffer, discarding the oldest messages if it is full"""
+        with self._condition:
+            overflow = len(self._buffer) + len(messages) - self._buffer.maxlen
+            if overflow > 0:
+                self.dropped += overflow
+            self._buffer.extend(messages)
+            self._condition.notify()
+
+    def get(self, timeout):
+        """remove and return the buffered messages, waiting up to timeout seconds for some to arrive.
+        Returns an empty list on timeout.
+        """
+        with self._condition:
+            if not self._buffer:
+                self._condition.wait(timeout)
+            messages = list(self._buffer)
+            self._buffer.clear()
+        return messages
+
+
+class Fanout:
+    """A Fanout publishes Samples to the Subscriptions interested in them"""
+
+    def __init__(self, encode=None):
+        """Args:
+
+            encode (function): optional, encode(sample) returns the message passed to the subscribers for
+                a Sample. By default subscribers are passed the Samples themselves.
+        """
+        self._encode = encode or (lambda sample: sample)
+        # Subscriptions are replaced rather than modified, so publish() needn't lock
+        self._by_name = {}  # item name -> tuple of Subscriptions to the item
+        self._all = ()  # Subscriptions to all the items
+        self._lock = Lock()
+
+    def subscribe(self, names=None, buffer_size=DEFAULT_BUFFER_SIZE):
+        """return a new Subscription to the Samples of the items with the given names (all items if None)"""
+        subscription = Subscription(frozenset(names) if names is not None else None, buffer_size)
+        with self._lock:
+            if names is None:
+                self._all += (subscription,)
+            else:
+                by_name = dict(self._by_name)
+                for name in subscription.names:
+                    by_name[name] = by_name.get(name, ()) + (subscription,)
+                self._by_name = by_name
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            if subscription.names is None:
+                self._all = tuple(s for s in self._all if s is not subscription)
+            else:
+                by_name = dict(self._by_name)
+                for name in subscription.names:
+                    subscriptions = tuple(s for s in by_name.get(name, ()) if s is not subscription)
+                    if subscriptions:
+                        by_name[name] = subscriptions
+                    else:
+                        by_name.pop(name, None)
+                self._by_name = by_name
+
+    def get_num_subscribers(self):
+        with self._lock:
+            return len(self._all) + len(set(s for subscriptions in self._by_name.values() for s in subscriptions))
+
+    def publish(self, samples):
+        """pass the given Samples to the interested subscribers, waking each of them once"""
+        by_name = self._by_name
+        all_subscriptions = self._all
+        if not by_name and not all_subscriptions:
+            return
+
+        pending = {}  # Subscription -> list of messages
+        for sample in samples:
+            subscriptions = by_name.get(sample.name, ()) + all_subscriptions
+            if subscriptions:
+                message = self._encode(sample)
+                for subscription in subscriptions:
+                    pending.setdefault(subscription, []).append(message)
+
+        for subscription, messages in pending.items():
+            subscription.put(messages)
@@ -0,0 +1,90 @@
+from array import array
+from bisect import bisect_right
+from threading import Lock
+
+DEFAULT_HISTORY_DEPTH = 600
+# the initial capacity of a History, which grows up to its depth as samples are added
+INITIAL_CAPACITY = 16
+
+
+class History:
+    """A History is a fixed size ring buffer of the recent (timestamp, value) samples of a PollItem.
+
+    The samples are stored in two typed (double) arrays rather than a list of objects, so each
+    sample costs 16 bytes. The arrays start small and double in size until they reach the depth,
+    so items that are polled rarely (or not yet) don't pay for the full depth. Only numeric values
+    are stored; bools are stored as 0.0/1.0.
+    """
+
+    def __init__(self, depth=DEFAULT_HISTORY_DEPTH):
+        """Args:
+
+            depth (int): the maximum number of samples kept
+        """
+        self._depth = depth
+        self._capacity = min(depth, INITIAL_CAPACITY)
+        self._timestamps = array("d", [0.0]) * self._capacity
+        self._values = array("d", [0.0]) * self._capacity
+        self._count = 0  # number of samples stored, up to capacity
+        self._next = 0   # index of the next sample to be written
+        self._lock = Lock()
+
+    def add(self, timestamp, value):
+        """Add a sample, overwriting the oldest sample if the buffer is full.
+
+        Args:
+            timestamp (float): seconds since the epoch
+            value: the sample value, ignored if it is not a number
+        """
+        try:
+            value = float(value)
+        except (TypeError, ValueError):
+            return
+        with self._lock:
+            if self._count == self._capacity < self._depth:
+                self._grow()
+            self._timestamps[self._next] = timestamp
+            self._values[self._next] = value
+            self._next = (self._next + 1) % self._capacity
+            if self._count < self._capacity:
+                self._count += 1
+
+    def _grow(self):
+        """double the capacity (up to the depth) of the full buffer, moving the oldest sample to index 0"""
+        capacity = min(self._depth, self._capacity * 2)
+        padding = array("d", [0.0]) * (capacity - self._capacity)
+        start = self._next
+        self._timestamps = self._timestamps[start:] + self._timestamps[:start] + padding
+        self._values = self._values[start:] + self._values[:start] + padding
+        self._next = self._count
+        self._capacity = capacity
+
+    def get_samples(self, since=None):
+        """return the list of (timestamp, value) samples newer than since (if given), oldest first"""
+        with self._lock:
+            start = (self._next - self._count) % self._capacity
+            if start + self._count <= self._capacity:
+                timestamps = self._timestamps[start:start + self._count]
+                values = self._values[start:start + self._count]
+            else:
+                timestamps = self._timestamps[start:] + self._timestamps[:self._next]
+                values = self._values[start:] + self._values[:self._next]
+
+        if since is not None:
+            # the samples are in time order so the first one newer than since can be found by bisection
+            first = bisect_right(timestamps, since)
+            timestamps = timestamps[first:]
+            values = values[first:]
+        return zip(timestamps, values)
+
+    def summary(self, since=None):
+        """return a dict of the samples newer than since (if given), plus their min, max and mean"""
+        samples = self.get_samples(since)
+        values = [s[1] for s in samples]
+        return {
+            "samples": samples,
+            "count": len(values),
+            "min": min(values) if values else None,
+            "max": max(values) if values else None,
+            "mean": sum(values) / len(values) if values else None
+        }
@@ -0,0 +1,112 @@
+import gzip
+import math
+from cStringIO import StringIO
+from influxdb.exceptions import InfluxDBClientError
+from metrics import metrics
+from sink import Sink, DEFAULT_BATCH_SIZE, DEFAULT_FLUSH_INTERVAL, DEFAULT_QUEUE_SIZE, DEFAULT_RETRY_INTERVAL
+
+# the 4xx responses which aren't about the batch (authentication, a missing database, rate limiting), so the
+# write is retried rather than the batch rejected
+RETRIED_CLIENT_ERRORS = (401, 403, 404, 429)
+
+
+def is_rejected(error):
+    """return True if influx rejected the batch, eg for a field type conflict or a point it can't parse"""
+    code = getattr(error, "code", None)
+    return (isinstance(error, InfluxDBClientError) and isinstance(code, int) and 400 <= code < 500 and
+            code not in RETRIED_CLIENT_ERRORS)
+
+
+def escape_key(s):
+    """escape a measurement name or field key for the influx line protocol"""
+    return s.replace(",", r"\,").replace("=", r"\=").replace(" ", r"\ ")
+
+def format_value(value):
+    """return the line protocol representation of a field value"""
+    # check bool before int, since bool is a subclass of int
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    if isinstance(value, (int, long)):
+        return "{0}i".format(value)
+    if isinstance(value, float):
+        return repr(value)
+    return u'"{0}"'.format(unicode(value).replace("\\", "\\\\").replace('"', r'\"'))
+
+def compress(body):
+    """return the body gzipped, for a request with Content-Encoding: gzip"""
+    buf = StringIO()
+    with gzip.GzipFile(fileobj=buf, mode="wb", compresslevel=5) as f:
+        f.write(body)
+    return buf.getvalue()
+
+def is_finite(value):
+    """return False if value is a float nan or inf, which the line protocol can't represent"""
+    return not isinstance(value, float) or not (math.isnan(value) or math.isinf(value))
+
+def encode_line(measurement, fields, timestamp_ms):
+    """Encode one point in the influx line protocol.
+
+    Fields whose values are nan or inf are left out (and counted in non_finite_values), since influx would reject
+    the whole batch. Returns None if that leaves no fields.
+
+    Args:
+        measurement (str): eg "rpdemo"
+        fields (iterable): (key, value) pairs
+        timestamp_ms (int): milliseconds since the epoch
+    """
+    encoded = []
+    for k, v in fields:
+        if is_finite(v):
+            encoded.append(u"{0}={1}".format(escape_key(k), format_value(v)))
+        else:
+            metrics.counter("non_finite_values").inc()
+    if not encoded:
+        return None
+    field_set = u",".join(encoded)
+    return u"{0} {1} {2}".format(escape_key(measurement), field_set, timestamp_ms)
+
+
+class InfluxWriter(Sink):
+    """An InfluxWriter is a Sink that writes line protocol points to InfluxDB, each batch in a single HTTP request.
+
+    If a Spool is given, points that can't be written because influx is down (or because the
+    writer has fallen too far behind) are appended to the spool instead of being dropped. Once
+    influx is writable again the spooled points are replayed in large batches.
+    """
+
+    def __init__(self, client, database, batch_size=DEFAULT_BATCH_SIZE, flush_interval=DEFAULT_FLUSH_INTERVAL,
+                 use_gzip=False, queue_size=DEFAULT_QUEUE_SIZE, spool=None, retry_interval=DEFAULT_RETRY_INTERVAL,
+                 name="influx", overflow=None):
+        """Args:
+
+            client (InfluxDBClient): the client used to write to influx
+            database (str): eg "rpdemo"
+            batch_size (int): flush when this many points are buffered
+            flush_interval (float): flush when the oldest buffered point is this old (seconds)
+            use_gzip (bool): gzip the request body
+            queue_size (int): the maximum number of result sets waiting to be buffered
+            spool (Spool): optional, where points are kept while influx is unavailable
+            retry_interval (float): seconds between attempts to write to influx while it is unavailable
+            name (str): the name of the sink
+            overflow (str): optional, the overflow policy, see sink.py
+        """
+        super(InfluxWriter, self).__init__(name, batch_size=batch_size, flush_interval=flush_interval,
+                                           queue_size=queue_size, overflow=overflow, spool=spool,
+                                           retry_interval=retry_interval)
+        self._client = client
+        self._database = database
+        self._use_gzip = use_gzip
+
+    def is_rejected(self, error):
+        return is_rejected(error)
+
+    def write_batch(self, lines):
+        """write the points to influx"""
+        body = u"\n".join(lines).encode("utf-8")
+        headers = {"Content-Type": "application/octet-stream"}
+        if self._use_gzip:
+            body = compress(body)
+            headers["Content-Encoding"] = "gzip"
+        self._client.request("write", "POST",
+                             params={"db": self._database, "precision": "ms"},
+                             data=body, expected_response_code=204, headers=headers)
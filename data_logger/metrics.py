@@ -0,0 +1,170 @@
+"""Internal metrics for monitoring the performance of the data logger.
+
+The metrics are cheap enough to leave on: each thread updates its own cell of a counter or
+histogram, so recording a value takes no lock (a lock is only taken the first time a thread
+touches a metric). Reading a metric sums the cells of all the threads.
+"""
+from array import array
+from bisect import bisect_left
+from clock import monotonic
+from threading import Lock
+try:
+    from thread import get_ident
+except ImportError:
+    from threading import get_ident
+
+# histogram bucket upper bounds, suitable for latencies in seconds
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+PERCENTILES = (50, 90, 99)
+
+
+class Counter:
+    """A Counter is a monotonically increasing count, eg of failed samples"""
+
+    def __init__(self):
+        self._cells = {}  # thread ident -> count
+        self._lock = Lock()
+
+    def inc(self, n=1):
+        ident = get_ident()
+        try:
+            self._cells[ident] += n
+        except KeyError:
+            with self._lock:
+                self._cells[ident] = n
+
+    def value(self):
+        return sum(self._cells.values())
+
+
+class Histogram:
+    """A Histogram counts observed values (eg latencies) in preallocated buckets"""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        """Args:
+
+            buckets (sequence): the upper bounds of the buckets, in increasing order. Larger values
+                are counted in an extra overflow bucket.
+        """
+        self._buckets = buckets
+        self._cells = {}  # thread ident -> (array of bucket counts, array of [sum])
+        self._lock = Lock()
+
+    def observe(self, value):
+        cell = self._cells.get(get_ident())
+        if cell is None:
+            cell = self._new_cell()
+        cell[0][bisect_left(self._buckets, value)] += 1
+        cell[1][0] += value
+
+    def _new_cell(self):
+        cell = (array("l", [0]) * (len(self._buckets) + 1), array("d", [0.0]))
+        with self._lock:
+            self._cells[get_ident()] = cell
+        return cell
+
+    def snapshot(self):
+        """return a dict of the count, sum, approximate percentiles and bucket counts"""
+        counts = [0] * (len(self._buckets) + 1)
+        total = 0.0
+        for bucket_counts, cell_sum in list(self._cells.values()):
+            for i, n in enumerate(bucket_counts):
+                counts[i] += n
+            total += cell_sum[0]
+
+        count = sum(counts)
+        snapshot = {
+            "count": count,
+            "sum": total,
+            "mean": total / count if count else None,
+            "buckets": dict((str(bound), n) for bound, n in zip(self._buckets + ("+Inf",), counts))
+        }
+        for percentile in PERCENTILES:
+            snapshot["p{0}".format(percentile)] = self._percentile(counts, count, percentile)
+        return snapshot
+
+    def _percentile(self, counts, count, percentile):
+        """return the upper bound of the bucket containing the given percentile"""
+        if not count:
+            return None
+        rank = count * percentile / 100.0
+        cumulative = 0
+        for i, n in enumerate(counts):
+            cumulative += n
+            if cumulative >= rank:
+                return self._buckets[i] if i < len(self._buckets) else float("inf")
+        return None
+
+
+class Metrics:
+    """Metrics is a registry of named Counters, Histograms and gauges"""
+
+    def __init__(self):
+        self._counters = {}
+        self._histograms = {}
+        self._gauges = {}
+        self._lock = Lock()
+        self._start_time = monotonic()
+
+    def counter(self, name):
+        """return the Counter with the given name, creating it if necessary"""
+        counter = self._counters.get(name)
+        if counter is None:
+            with self._lock:
+                counter = self._counters.setdefault(name, Counter())
+        return counter
+
+    def histogram(self, name, buckets=LATENCY_BUCKETS):
+        """return the Histogram with the given name, creating it if necessary"""
+        histogram = self._histograms.get(name)
+        if histogram is None:
+            with self._lock:
+                histogram = self._histograms.setdefault(name, Histogram(buckets))
+        return histogram
+
+    def gauge(self, name, func):
+        """register a gauge, whose value is func() when read"""
+        with self._lock:
+            self._gauges[name] = func
+
+    def snapshot(self):
+        """return a dict of the current values of all the metrics"""
+        with self._lock:
+            counters = dict(self._counters)
+            histograms = dict(self._histograms)
+            gauges = dict(self._gauges)
+
+        gauge_values = {}
+        for name, func in gauges.items():
+            try:
+                gauge_values[name] = func()
+            except Exception:
+                gauge_values[name] = None
+
+        return {
+            "uptime": monotonic() - self._start_time,
+            "counters": dict((name, counter.value()) for name, counter in counters.items()),
+            "histograms": dict((name, histogram.snapshot()) for name, histogram in histograms.items()),
+            "gauges": gauge_values
+        }
+
+    def flatten(self, snapshot=None):
+        """return a list of (name, value) of the metrics, suitable for writing to influx as fields"""
+        if snapshot is None:
+            snapshot = self.snapshot()
+        fields = [("uptime", snapshot["uptime"])]
+        for name, value in snapshot["counters"].items():
+            fields.append((name, value))
+        for name, value in snapshot["gauges"].items():
+            if isinstance(value, (int, long, float)):
+                fields.append((name, value))
+        for name, histogram in snapshot["histograms"].items():
+            fields.append((name + ".count", histogram["count"]))
+            for stat in ["mean"] + ["p{0}".format(p) for p in PERCENTILES]:
+                if histogram[stat] is not None and histogram[stat] != float("inf"):
+                    fields.append((name + "." + stat, float(histogram[stat])))
+        return fields
+
+
+# the metrics of this process
+metrics = Metrics()
@@ -1,13 +1,22 @@
 import logging
 import re
 import subprocess
+from pinger import Pinger
+
+PING_TIMEOUT = 1.0  # seconds
+
+
+def no_reply(host):
+    """return the error of a ping that got no reply, so the item's poll fails (and is backed off)"""
+    return IOError("no reply from {0}".format(host))
+
 
 def ping(host):
     """
-    ping the given host.
-    returns the ping time in ms, or zero if ping fails for any reason
+    ping the given host using the ping command. This is only used if the Pinger can't open an ICMP socket.
+    returns the ping time in ms, or None if ping fails for any reason
     """
-    ping_time = 0.0
+    ping_time = None
     try:
         # ping args:  -c1 - send one ping
         #             -w1 - timeout after 1 second
@@ -31,11 +40,71 @@ def ping(host):
 class NetSampler:
     """Returns metrics for network access"""
 
+    def __init__(self):
+        # all pings share the one Pinger (and its ICMP socket)
+        self.pinger = None
+        try:
+            self.pinger = Pinger()
+        except Exception as e:
+            logging.warn("failed to start pinger, falling back to the ping command: {0}".format(e))
+
+    def ping(self, host):
+        """ping the given host, returns the ping time in ms. Raises IOError if there is no reply"""
+        if self.pinger is None:
+            ping_time = ping(host)
+        else:
+            ping_time = self.pinger.ping(host, PING_TIMEOUT)
+        if ping_time is None:
+            raise no_reply(host)
+        return ping_time
+
+    def supports_async(self, key):
+        """return True if get_sample_async can be used for the given key"""
+        return key == "ping" and self.pinger is not None
+
+    def get_sample_async(self, key, arg, callback):
+        """start getting a sample without blocking, see Sampler.get_sample_async"""
+        if not arg:
+            raise ValueError("ping requires host arg")
+        host = arg
+        def ping_callback(ping_time):
+            if ping_time is None:
+                callback(None, no_reply(host))
+            else:
+                callback(ping_time, None)
+        self.pinger.ping_async(host, PING_TIMEOUT, ping_callback)
+
+    def supports_batch(self, key):
+        """return True if get_samples can sample many keys concurrently"""
+        return key == "ping" and self.pinger is not None
+
+    def get_samples(self, requests):
+        """return samples for a batch of (key, arg) requests, pinging all the hosts concurrently"""
+        results = {}
+        hosts = set()
+        for key, arg in requests:
+            if key != "ping":
+                results[(key, arg)] = ValueError("NetSampler unknown key: {0}".format(key))
+            elif not arg:
+                results[(key, arg)] = ValueError("ping requires host arg")
+            else:
+                hosts.add(arg)
+
+        if not hosts:
+            ping_times = {}
+        elif self.pinger is not None:
+            ping_times = self.pinger.ping_many(hosts, PING_TIMEOUT)
+        else:
+            ping_times = dict((host, ping(host)) for host in hosts)
+        for host, ping_time in ping_times.items():
+            results[("ping", host)] = ping_time if ping_time is not None else no_reply(host)
+        return results
+
     def get_sample(self, key, arg):
         if key == "ping":
             if not arg:
                 raise ValueError("ping requires host arg")
             host = arg
-            return ping(host)
+            return self.ping(host)
         else:
             raise ValueError("NetSampler unknown key: {0}".format(key))
@@ -0,0 +1,189 @@
+"""Oversampling of noisy hardware sensors, eg the SenseHat: each sample is the mean of many readings, along
+with their standard deviation, min and max, so the signal is smoothed without writing more points to influx.
+
+The readings are either taken in a burst when the item is polled (BurstReader), or continuously at a fixed
+rate by a dedicated thread (ContinuousReader), in which case each sample summarises the readings taken since
+the previous one. Either way the readings are stored in preallocated buffers that are reused for every sample.
+
+A sampler enables oversampling per item with the item's arg, see parse_oversampling.
+"""
+from array import array
+from threading import Thread, Lock
+import logging
+import math
+import time
+from clock import monotonic
+
+# the most readings in a burst
+MAX_BURST = 1000
+# the fastest rate of continuous reading (per second)
+MAX_RATE = 100.0
+# a continuous reader buffers the readings of this long (seconds). If an item is polled less often than this
+# the oldest unread readings are overwritten
+DEFAULT_BUFFER_SECONDS = 60.0
+# a continuous reader stops if its item hasn't been polled for this long (seconds), eg the item was deleted
+DEFAULT_IDLE_TIMEOUT = 600.0
+
+
+def parse_oversampling(arg):
+    """Parse the oversampling mode of an item from its arg, returning (mode, n), or None for no oversampling.
+
+    The arg is either "burst:<n>" to take n readings in a burst each time the item is polled, or
+    "continuous:<n>" to take readings continuously at n per second. Raises ValueError if the arg is invalid.
+    """
+    if not arg:
+        return None
+    mode, _, n = arg.partition(":")
+    try:
+        if mode == "burst":
+            count = int(n)
+            if 1 <= count <= MAX_BURST:
+                return mode, count
+        elif mode == "continuous":
+            rate = float(n)
+            if 0 < rate <= MAX_RATE:
+                return mode, rate
+    except ValueError:
+        pass
+    raise ValueError("invalid oversampling (expected burst:<1-{0}> or continuous:<rate up to {1}/s>): {2}".format(
+        MAX_BURST, MAX_RATE, arg))
+
+
+class Oversample(float):
+    """The value of an oversampled sample: a float (the mean of the readings) that also has their stddev,
+    min, max and count. It can be used wherever a float sample value can, eg by the history and rollups.
+    """
+    __slots__ = ("stddev", "min", "max", "count")
+
+    def __new__(cls, mean, stddev, min, max, count):
+        value = float.__new__(cls, mean)
+        value.stddev = stddev
+        value.min = min
+        value.max = max
+        value.count = count
+        return value
+
+    def __reduce__(self):
+        return Oversample, (float(self), self.stddev, self.min, self.max, self.count)
+
+    def fields(self, name):
+        """return the influx fields of the sample of the named item: the mean is the item's own field"""
+        return [(name, float(self)), (name + ".stddev", self.stddev), (name + ".min", self.min),
+                (name + ".max", self.max), (name + ".count", self.count)]
+
+
+def summarize(buffer, count):
+    """return the Oversample of the first count readings in the buffer"""
+    total = 0.0
+    low = high = buffer[0]
+    for i in xrange(count):
+        value = buffer[i]
+        total += value
+        if value < low:
+            low = value
+        elif value > high:
+            high = value
+    mean = total / count
+    squares = 0.0
+    for i in xrange(count):
+        deviation = buffer[i] - mean
+        squares += deviation * deviation
+    return Oversample(mean, math.sqrt(squares / count), low, high, count)
+
+
+class BurstReader:
+    """Takes a burst of readings each time a sample is needed"""
+
+    def __init__(self, read, count):
+        """Args:
+
+            read (function): read() returns a reading (a number)
+            count (int): the number of readings per sample
+        """
+        self._read = read
+        self._count = count
+        self._buffer = array("d", [0.0]) * count
+        self._lock = Lock()
+
+    def get_sample(self):
+        """take the readings, returning their Oversample"""
+        with self._lock:
+            buffer = self._buffer
+            read = self._read
+            for i in xrange(self._count):
+                buffer[i] = read()
+            return summarize(buffer, self._count)
+
+
+class ContinuousReader(Thread):
+    """Takes readings continuously at a fixed rate from a dedicated thread, buffering them until the next
+    sample is needed.
+    """
+
+    def __init__(self, read, rate, buffer_seconds=DEFAULT_BUFFER_SECONDS, idle_timeout=DEFAULT_IDLE_TIMEOUT,
+                 name="continuous reader"):
+        """Args:
+
+            read (function): read() returns a reading (a number)
+            rate (float): the number of readings per second
+            buffer_seconds (float): the buffers hold this long of readings
+            idle_timeout (float): the thread stops if get_sample isn't called for this long (seconds)
+        """
+        Thread.__init__(self, name=name)
+        self.daemon = True
+        self._read = read
+        self._interval = 1.0 / rate
+        self._idle_timeout = idle_timeout
+        capacity = max(1, int(math.ceil(rate * buffer_seconds)))
+        # readings are written to one buffer while the other is summarised
+        self._buffer = array("d", [0.0]) * capacity
+        self._spare = array("d", [0.0]) * capacity
+        # the number of readings written to the buffer, which wrap around when it is full
+        self._written = 0
+        self._last_get_time = monotonic()
+        self._lock = Lock()
+        # held while a buffer is summarised, so it isn't swapped back in to be written to meanwhile
+        self._get_lock = Lock()
+
+    def run(self):
+        next_time = monotonic()
+        failures = 0
+        while monotonic() - self._last_get_time < self._idle_timeout:
+            try:
+                value = float(self._read())
+                failures = 0
+            except Exception as e:
+                failures += 1
+                if failures == 1:
+                    logging.warning("{0} failed to read: {1}".format(self.name, e))
+            else:
+                with self._lock:
+                    self._buffer[self._written % len(self._buffer)] = value
+                    self._written += 1
+
+            now = monotonic()
+            next_time += self._interval
+            if next_time < now:
+                # fallen behind (eg slow readings), skip the missed readings rather than catching up
+                next_time = now
+            time.sleep(next_time - now)
+        logging.info("{0} stopped, not polled for {1} seconds".format(self.name, self._idle_timeout))
+
+    def get_sample(self):
+        """Return the Oversample of the readings since the previous call.
+
+        If there are no readings (eg the reader has just started, or the sensor is failing) one reading is
+        taken now instead.
+        """
+        with self._get_lock:
+            with self._lock:
+                self._last_get_time = monotonic()
+                buffer = self._buffer
+                count = min(self._written, len(buffer))
+                self._buffer = self._spare
+                self._spare = buffer
+                self._written = 0
+            if count == 0:
+                buffer[0] = float(self._read())
+                count = 1
+            return summarize(buffer, count)
@@ -0,0 +1,256 @@
+import errno
+import heapq
+import itertools
+import logging
+import os
+import select
+import socket
+import struct
+from clock import monotonic
+from Queue import Queue
+from threading import Thread, Lock, Event
+
+ICMP_ECHO_REPLY = 0
+ICMP_ECHO_REQUEST = 8
+DNS_CACHE_TTL = 300.0  # seconds
+# the longest the receiver thread waits before checking for timed out probes (seconds)
+TIMEOUT_CHECK_INTERVAL = 0.05
+
+_icmp_header = struct.Struct("!BBHHH")  # type, code, checksum, identifier, sequence
+PAYLOAD = b"rpdemo-pinger".ljust(32, b".")
+
+
+def checksum(data):
+    """return the internet checksum (RFC 1071) of the given bytes"""
+    if len(data) % 2:
+        data += b"\0"
+    total = sum(struct.unpack("!{0}H".format(len(data) // 2), data))
+    total = (total >> 16) + (total & 0xffff)
+    total += total >> 16
+    return ~total & 0xffff
+
+
+class Probe(object):
+    """a single outstanding echo request"""
+    __slots__ = ("address", "sequence", "send_time", "deadline", "callback")
+
+    def __init__(self, address, sequence, deadline, callback):
+        self.address = address
+        self.sequence = sequence
+        self.send_time = None
+        self.deadline = deadline
+        self.callback = callback
+
+
+class Pinger:
+    """A Pinger sends ICMP echo requests to any number of hosts from a single socket.
+
+    Replies are received by a background thread and matched to the outstanding probes by
+    sequence number, so many pings may be in flight at once and no process is forked per ping.
+    Round trip times are measured on the monotonic clock. The same thread times out probes
+    which get no reply.
+
+    Host names are resolved by another background thread, so a slow DNS server never holds up
+    the caller (eg the polling loop). Addresses are cached, and an expired address is still used
+    while it is refreshed. A ping still waiting for its host's address at its deadline times out.
+
+    An unprivileged ICMP datagram socket is used if the kernel allows it (see the
+    net.ipv4.ping_group_range sysctl), otherwise a raw socket, which requires root or CAP_NET_RAW.
+    """
+
+    def __init__(self):
+        self._raw = False
+        try:
+            self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_ICMP)
+        except socket.error:
+            self._socket = socket.socket(socket.AF_INET, socket.SOCK_RAW, socket.IPPROTO_ICMP)
+            self._raw = True
+
+        # the kernel replaces the identifier of datagram sockets with their port number, so
+        # it is only checked for raw sockets, which see all the ICMP traffic on the host
+        self._identifier = os.getpid() & 0xffff
+        self._sequences = itertools.cycle(range(1, 0x10000))
+        self._probes = {}  # sequence -> Probe
+        self._deadlines = []  # heap of (deadline, sequence) of the outstanding probes
+        self._lock = Lock()
+        self._dns_cache = {}  # host -> (address, expiry time)
+        # host -> list of (deadline, callback) of the pings waiting for its address, for the hosts being resolved
+        self._resolving = {}
+        self._resolve_queue = Queue()  # hosts to be resolved
+
+        self._resolver = Thread(target=self._resolve_hosts, name="pinger resolver")
+        self._resolver.daemon = True
+        self._resolver.start()
+        self._receiver = Thread(target=self._receive_replies)
+        self._receiver.daemon = True
+        self._receiver.start()
+        logging.info("pinger started using {0} socket".format("raw" if self._raw else "datagram"))
+
+    def ping(self, host, timeout=1.0):
+        """ping the given host, returning the round trip time in ms or None if there is no reply within timeout"""
+        return self.ping_many([host], timeout)[host]
+
+    def ping_many(self, hosts, timeout=1.0):
+        """Ping all the given hosts concurrently.
+
+        Returns a dict of host -> round trip time in ms, or None if there is no reply within timeout.
+        """
+        results = dict.fromkeys(hosts)
+        if not results:
+            return results
+        remaining = [len(results)]
+        done = Event()
+        lock = Lock()
+
+        def make_callback(host):
+            def callback(rtt):
+                results[host] = rtt
+                with lock:
+                    remaining[0] -= 1
+                    if remaining[0] == 0:
+                        done.set()
+            return callback
+
+        for host in results.keys():
+            self.ping_async(host, timeout, make_callback(host))
+        # every probe calls back by its timeout, the extra wait just allows for the receiver thread being late
+        done.wait(timeout + 1.0)
+        return results
+
+    def ping_async(self, host, timeout, callback):
+        """Ping the given host without waiting for the reply.
+
+        callback(rtt) is called with the round trip time in ms, or None if there is no reply
+        within timeout. It is usually called from the receiver thread so it must not block.
+        """
+        address = self._resolve(host, monotonic() + timeout, callback)
+        if address is not None:
+            self._send_or_fail(host, address, timeout, callback)
+
+    def _send_or_fail(self, host, address, timeout, callback):
+        try:
+            self._send(address, timeout, callback)
+        except socket.error as e:
+            logging.debug("ping {0} failed: {1}".format(host, e))
+            self._complete_callback(callback, None)
+
+    def _resolve(self, host, deadline, callback):
+        """Return the cached address of the host, queueing it to be resolved if it has expired.
+
+        If there is no address yet, None is returned and the ping (its deadline and callback) waits for
+        the resolver thread, which sends it.
+        """
+        with self._lock:
+            address, expiry_time = self._dns_cache.get(host, (None, None))
+            if address is not None and expiry_time > monotonic():
+                return address
+            waiting = self._resolving.get(host)
+            if waiting is None:
+                waiting = self._resolving[host] = []
+                self._resolve_queue.put(host)
+            if address is None:
+                waiting.append((deadline, callback))
+            return address
+
+    def _resolve_hosts(self):
+        while True:
+            host = self._resolve_queue.get()
+            try:
+                address = socket.gethostbyname(host)
+            except (socket.error, socket.gaierror) as e:
+                logging.debug("failed to resolve {0}: {1}".format(host, e))
+                address = None
+            with self._lock:
+                if address is not None:
+                    self._dns_cache[host] = (address, monotonic() + DNS_CACHE_TTL)
+                # if the refresh of an expired address failed the old address is kept, and retried by the next ping
+                waiting = self._resolving.pop(host, [])
+            for deadline, callback in waiting:
+                timeout = deadline - monotonic()
+                if address is None or timeout <= 0:
+                    self._complete_callback(callback, None)
+                else:
+                    self._send_or_fail(host, address, timeout, callback)
+
+    def _send(self, address, timeout, callback):
+        with self._lock:
+            sequence = next(self._sequences)
+            while sequence in self._probes:
+                sequence = next(self._sequences)
+            probe = Probe(address, sequence, monotonic() + timeout, callback)
+            self._probes[sequence] = probe
+
+        header = _icmp_header.pack(ICMP_ECHO_REQUEST, 0, 0, self._identifier, sequence)
+        packet = _icmp_header.pack(ICMP_ECHO_REQUEST, 0, checksum(header + PAYLOAD), self._identifier, sequence) + PAYLOAD
+        probe.send_time = monotonic()
+        try:
+            self._socket.sendto(packet, (address, 0))
+        except socket.error:
+            with self._lock:
+                self._probes.pop(sequence, None)
+            raise
+        with self._lock:
+            heapq.heappush(self._deadlines, (probe.deadline, sequence))
+
+    def _receive_replies(self):
+        while True:
+            self._expire_probes()
+            try:
+                readable, _, _ = select.select([self._socket], [], [], TIMEOUT_CHECK_INTERVAL)
+                if not readable:
+                    continue
+                packet, (address, _) = self._socket.recvfrom(2048)
+            except (socket.error, select.error) as e:
+                if e.args[0] != errno.EINTR:
+                    logging.error("pinger receive failed: {0}".format(e))
+                continue
+            receive_time = monotonic()
+
+            if self._raw:
+                # raw sockets receive the IP header too
+                packet = packet[(ord(packet[0:1]) & 0x0f) * 4:]
+            if len(packet) < _icmp_header.size:
+                continue
+            icmp_type, _, _, identifier, sequence = _icmp_header.unpack_from(packet)
+            if icmp_type != ICMP_ECHO_REPLY or (self._raw and identifier != self._identifier):
+                continue
+
+            with self._lock:
+                probe = self._probes.get(sequence)
+                if probe is None or probe.address != address or probe.send_time is None:
+                    continue
+                del self._probes[sequence]
+            self._complete(probe, (receive_time - probe.send_time) * 1000.0)
+
+    def _expire_probes(self):
+        """complete any probes which have passed their deadline without a reply, and any pings which have
+        passed their deadline still waiting for the address of their host (eg from a slow DNS server)
+        """
+        now = monotonic()
+        expired = []
+        expired_callbacks = []
+        with self._lock:
+            for host, waiting in self._resolving.items():
+                if any(deadline <= now for deadline, _ in waiting):
+                    expired_callbacks.extend(callback for deadline, callback in waiting if deadline <= now)
+                    waiting[:] = [(deadline, callback) for deadline, callback in waiting if deadline > now]
+            while self._deadlines and self._deadlines[0][0] <= now:
+                _, sequence = heapq.heappop(self._deadlines)
+                probe = self._probes.get(sequence)
+                # the sequence number may have been reused since, in which case the deadline won't match
+                if probe is not None and probe.deadline <= now:
+                    del self._probes[sequence]
+                    expired.append(probe)
+        for probe in expired:
+            self._complete(probe, None)
+        for callback in expired_callbacks:
+            self._complete_callback(callback, None)
+
+    def _complete(self, probe, rtt):
+        self._complete_callback(probe.callback, rtt)
+
+    def _complete_callback(self, callback, rtt):
+        try:
+            callback(rtt)
+        except Exception as e:
+            logging.error("ping callback failed: {0}".format(e))
@@ -1,141 +1,581 @@
-import datetime
 import logging
-import random
+import math
+from bisect import bisect_right
 import time
-from sampler import Sampler
+import zlib
+from collections import namedtuple
+from clock import monotonic
+from history import History, DEFAULT_HISTORY_DEPTH
+from metrics import metrics
+from registry import ItemRegistry, ItemExistsError
+from sampler import Sampler, check_item
+from scheduler import Scheduler
 from Queue import Queue, Empty
-from threading import Thread
-
-SAMPLE_INTERVAL = 1.0
-
-class ItemExistsError(Exception):
-    pass
-
-class PollItem:
+from threading import Thread, Lock
+
+# results are collected and passed to the results callback at this interval (seconds)
+RESULT_INTERVAL = 1.0
+# the shortest supported poll interval (seconds)
+MIN_INTERVAL = 0.01
+# the default maximum time a poll may take (seconds), see WorkerPool
+DEFAULT_DEADLINE = 10.0
+# how often the polling loop checks for polls that have overrun their deadline (seconds)
+DEADLINE_CHECK_INTERVAL = 0.1
+# the default longest interval (seconds) a failing item's polls are backed off to, see PollItem.current_interval
+DEFAULT_MAX_BACKOFF = 60.0
+# an item's first poll is within this long (seconds) of it being added, staggered by sampler, see PollItem
+FIRST_POLL_SPREAD = 0.25
+
+# polling engines:
+#   threads - every item is polled by the sampler's pool of PollingThreads
+#   async - items whose samplers support it are polled without blocking, directly from the
+#           polling loop, and only the rest are polled by the PollingThreads
+ENGINE_THREADS = "threads"
+ENGINE_ASYNC = "async"
+
+# A Sample is the immutable result of one poll of a PollItem, as passed from the polling threads to the
+# results callback. name is the PollItem name, timestamp is in seconds since the epoch.
+Sample = namedtuple("Sample", ["name", "timestamp", "value"])
+
+# the public fields of a PollItem, see PollItem.as_dict
+ITEM_FIELDS = ("name", "key", "arg", "interval", "deadband", "heartbeat", "max_backoff", "last_value", "last_sample_time",
+               "poll_in_progress", "dispatch_lag", "failures")
+
+
+def is_number(value):
+    """return True if value is an int or float (but not a bool, which is an int in python)"""
+    return isinstance(value, (int, long, float)) and not isinstance(value, bool)
+
+
+class PollItem(object):
     """A PollItem is a metric that is sampled (polled) periodically and inserted into the database."""
+    # there may be many thousands of items so they don't have a __dict__
+    __slots__ = ("name", "key", "arg", "interval", "deadband", "heartbeat", "max_backoff", "last_value",
+                 "last_sample_time", "poll_in_progress", "dispatch_lag", "failures", "poll_generation", "deleted",
+                 "next_poll_time", "last_reported_value", "last_reported_time")
 
-    def __init__(self, name, key, arg, interval):
+    def __init__(self, name, key, arg, interval, deadband=None, heartbeat=None, max_backoff=DEFAULT_MAX_BACKOFF):
         """Args:
 
             name (str): eg "ping google.com.au"
             key (str): eg "net.ping"
             arg (str): eg "google.com.au"
-            interval (int): eg 5.0 (seconds)
+            interval (float): eg 5.0 (seconds), minimum MIN_INTERVAL
+            deadband (float): optional, only report (write) a sample if its value differs from the last
+                reported value by more than this, eg 0.05. 0 reports only changed values. See should_report
+            heartbeat (float): optional, report a sample at least this often (seconds), even if unchanged.
+                If there is no deadband, samples are only reported if their value has changed (or on the
+                heartbeat)
+            max_backoff (float): the longest interval (seconds) polls are backed off to while the item is
+                failing, 0 for no backoff. See current_interval
+
+        Raises ValueError if the key isn't of the form "<sampler>.<name>", the interval or the other settings
+        aren't numbers, the interval is too short, the other settings are negative, or the arg isn't valid for
+        the sampler (see sampler.check_item)
         """
+        if not isinstance(key, basestring) or not all(key.partition(".")[::2]):
+            raise ValueError("key must be of the form <sampler>.<name>, eg net.ping: {0}".format(name))
+        if not is_number(interval):
+            raise ValueError("interval must be a number: {0}".format(name))
+        if interval < MIN_INTERVAL:
+            raise ValueError("interval must be at least {0} seconds: {1}".format(MIN_INTERVAL, name))
+        if deadband is not None and (not is_number(deadband) or deadband < 0):
+            raise ValueError("deadband must be a number, not negative: {0}".format(name))
+        if heartbeat is not None and (not is_number(heartbeat) or heartbeat <= 0):
+            raise ValueError("heartbeat must be a positive number: {0}".format(name))
+        if not is_number(max_backoff) or max_backoff < 0:
+            raise ValueError("max_backoff must be a number, not negative: {0}".format(name))
+        check_item(key, arg)
+
         self.name = name
         self.key = key
         self.arg = arg
         self.interval = interval
+        self.deadband = deadband
+        self.heartbeat = heartbeat
+        self.max_backoff = max_backoff
         self.last_value = None
+        self.last_sample_time = None
         self.poll_in_progress = False
-
-        # For the initial poll, add a random delay up the interval to stagger the items
-        delay = random.randint(0, self.interval)
-        self.next_poll_time = datetime.datetime.now() + datetime.timedelta(seconds=delay)
+        # how late (seconds) the last poll was dispatched, compared to when it was scheduled
+        self.dispatch_lag = 0.0
+        # the number of consecutive failed polls
+        self.failures = 0
+        self.last_reported_value = None
+        self.last_reported_time = None
+        # incremented each time a poll starts, so the result of a poll that timed out can be recognised
+        self.poll_generation = 0
+        self.deleted = False
+
+        # the first poll is due soon (rather than up to an interval away), staggered by sampler like the phases,
+        # then the item falls into phase, see schedule_next_poll. next_poll_time is on the monotonic clock, see
+        # clock.py
+        self.next_poll_time = monotonic() + self._phase() * min(interval, FIRST_POLL_SPREAD)
 
     def __str__(self):
         return "{0} ({1}[{2}])".format(self.name, self.key, self.arg)
 
-    def needs_poll(self, now, tolerance):
-        """Returns True if the item needs polling now"""
-        return not self.poll_in_progress and (now - self.next_poll_time) > -tolerance
+    def as_dict(self, fields=ITEM_FIELDS):
+        """return a dict of the item's public fields (or the given subset of them), suitable for serialisation
+        to JSON
+        """
+        return dict((field, getattr(self, field)) for field in fields)
+
+    def current_interval(self):
+        """Return the time until the next poll: the interval, or while the item is failing, the interval
+        doubled for each consecutive failure up to max_backoff. It is always a multiple of the interval
+        so the item keeps its phase.
+        """
+        if not self.failures or not self.max_backoff:
+            return self.interval
+        max_multiple = max(1, int(self.max_backoff / self.interval))
+        return self.interval * min(1 << min(self.failures, 30), max_multiple)
 
-    def do_poll(self, sampler):
-        """Get (sample) the current value of the item by calling the Sampler.
+    def in_phase_poll_time(self, now):
+        """Return the first poll time after now that is in phase.
 
-        Updates self.last_value, self.next_poll_time and sets self.poll_in_progress to False when done.
+        The items are staggered by sampler: items of the same sampler and interval are polled in phase, so
+        they fall due together and can be sampled as one batch, while the phases of different samplers
+        are spread across the interval.
         """
-        self.next_poll_time = datetime.datetime.now() + datetime.timedelta(seconds=self.interval)
-        try:
-            self.last_value = sampler.get_sample(self.key, self.arg)
-            logging.debug("{0} result: {1}".format(self, self.last_value))
-        except Exception as e:
-            self.last_value = None
-            logging.debug("{0} error: {1}".format(self, e))
+        phase = self._phase() * self.interval
+        poll_time = now - (now % self.interval) + phase
+        if poll_time <= now:
+            poll_time += self.interval
+        return poll_time
+
+    def _phase(self):
+        """return the phase of the item's sampler, as a fraction of an interval"""
+        sampler_name = self.key.split(".")[0].encode("utf-8")
+        return (zlib.crc32(sampler_name) & 0xffffffff) / float(1 << 32)
+
+    def schedule_next_poll(self, now):
+        """Advance next_poll_time by the current interval.
+
+        Deadlines advance from the previous deadline rather than from now so the item doesn't
+        drift (or lose its phase). If the item has fallen a whole interval behind the missed polls
+        are skipped rather than fired in a burst.
+        """
+        if self.poll_generation == 0:
+            # after the first poll the item falls into phase
+            self.next_poll_time = self.in_phase_poll_time(now)
+            return
+        self.next_poll_time += self.current_interval()
+        if self.next_poll_time <= now:
+            missed = math.floor((now - self.next_poll_time) / self.interval) + 1
+            self.next_poll_time += missed * self.interval
+
+    def start_poll(self):
+        """mark the item as being polled"""
+        self.poll_generation += 1
+        self.poll_in_progress = True
+
+    def poll_timeout(self, generation):
+        """Give up on the given poll generation, so the item can be polled again.
+
+        The result of the poll will be discarded if it eventually completes.
+        """
+        if generation == self.poll_generation:
+            self.poll_generation += 1
+            self.poll_in_progress = False
+            self.failures += 1
+
+    def poll_complete(self, value, error, generation=None):
+        """Record the result of a poll, where error is an Exception if the poll failed.
+
+        Updates self.last_value, self.last_sample_time and sets self.poll_in_progress to False.
+        Returns the Sample, whose value is None if the poll failed.
+        If the generation of the poll is given and the poll has since timed out, the result is
+        discarded and None is returned.
+        """
+        if generation is not None and generation != self.poll_generation:
+            logging.debug("{0} late result discarded".format(self))
+            return None
+
+        if error is None:
+            logging.debug("{0} result: {1}".format(self, value))
+            self.failures = 0
+        else:
+            value = None
+            self.failures += 1
+            logging.debug("{0} error: {1}, polls backed off to {2} seconds".format(self, error, self.current_interval()))
+        sample = Sample(self.name, time.time(), value)
+        self.last_value = value
+        self.last_sample_time = sample.timestamp
         self.poll_in_progress = False
+        return sample
+
+    def should_report(self, sample):
+        """Return True if the given Sample of the item should be reported (written to the database), in which
+        case it is recorded as the last reported sample.
+
+        Without a deadband or heartbeat every sample is reported. Otherwise a sample is reported if it
+        is the first, if its value has moved beyond the deadband since the last reported sample, or if
+        the heartbeat has expired since the last reported sample.
+        """
+        if self.deadband is None and self.heartbeat is None:
+            return True
+
+        last_value = self.last_reported_value
+        if last_value is None:
+            report = True
+        elif self.heartbeat is not None and sample.timestamp - self.last_reported_time >= self.heartbeat:
+            report = True
+        elif self.deadband and isinstance(sample.value, (int, long, float)) and isinstance(last_value, (int, long, float)):
+            report = abs(sample.value - last_value) > self.deadband
+        else:
+            report = sample.value != last_value
+
+        if report:
+            self.last_reported_value = sample.value
+            self.last_reported_time = sample.timestamp
+        return report
+
+
+def sample_items(items, sampler):
+    """Sample a batch of PollItems that are due at the same time, with one call to the Sampler.
+
+    Items with the same key and arg share a single sample, unless the sampler keeps state for each item (see
+    Sampler.get_item_samples). Returns a list of (value, error) for the items, where error is an Exception if
+    the sample failed.
+    """
+    results = sampler.get_item_samples([(item.name, item.key, item.arg) for item in items])
+    samples = []
+    for item in items:
+        value = results.get(item.name)
+        if isinstance(value, Exception):
+            samples.append((None, value))
+        else:
+            samples.append((value, None))
+    return samples
+
+
+class PollTask(object):
+    """A batch of PollItems queued for polling by a PollingThread, with the poll generation of each item."""
+    __slots__ = ("items", "generations", "start_time", "timed_out")
+
+    def __init__(self, items):
+        self.items = items
+        self.generations = [item.poll_generation for item in items]
+        self.start_time = None
+        self.timed_out = False
 
 
 class PollingThread(Thread):
-    """A PollingThread is a Thread that polls PollItems from a queue.
+    """A PollingThread is a Thread that polls batches of PollItems from a queue.
+
+    The Thread waits on the polling_queue, removes a PollTask, polls its items then
+    adds their Samples to the result_queue.
 
-    The Thread waits on the polling_queue, removes a PollItem, polls it then
-    adds it to the result_queue.
+    If its WorkerPool abandons the thread because a poll has overrun the deadline, the thread
+    discards the (late) results and exits once the poll eventually returns.
     """
 
-    def __init__(self, polling_queue, result_queue, sampler):
+    def __init__(self, pool, polling_queue, result_queue, sampler):
         """Args:
 
-            polling_queue (Queue): a queue of PollItems that need polling
-            result_queue (Queue): a queue of PollItems that have been polled
+            pool (WorkerPool): the pool the thread belongs to
+            polling_queue (Queue): a queue of PollTasks that need polling
+            result_queue (Queue): a queue of Samples of PollItems that have been polled
             sampler (Sampler): the sampler used to update the value of a PollItem
         """
-        super(PollingThread, self).__init__()
+        super(PollingThread, self).__init__(name="{0} polling thread".format(pool.name))
+        self._pool = pool
         self._polling_queue = polling_queue
         self._result_queue = result_queue
         self._sampler = sampler
+        self.current_task = None
+        self.abandoned = False
         # polling threads should die immediately when the process ends
         self.daemon = True
 
     def run(self):
-        logging.info("polling thread {0} started".format(self.ident))
-        while True:
-            item = self._polling_queue.get()
-            logging.debug("thread {0} polling item {1}".format(self.ident, item.name))
-            item.do_poll(self._sampler)
-            if item.last_value is not None:
-                self._result_queue.put(item)
-
+        logging.info("{0} polling thread {1} started".format(self._pool.name, self.ident))
+        while not self.abandoned:
+            task = self._polling_queue.get()
+            logging.debug("thread {0} polling {1} items".format(self.ident, len(task.items)))
+            task.start_time = monotonic()
+            self.current_task = task
+            samples = sample_items(task.items, self._sampler)
+            self.current_task = None
+            latency = monotonic() - task.start_time
+
+            late = 0
+            failed = 0
+            for item, generation, (value, error) in zip(task.items, task.generations, samples):
+                if error is not None:
+                    failed += 1
+                try:
+                    sample = item.poll_complete(value, error, generation)
+                except Exception as e:
+                    # a bad item mustn't stop the thread polling the others
+                    logging.error("{0} poll result failed: {1}".format(item, e))
+                    continue
+                if sample is None:
+                    late += 1
+                else:
+                    # failed polls (with a None value) are queued too, as they change the item's state
+                    self._result_queue.put(sample)
+            self._pool.count_polls(task.items, latency, failed, late)
+        logging.info("{0} polling thread {1} exiting, it was abandoned".format(self._pool.name, self.ident))
+
+
+class WorkerPool:
+    """A WorkerPool is a bounded pool of PollingThreads dedicated to one sampler (eg "net").
+
+    Each sampler has its own pool so a slow or hung sampler can only tie up its own threads.
+    If a poll runs longer than the deadline, its items are released for polling again (and their
+    late results will be discarded) and the thread is abandoned and replaced, so the pool keeps
+    its capacity. At most max_abandoned threads may be abandoned at once, after which hung polls
+    are still timed out but their threads are not replaced until they return.
+    """
 
-class Poller:
-    """The Poller polls PollItems using a pool of PollingThreads."""
+    def __init__(self, name, num_threads, deadline, result_queue, sampler):
+        """Args:
 
-    def __init__(self):
-        self._sampler = Sampler()
-        self._items = []
+            name (str): the sampler name, eg "net"
+            num_threads (int): the number of polling threads
+            deadline (float): the maximum time a poll may take (seconds)
+            result_queue (Queue): a queue of Samples of PollItems that have been polled
+            sampler (Sampler): the sampler used to update the value of a PollItem
+        """
+        self.name = name
+        self._num_threads = num_threads
+        self._deadline = deadline
+        self._max_abandoned = num_threads
+        self._result_queue = result_queue
+        self._sampler = sampler
+        self._queue = Queue()  # PollTasks that require polling by a polling thread
         self._threads = []
-        self._polling_queue = Queue() # items that require polling by a polling thread
-        self._result_queue = Queue()  # items that have just been polled by a polling thread
+        self._abandoned = []
+        self._lock = Lock()
+        self._stats = {
+            "polls": 0,
+            "deadline_exceeded": 0,
+            "late_results_discarded": 0,
+            "threads_abandoned": 0
+        }
+        self._busy_time = metrics.counter("pool.{0}.busy_seconds".format(name))
+        self._start_time = monotonic()
+        metrics.gauge("pool.{0}.queue_size".format(name), self._queue.qsize)
+        metrics.gauge("pool.{0}.threads".format(name), lambda: len(self._threads))
+        metrics.gauge("pool.{0}.utilisation".format(name), self.get_utilisation)
+
+    def start(self):
+        for i in range(self._num_threads):
+            self._start_thread()
+
+    def put(self, items):
+        """queue a batch of items for polling"""
+        self._queue.put(PollTask(items))
+
+    def check_deadlines(self, now):
+        """time out any polls that have overrun the deadline, returning the number of items timed out"""
+        timed_out = 0
+        for thread in list(self._threads):
+            task = thread.current_task
+            if task is None or task.timed_out or now - task.start_time <= self._deadline:
+                continue
+
+            task.timed_out = True
+            logging.warn("{0} poll of {1} items exceeded the {2}s deadline".format(self.name, len(task.items), self._deadline))
+            for item, generation in zip(task.items, task.generations):
+                item.poll_timeout(generation)
+            timed_out += len(task.items)
+            with self._lock:
+                self._stats["deadline_exceeded"] += len(task.items)
+            metrics.counter("samples_deadline_exceeded").inc(len(task.items))
+
+            self._abandoned = [t for t in self._abandoned if t.is_alive()]
+            if len(self._abandoned) < self._max_abandoned:
+                thread.abandoned = True
+                self._threads.remove(thread)
+                self._abandoned.append(thread)
+                with self._lock:
+                    self._stats["threads_abandoned"] += 1
+                self._start_thread()
+        return timed_out
+
+    def count_polls(self, items, latency, failed, late):
+        """record the result of polling a batch of items, which took latency seconds"""
+        with self._lock:
+            self._stats["polls"] += len(items)
+            self._stats["late_results_discarded"] += late
+        self._busy_time.inc(latency)
+        for key in set(item.key for item in items):
+            metrics.histogram("sample_latency." + key).observe(latency)
+        if failed:
+            metrics.counter("samples_failed").inc(failed)
+        if late:
+            metrics.counter("samples_late").inc(late)
+
+    def get_utilisation(self):
+        """return the average fraction of time the pool's threads have been busy polling"""
+        elapsed = (monotonic() - self._start_time) * self._num_threads
+        return self._busy_time.value() / elapsed if elapsed > 0 else 0.0
+
+    def get_stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+        stats["threads"] = len(self._threads)
+        stats["abandoned_threads_alive"] = len([t for t in self._abandoned if t.is_alive()])
+        stats["deadline"] = self._deadline
+        stats["queue_size"] = self._queue.qsize()
+        return stats
+
+    def _start_thread(self):
+        thread = PollingThread(self, self._queue, self._result_queue, self._sampler)
+        thread.start()
+        self._threads.append(thread)
 
-    def _start_polling_threads(self, num_threads):
-        for i in range(num_threads):
-            thread = PollingThread(self._polling_queue, self._result_queue, self._sampler)
-            thread.start()
-            self._threads.append(thread)
 
-    def add_item(self, name, key, arg, interval):
+class Poller:
+    """The Poller polls PollItems using a WorkerPool of PollingThreads for each sampler."""
+
+    def __init__(self, sampler=None):
+        """Args:
+
+            sampler (Sampler): optional, the sampler used to poll the items. By default a Sampler with all
+                the standard samplers, which is created when the Poller starts running.
+        """
+        self._sampler = sampler
+        self._items = ItemRegistry()
+        self._histories = {}  # item name -> History
+        self._history_depth = DEFAULT_HISTORY_DEPTH
+        self._schedule = Scheduler()
+        self._pools = {}  # sampler name -> WorkerPool
+        self._pools_config = {}
+        self._num_polling_threads = 0
+        self._running = False
+        self._result_queue = Queue()  # Samples of items that have just been polled
+        self._engine = ENGINE_THREADS
+        self._results_listeners = []
+        # incremented whenever the items' values or polling state change (polls dispatched, collected, failed or
+        # timed out), so readers can tell if the dynamic fields of the items have changed
+        self.results_version = 0
+        self._dispatch_lag = metrics.histogram("dispatch_lag")
+        metrics.gauge("result_queue_size", self._result_queue.qsize)
+        metrics.gauge("items", lambda: len(self._items))
+
+    def _get_pool(self, sampler_name):
+        """return the WorkerPool for the given sampler, starting it if necessary"""
+        pool = self._pools.get(sampler_name)
+        if pool is None:
+            config = self._pools_config.get(sampler_name, {})
+            pool = WorkerPool(sampler_name,
+                              config.get("threads", self._num_polling_threads),
+                              config.get("deadline", DEFAULT_DEADLINE),
+                              self._result_queue, self._sampler)
+            pool.start()
+            self._pools[sampler_name] = pool
+        return pool
+
+    def get_pool_stats(self):
+        """return a dict of sampler name -> WorkerPool statistics"""
+        return dict((name, pool.get_stats()) for name, pool in self._pools.items())
+
+    def add_item(self, name, key, arg, interval, deadband=None, heartbeat=None, max_backoff=DEFAULT_MAX_BACKOFF):
         """Add a new item to be polled.
 
         Args:
             name (str): eg "ping google.com.au"
             key (str): eg "net.ping"
             arg (str): eg "google.com.au" (optional, use depends on key)
-            interval (int): eg 5.0 (seconds)
+            interval (float): eg 5.0 (seconds)
+            deadband, heartbeat, max_backoff: optional, see PollItem
 
         Raises ItemExistsError if item with given name already exists
+        Raises ValueError if the interval is too short (or other settings are invalid)
 
         """
-        if name in [i.name for i in self._items]:
-            raise ItemExistsError("item already exists: {0}".format(name))
+        self.add_items([{"name": name, "key": key, "arg": arg, "interval": interval,
+                         "deadband": deadband, "heartbeat": heartbeat, "max_backoff": max_backoff}])
+
+    def add_items(self, items_config):
+        """Add many new items to be polled, as one update. Each item is a dict of name, key, arg, interval
+        and optionally deadband, heartbeat and max_backoff as for add_item.
 
-        self._items.append(PollItem(name, key, arg, interval))
+        Raises ItemExistsError (and adds none of the items) if any item with given name already exists
+        Raises ValueError (and adds none of the items) if any interval is too short (or other settings are invalid)
+
+        """
+        self._add_poll_items([self._new_item(i) for i in items_config])
+
+    def _new_item(self, item_config):
+        """return a new PollItem given its config, see add_items"""
+        return PollItem(item_config["name"], item_config["key"], item_config.get("arg"), item_config["interval"],
+                        item_config.get("deadband"), item_config.get("heartbeat"),
+                        item_config.get("max_backoff", DEFAULT_MAX_BACKOFF))
+
+    def _add_poll_items(self, items, histories=None):
+        """add the given new PollItems, with the given histories (item name -> History) if any"""
+        self._items.add_many(items)
+        if self._history_depth:
+            for item in items:
+                history = histories.get(item.name) if histories else None
+                self._histories[item.name] = history or History(self._history_depth)
+        self._items_added(items)
+
+    def _items_added(self, items):
+        """start polling the given (newly added) PollItems"""
+        self._schedule.add_many(items)
 
     def delete_item(self, name):
-        # this will raise KeyError if the item is not found
-        item = self.get_item(name)
-        # now delete it
-        # TODO: confirm this is thread-safe, since it's typically called by the Flask thread
-        self._items = [item for item in self._items if item.name != name]
+        """Delete the item with the given name
+
+        Raises KeyError if the item is not found
+        """
+        self.delete_items([name])
+
+    def delete_items(self, names):
+        """Delete the items with the given names, as one update.
+
+        Raises KeyError (and deletes none of the items) if any item is not found
+        """
+        items = self._items.delete_many(names)
+        for item in items:
+            self._histories.pop(item.name, None)
+        self._items_deleted(items)
+
+    def _items_deleted(self, items):
+        """stop polling the given (just deleted) PollItems"""
+        # the items are dropped from the schedule when they next fall due
+        for item in items:
+            item.deleted = True
+        if self._sampler is not None:
+            self._sampler.forget_items([item.name for item in items])
+
+    def set_history_depth(self, depth):
+        """set the number of recent samples kept for each item added from now on, 0 to disable history"""
+        self._history_depth = depth
+
+    def get_history(self, name):
+        """return the History of the item with the given name
+
+        Raises KeyError if not found
+        """
+        try:
+            return self._histories[name]
+        except KeyError:
+            raise KeyError("item history not found: {0}".format(name))
 
     def get_items_config(self):
         """Return a list of dicts describing the poll items, suitable for serialisation to JSON"""
         items_config = []
-        for item in self._items:
+        for item in self._items.snapshot():
             item_config = {
                 "name": item.name,
                 "key": item.key,
                 "arg": item.arg,
                 "interval": item.interval
             }
+            # the optional settings are only included if set, as in the config file
+            if item.deadband is not None:
+                item_config["deadband"] = item.deadband
+            if item.heartbeat is not None:
+                item_config["heartbeat"] = item.heartbeat
+            if item.max_backoff != DEFAULT_MAX_BACKOFF:
+                item_config["max_backoff"] = item.max_backoff
             items_config.append(item_config)
 
         return items_config
@@ -159,91 +599,256 @@ class Poller:
             ]
 
         """
-        if self._items:
+        if len(self._items):
             raise Exception("poller is already configured")
 
-        for item in items_config:
-            self.add_item(item["name"], item["key"], item["arg"], item["interval"])
+        self.add_items(items_config)
+
+    def apply_items_config(self, items_config):
+        """Update the items to match the given items config (as for set_items_config), changing only the items
+        that differ: new items are added, missing items are deleted and items whose settings have changed are
+        updated. Unchanged items, and their schedules, are untouched.
+
+        An item whose key, arg, interval or max_backoff has changed is replaced (keeping its history), one
+        whose deadband or heartbeat has changed is updated in place.
+
+        Returns (added, deleted, changed), lists of the item names.
+        Raises ValueError or ItemExistsError (and changes nothing) if the config is invalid.
+        """
+        # all the items are validated before anything is changed
+        new_items = [self._new_item(i) for i in items_config]
+        new_names = set()
+        for item in new_items:
+            if item.name in new_names:
+                raise ItemExistsError("duplicate item: {0}".format(item.name))
+            new_names.add(item.name)
+
+        current = dict((item.name, item) for item in self._items.snapshot())
+        deleted = [name for name in current if name not in new_names]
+        added = []
+        replaced = []
+        updated = []  # (current item, new item)
+        for item in new_items:
+            current_item = current.get(item.name)
+            if current_item is None:
+                added.append(item)
+            elif ((current_item.key, current_item.arg, current_item.interval, current_item.max_backoff) !=
+                  (item.key, item.arg, item.interval, item.max_backoff)):
+                replaced.append(item)
+            elif (current_item.deadband, current_item.heartbeat) != (item.deadband, item.heartbeat):
+                updated.append((current_item, item))
+
+        if deleted or replaced:
+            histories = dict((item.name, self._histories.get(item.name)) for item in replaced)
+            self.delete_items(deleted + [item.name for item in replaced])
+            self._add_poll_items(replaced, histories)
+        if added:
+            self._add_poll_items(added)
+        for current_item, item in updated:
+            current_item.deadband = item.deadband
+            current_item.heartbeat = item.heartbeat
+        if updated:
+            # so readers of the items (eg a GET /items/ cached by ETag) see the new settings
+            self._items.touch()
+
+        changed = [item.name for item in replaced] + [item.name for item, _ in updated]
+        return [item.name for item in added], deleted, changed
 
     def get_items(self):
-        """return a list of all the PollItems"""
-        return self._items
+        """return a list (tuple) of all the PollItems"""
+        return self._items.snapshot()
+
+    def get_items_page(self, cursor=None, limit=None):
+        """return a list (tuple) of the PollItems in order of name, starting after the item named cursor
+        (from the first item if None) and returning at most limit items (all if None)
+        """
+        names, items = self._items.sorted_snapshot()
+        start = bisect_right(names, cursor) if cursor is not None else 0
+        end = start + limit if limit is not None else len(items)
+        return items[start:end]
+
+    def get_items_version(self):
+        """return the version of the items, which changes whenever an item is added, deleted or changed"""
+        return self._items.version
+
+    def add_results_listener(self, listener):
+        """register listener(samples) to be called with the list of Samples each time results are collected,
+        from the polling loop (so it should be quick)
+        """
+        self._results_listeners.append(listener)
 
     def get_item(self, name):
         """return the PollItem with the given name
 
         Raises KeyError if not found
         """
-        for item in self._items:
-            if item.name == name:
-                return item
-        raise KeyError("item not found: {0}".format(name))
+        return self._items.get(name)
 
-    def run(self, num_polling_threads, results_callback):
+    def run(self, num_polling_threads, results_callback, engine=ENGINE_THREADS, pools_config=None):
         """Run the polling main loop, polling items as per their polling interval.
 
-        Results are collected once per second and provided via results_callback(items),
-        where items is a list of PollItems.
+        The loop sleeps until the next item is due, so items may be polled at sub-second intervals.
+        Results are collected every RESULT_INTERVAL seconds and provided via results_callback(samples),
+        where samples is a list of the Samples to be reported, see PollItem.should_report. It is called even
+        if the list is empty, so the callback can also do work that is due by time (eg closing rollups).
+
+        engine is ENGINE_THREADS or ENGINE_ASYNC, see above.
+
+        pools_config configures the WorkerPool of each sampler, eg {"net": {"threads": 8, "deadline": 2.0}}.
+        By default a pool has num_polling_threads threads and a deadline of DEFAULT_DEADLINE.
 
         This method does not return.
         """
-        if self._threads:
+        if self._running:
             raise Exception("Poller already running")
+        if engine not in (ENGINE_THREADS, ENGINE_ASYNC):
+            raise ValueError("unknown polling engine: {0}".format(engine))
 
-        self._start_polling_threads(num_polling_threads)
+        self._running = True
+        if self._sampler is None:
+            self._sampler = Sampler()
+        self._engine = engine
+        self._num_polling_threads = num_polling_threads
+        self._pools_config = pools_config or {}
 
+        next_result_time = monotonic() + RESULT_INTERVAL
         while True:
-            start_timestamp = datetime.datetime.now()
-
-            # enque the due items for polling by the threads
-            self._dispatch_due_items()
+            # enqueue the due items for polling by the threads
+            self._dispatch_due_items(monotonic())
 
-            # Wait a short while for fast poll results to come in. It doesn't matter if slow ones are not
-            # complete after this wait - we'll check for them next time around.
-            time.sleep(0.1)
+            now = monotonic()
+            if sum(pool.check_deadlines(now) for pool in self._pools.values()):
+                self.results_version += 1
 
-            # collect any results (PollItems) that are ready
-            result_items = self._collect_poll_results()
+            if now >= next_result_time:
+                # collect any results (Samples) that are ready. It doesn't matter if slow ones are not
+                # complete yet - we'll check for them next time around.
+                samples = self._filter_reports(self._collect_poll_results())
+                results_callback(samples)
 
-            if result_items:
-                results_callback(result_items)
+                next_result_time += RESULT_INTERVAL
+                now = monotonic()
+                if next_result_time <= now:
+                    logging.warn("result processing overran the result interval {0} by {1} seconds".format(
+                        RESULT_INTERVAL, now - next_result_time + RESULT_INTERVAL))
+                    next_result_time = now + RESULT_INTERVAL
 
-            cycle_time = (datetime.datetime.now() - start_timestamp).total_seconds()
-            if cycle_time < SAMPLE_INTERVAL:
-                sleep_time_sec = SAMPLE_INTERVAL - cycle_time
-                logging.debug("sleeping for {0} seconds".format(sleep_time_sec))
-                time.sleep(sleep_time_sec)
-            else:
-                logging.warn("cycle time {0} exceeded sample interval {1}".format(cycle_time, SAMPLE_INTERVAL))
+            self._schedule.wait(min(next_result_time, monotonic() + DEADLINE_CHECK_INTERVAL))
 
-    def _dispatch_due_items(self):
+    def _dispatch_due_items(self, now):
         """
         enqueue any due poll items for processing by the polling threads
         """
-        now = datetime.datetime.now()
-
-        # an item is polled if the current time is within 0.5s of the due poll time.
-        # this avoids failing to poll every second cycle
-        tolerance = datetime.timedelta(seconds=0.5)
-
-        # find the items that are now due to be polled
-        items_due = [i for i in self._items if i.needs_poll(now, tolerance)]
-
-        # add the due items to the polling queue
-        logging.debug("adding {0} items to polling queue (size was {1})".format(len(items_due), self._polling_queue.qsize()))
+        items_due = []
+        for item in self._schedule.pop_due(now):
+            if item.deleted:
+                continue
+            # reschedule the items before they are polled, so they keep their cadence however long the poll takes
+            try:
+                item.dispatch_lag = now - item.next_poll_time
+                self._dispatch_lag.observe(item.dispatch_lag)
+                item.schedule_next_poll(now)
+            except Exception as e:
+                # a bad item mustn't stop the others being polled, so it is dropped from the schedule
+                logging.error("{0} scheduling failed, no longer polled: {1}".format(item, e))
+                metrics.counter("schedule_errors").inc()
+                continue
+            items_due.append(item)
+        self._schedule.reschedule(items_due)
+
+        # Group the due items into batches for the polling queue, skipping items whose previous poll
+        # is still running. Items whose sampler supports batches are batched together by sampler,
+        # other items are only batched with items that have the same key and arg.
+        batches = {}
         for item in items_due:
-            item.poll_in_progress = True
-            self._polling_queue.put(item)
+            if item.poll_in_progress:
+                logging.debug("{0} skipped, previous poll still in progress".format(item))
+                metrics.counter("polls_skipped").inc()
+                continue
+            item.start_poll()
+            try:
+                if self._engine == ENGINE_ASYNC and self._sampler.supports_async(item.key):
+                    self._poll_async(item)
+                elif self._sampler.supports_batch(item.key):
+                    batches.setdefault(item.key.split(".")[0], []).append(item)
+                else:
+                    batches.setdefault((item.key, item.arg), []).append(item)
+            except Exception as e:
+                # a bad item mustn't stop the others being polled
+                logging.error("{0} dispatch failed: {1}".format(item, e))
+                metrics.counter("samples_failed").inc()
+                item.poll_complete(None, e)
+
+        if items_due:
+            # the items' dispatch_lag and poll_in_progress have changed
+            self.results_version += 1
+
+        logging.debug("adding {0} batches of {1} items to polling queues".format(len(batches), len(items_due)))
+        for batch in batches.values():
+            self._get_pool(batch[0].key.split(".")[0]).put(batch)
+
+    def _poll_async(self, item):
+        """poll the item without blocking, its result is queued when the sampler calls back"""
+        generation = item.poll_generation
+        start_time = monotonic()
+        def callback(value, error):
+            metrics.histogram("sample_latency." + item.key).observe(monotonic() - start_time)
+            if error is not None:
+                metrics.counter("samples_failed").inc()
+            sample = item.poll_complete(value, error, generation)
+            if sample is not None:
+                self._result_queue.put(sample)
+        try:
+            self._sampler.get_sample_async(item.key, item.arg, callback)
+        except Exception as e:
+            item.poll_complete(None, e)
 
     def _collect_poll_results(self):
         """
-        return (and remove) any currently available poll results (a list of PollItems)
+        return (and remove) any currently available poll results (a list of Samples)
         does not block or wait for any results
         """
-        items = []
+        polled = []
         while True:
             try:
-                items.append(self._result_queue.get_nowait())
+                polled.append(self._result_queue.get_nowait())
             except Empty:
                 break
-        return items
+
+        # only the successful polls are reported, but the failed ones have changed the items' state too
+        samples = [sample for sample in polled if sample.value is not None]
+        if len(samples) < len(polled):
+            self.results_version += 1
+        self._samples_collected(samples)
+        return samples
+
+    def _filter_reports(self, samples):
+        """return the given Samples that should be reported, see PollItem.should_report"""
+        reports = []
+        for sample in samples:
+            try:
+                item = self._items.get(sample.name)
+            except KeyError:
+                # the item has been deleted since it was polled
+                continue
+            if item.should_report(sample):
+                reports.append(sample)
+        if len(reports) < len(samples):
+            metrics.counter("samples_suppressed").inc(len(samples) - len(reports))
+        return reports
+
+    def _samples_collected(self, samples):
+        """add the just collected samples to the history, and pass them to the results listeners"""
+        if not samples:
+            return
+        for sample in samples:
+            history = self._histories.get(sample.name)
+            if history is not None:
+                history.add(sample.timestamp, sample.value)
+        self.results_version += 1
+
+        for listener in self._results_listeners:
+            try:
+                listener(samples)
+            except Exception as e:
+                logging.exception("results listener failed: {0}".format(e))
@@ -0,0 +1,184 @@
+"""A low-overhead sampling profiler, for finding where the time goes in a running data logger without
+restarting it (see the /admin/profile endpoints of data_logger_app.py).
+
+A background thread takes the stack of every other thread (with sys._current_frames) every interval, and
+counts each distinct stack. Nothing is done in the profiled threads, so the overhead is the profiler
+thread's own, and it only runs while profiling. The stacks are returned in the "collapsed" format of flame
+graph tools (eg https://github.com/brendangregg/FlameGraph): one line per distinct stack, the thread name then
+the frames from outermost to innermost separated by ";", then the number of times the stack was seen.
+
+Threads are named by their Thread name with any trailing number removed, so eg the threads of a polling
+pool, or Flask's request threads ("Thread-N"), are merged. Only this process is profiled, not shard processes.
+"""
+import os
+import re
+import sys
+import threading
+from threading import Thread, Event, Lock
+from clock import monotonic
+from metrics import metrics
+
+DEFAULT_DURATION = 30.0  # seconds
+MAX_DURATION = 600.0
+DEFAULT_INTERVAL = 0.01  # seconds between samples of the stacks
+MIN_INTERVAL = 0.001
+SAMPLER_TIME_PREFIX = "sampler_time."
+SAMPLER_REQUESTS_PREFIX = "sampler_requests."
+
+_thread_number = re.compile(r"[-_ ]?\d+$")
+
+
+def thread_group(name):
+    """return the name of a thread without any trailing number, eg "Thread" for "Thread-12" """
+    return (_thread_number.sub("", name) or name).replace(";", ":")
+
+
+def get_sampler_times():
+    """return a dict of sampler name -> (calls, requests, total seconds) of the calls to the sampler so far"""
+    snapshot = metrics.snapshot()
+    times = {}
+    for name, histogram in snapshot["histograms"].items():
+        if name.startswith(SAMPLER_TIME_PREFIX):
+            sampler_name = name[len(SAMPLER_TIME_PREFIX):]
+            requests = snapshot["counters"].get(SAMPLER_REQUESTS_PREFIX + sampler_name, 0)
+            times[sampler_name] = (histogram["count"], requests, histogram["sum"])
+    return times
+
+
+class Profiler(Thread):
+    """A Profiler samples the stacks of the threads for a given duration, or until stopped"""
+
+    def __init__(self, duration=DEFAULT_DURATION, interval=DEFAULT_INTERVAL):
+        """Args:
+
+            duration (float): how long to profile for (seconds), at most MAX_DURATION
+            interval (float): the time between samples of the stacks (seconds), at least MIN_INTERVAL
+
+        Raises ValueError if the duration or interval is out of range
+        """
+        super(Profiler, self).__init__(name="profiler")
+        if not 0 < duration <= MAX_DURATION:
+            raise ValueError("duration must be between 0 and {0} seconds".format(MAX_DURATION))
+        if interval < MIN_INTERVAL:
+            raise ValueError("interval must be at least {0} seconds".format(MIN_INTERVAL))
+        self.daemon = True
+        self.duration = duration
+        self.interval = interval
+        self._stop_requested = Event()
+        self._lock = Lock()
+        self._counts = {}  # collapsed stack -> the number of times it was seen
+        self._labels = {}  # code object -> its frame label
+        self._samples = 0
+        self._start_time = None
+        self._stop_time = None
+        self._start_sampler_times = None
+        self._sampler_times = None
+
+    def run(self):
+        self._start_sampler_times = get_sampler_times()
+        self._start_time = monotonic()
+        end_time = self._start_time + self.duration
+        next_time = self._start_time
+        while not self._stop_requested.is_set():
+            self._sample()
+            now = monotonic()
+            if now >= end_time:
+                break
+            # keep to the interval, but don't try to catch up if sampling was slow
+            next_time = max(next_time + self.interval, now)
+            self._stop_requested.wait(min(next_time, end_time) - now)
+        self._stop_time = monotonic()
+        self._sampler_times = get_sampler_times()
+
+    def stop(self):
+        """stop profiling, waiting for the profiler to finish"""
+        self._stop_requested.set()
+        self.join()
+
+    def _sample(self):
+        names = dict((thread.ident, thread_group(thread.name)) for thread in threading.enumerate())
+        frames = sys._current_frames()
+        own_ident = self.ident
+        stacks = []
+        for ident, frame in frames.items():
+            if ident == own_ident:
+                continue
+            labels = []
+            while frame is not None:
+                labels.append(self._label(frame.f_code))
+                frame = frame.f_back
+            labels.append(names.get(ident, "unknown"))
+            labels.reverse()
+            stacks.append(";".join(labels))
+        # drop the references to the frames promptly, so the profiled threads' objects can be freed
+        del frames
+        with self._lock:
+            for stack in stacks:
+                self._counts[stack] = self._counts.get(stack, 0) + 1
+            self._samples += 1
+
+    def _label(self, code):
+        label = self._labels.get(code)
+        if label is None:
+            # ";" separates the frames
+            label = "{0} ({1}:{2})".format(code.co_name, os.path.basename(code.co_filename), code.co_firstlineno)
+            label = self._labels[code] = label.replace(";", ":")
+        return label
+
+    def get_collapsed(self):
+        """return the collapsed stacks seen so far, one "frame;frame;... count" line per stack"""
+        with self._lock:
+            counts = sorted(self._counts.items())
+        return "".join("{0} {1}\n".format(stack, count) for stack, count in counts)
+
+    def get_summary(self, top=20):
+        """Return a dict of the state of the profile, the functions most often seen running (innermost in a
+        stack) by thread, and the time spent in each sampler during the profile.
+        """
+        with self._lock:
+            counts = dict(self._counts)
+            samples = self._samples
+        if self._start_time is None:
+            elapsed = 0.0
+        else:
+            elapsed = (self._stop_time or monotonic()) - self._start_time
+
+        by_function = {}
+        by_thread = {}
+        for stack, count in counts.items():
+            frames = stack.split(";")
+            by_function[(frames[0], frames[-1])] = by_function.get((frames[0], frames[-1]), 0) + count
+            by_thread[frames[0]] = by_thread.get(frames[0], 0) + count
+        top_functions = sorted(by_function.items(), key=lambda item: -item[1])[:top]
+
+        return {
+            "running": self.is_alive(),
+            "duration": self.duration,
+            "interval": self.interval,
+            "elapsed": elapsed,
+            "samples": samples,
+            "distinct_stacks": len(counts),
+            "threads": by_thread,
+            "top_functions": [{"thread": thread, "function": function, "count": count,
+                               "fraction": float(count) / samples if samples else 0.0}
+                              for (thread, function), count in top_functions],
+            "samplers": self._get_sampler_timing()
+        }
+
+    def _get_sampler_timing(self):
+        """return sampler name -> the calls, requests and time of the sampler during the profile"""
+        if self._start_sampler_times is None:
+            return {}
+        end_times = self._sampler_times or get_sampler_times()
+        timing = {}
+        for name, (calls, requests, total_time) in end_times.items():
+            start_calls, start_requests, start_time = self._start_sampler_times.get(name, (0, 0, 0.0))
+            calls -= start_calls
+            if calls:
+                timing[name] = {
+                    "calls": calls,
+                    "requests": requests - start_requests,
+                    "total_time": total_time - start_time,
+                    "mean_time": (total_time - start_time) / calls
+                }
+        return timing
@@ -0,0 +1,100 @@
+from threading import Lock
+
+class ItemExistsError(Exception):
+    pass
+
+class ItemRegistry:
+    """An ItemRegistry is the set of PollItems, indexed by name.
+
+    Mutations are serialised by a lock, and may add or delete many items at once (all or nothing).
+    Readers don't lock: snapshot() returns an immutable tuple of the items, which is rebuilt (once)
+    after the registry changes, so it is safe to iterate while items are added or deleted by another
+    thread (eg the Flask thread).
+    """
+
+    def __init__(self):
+        self._items = {}  # name -> PollItem
+        self._snapshot = ()
+        self._sorted = ((), ())
+        self._lock = Lock()
+        # incremented on every change, so readers can tell if the items have changed
+        self.version = 0
+
+    def __len__(self):
+        return len(self._items)
+
+    def __contains__(self, name):
+        return name in self._items
+
+    def get(self, name):
+        """return the PollItem with the given name
+
+        Raises KeyError if not found
+        """
+        try:
+            return self._items[name]
+        except KeyError:
+            raise KeyError("item not found: {0}".format(name))
+
+    def snapshot(self):
+        """return a tuple of all the PollItems"""
+        snapshot = self._snapshot
+        if snapshot is None:
+            with self._lock:
+                if self._snapshot is None:
+                    self._snapshot = tuple(self._items.values())
+                snapshot = self._snapshot
+        return snapshot
+
+    def sorted_snapshot(self):
+        """return (names, items): a tuple of the item names in sorted order and a tuple of the corresponding
+        PollItems. Like snapshot() it is only rebuilt after the registry changes.
+        """
+        sorted_items = self._sorted
+        if sorted_items is None:
+            version = self.version
+            items = sorted(self.snapshot(), key=lambda item: item.name)
+            sorted_items = (tuple(item.name for item in items), tuple(items))
+            with self._lock:
+                # don't keep it if the registry has changed in the meantime
+                if self._sorted is None and self.version == version:
+                    self._sorted = sorted_items
+        return sorted_items
+
+    def add_many(self, items):
+        """Add the given PollItems.
+
+        Raises ItemExistsError (and adds none of them) if any item name already exists
+        """
+        with self._lock:
+            names = set()
+            for item in items:
+                if item.name in self._items or item.name in names:
+                    raise ItemExistsError("item already exists: {0}".format(item.name))
+                names.add(item.name)
+            for item in items:
+                self._items[item.name] = item
+            self._changed()
+
+    def delete_many(self, names):
+        """Delete the items with the given names, returning the deleted PollItems.
+
+        Raises KeyError (and deletes none of them) if any item is not found
+        """
+        with self._lock:
+            for name in names:
+                if name not in self._items:
+                    raise KeyError("item not found: {0}".format(name))
+            items = [self._items.pop(name) for name in set(names)]
+            self._changed()
+        return items
+
+    def touch(self):
+        """mark the registry changed, after the settings of an item have been updated in place"""
+        with self._lock:
+            self._changed()
+
+    def _changed(self):
+        self._snapshot = None
+        self._sorted = None
+        self.version += 1
@@ -0,0 +1,154 @@
+"""Incremental rollups (aggregates) of the samples of each item, for long-term retention.
+
+For each configured window (eg 1 minute, 1 hour) the min, max, mean and count of each item's samples
+are accumulated as the samples are collected, and written to influx as a separate measurement when
+the window closes. Each item costs one small Accumulator per open window however many samples it
+has, and only the smallest window sees every sample: when a window closes its Accumulators are merged
+into the next larger window, so the windows must be multiples of each other.
+"""
+import logging
+from influx_writer import encode_line
+from metrics import metrics
+
+# a window is closed this long after its end (seconds), to allow for samples that are collected late
+DEFAULT_GRACE = 2.0
+DEFAULT_WINDOWS = [{"name": "1m", "seconds": 60}, {"name": "1h", "seconds": 3600}]
+
+
+class Accumulator(object):
+    """The count, min, max and sum of the samples of one item in one window"""
+    __slots__ = ("count", "min", "max", "sum")
+
+    def __init__(self, value):
+        self.count = 1
+        self.min = value
+        self.max = value
+        self.sum = value
+
+    def add(self, value):
+        self.count += 1
+        if value < self.min:
+            self.min = value
+        if value > self.max:
+            self.max = value
+        self.sum += value
+
+    def merge(self, other):
+        self.count += other.count
+        if other.min < self.min:
+            self.min = other.min
+        if other.max > self.max:
+            self.max = other.max
+        self.sum += other.sum
+
+    def fields(self, name):
+        """return the influx fields of the rollup of the named item"""
+        return [(name + ".min", self.min), (name + ".max", self.max),
+                (name + ".mean", self.sum / self.count), (name + ".count", self.count)]
+
+
+class RollupWindow:
+    """The open windows of one window size, each a dict of item name -> Accumulator"""
+
+    def __init__(self, name, seconds, measurement):
+        self.name = name
+        self.seconds = seconds
+        self.measurement = measurement
+        self.open = {}  # window start time -> {item name -> Accumulator}
+        # windows starting before this have been written, so late samples for them are dropped
+        self.closed_until = None
+
+    def window_start(self, timestamp):
+        return timestamp - timestamp % self.seconds
+
+    def add(self, name, timestamp, value):
+        """add a sample, returning False if its window has already closed"""
+        start = self.window_start(timestamp)
+        if self.closed_until is not None and start < self.closed_until:
+            return False
+        accumulators = self.open.get(start)
+        if accumulators is None:
+            accumulators = self.open[start] = {}
+        accumulator = accumulators.get(name)
+        if accumulator is None:
+            accumulators[name] = Accumulator(value)
+        else:
+            accumulator.add(value)
+        return True
+
+    def merge(self, start, accumulators):
+        """Merge the Accumulators of a closed smaller window starting at the given time.
+
+        The Accumulators are taken over (so they must not be used by the smaller window again).
+        """
+        start = self.window_start(start)
+        if self.closed_until is not None and start < self.closed_until:
+            return
+        window = self.open.setdefault(start, {})
+        for name, accumulator in accumulators.items():
+            existing = window.get(name)
+            if existing is None:
+                window[name] = accumulator
+            else:
+                existing.merge(accumulator)
+
+    def close(self, now, grace):
+        """remove and return the windows that ended more than grace seconds ago, a list of (start, accumulators)"""
+        closed = []
+        for start in sorted(self.open):
+            if start + self.seconds + grace > now:
+                break
+            closed.append((start, self.open.pop(start)))
+            self.closed_until = start + self.seconds
+        return closed
+
+
+class Rollups:
+    """Rollups maintains the rollups of all the items for each of the configured windows"""
+
+    def __init__(self, measurement, windows=None, grace=DEFAULT_GRACE):
+        """Args:
+
+            measurement (str): the measurement of the raw samples. The rollups of each window are written to
+                the measurement plus "_" plus the window name, eg "rpdemo_1m"
+            windows (list): optional, the windows as dicts of name and seconds, see DEFAULT_WINDOWS. Each
+                window must be a multiple of the next smaller one
+            grace (float): how long after its end a window is closed (seconds)
+
+        Raises ValueError if the windows are not multiples of each other
+        """
+        windows = sorted(windows or DEFAULT_WINDOWS, key=lambda window: window["seconds"])
+        for smaller, larger in zip(windows, windows[1:]):
+            if larger["seconds"] % smaller["seconds"]:
+                raise ValueError("rollup window {0} is not a multiple of {1}".format(larger["name"], smaller["name"]))
+        self._windows = [RollupWindow(w["name"], w["seconds"], "{0}_{1}".format(measurement, w["name"]))
+                         for w in windows]
+        self._grace = grace
+        self._late_samples = metrics.counter("rollup_samples_late")
+
+    def add(self, samples, now):
+        """Add the given Samples to the rollups, then close any windows that have ended by the given time.
+
+        Returns the influx lines of the rollups of the closed windows, one line per item per window.
+        """
+        smallest = self._windows[0]
+        for sample in samples:
+            try:
+                value = float(sample.value)
+            except (TypeError, ValueError):
+                continue
+            if not smallest.add(sample.name, sample.timestamp, value):
+                self._late_samples.inc()
+
+        lines = []
+        for i, window in enumerate(self._windows):
+            for start, accumulators in window.close(now, self._grace):
+                logging.debug("closed {0} rollup at {1} of {2} items".format(window.name, start, len(accumulators)))
+                timestamp_ms = int(start * 1000)
+                for name, accumulator in accumulators.items():
+                    line = encode_line(window.measurement, accumulator.fields(name), timestamp_ms)
+                    if line is not None:
+                        lines.append(line)
+                if i + 1 < len(self._windows):
+                    self._windows[i + 1].merge(start, accumulators)
+        return lines
@@ -1,17 +1,117 @@
-from net_sampler import NetSampler
-from sense_hat_sampler import SenseHatSampler
-from system_sampler import SystemSampler
-from wemo_sampler import WemoSampler
+import importlib
+import logging
+from threading import Lock
+from clock import monotonic
+from metrics import metrics
+
+# the standard samplers: key prefix -> "module:class". They are imported and created on first use
+BUILTIN_SAMPLERS = {
+    "exec": "exec_sampler:ExecSampler",
+    "net": "net_sampler:NetSampler",
+    "sensehat": "sense_hat_sampler:SenseHatSampler",
+    "system": "system_sampler:SystemSampler",
+    "wemo": "wemo_sampler:WemoSampler"
+}
+# Other samplers can be installed as setuptools entry points in this group, named by their key prefix, eg
+#   entry_points={"rpdemo.samplers": ["mqtt = rpdemo_mqtt:MqttSampler"]}
+ENTRY_POINT_GROUP = "rpdemo.samplers"
+# checks of the items of the standard samplers: key prefix -> "module:function", where function(subkey, arg) raises
+# ValueError if the item is invalid. They are imported when an item of the prefix is added, not the whole sampler
+ITEM_CHECKS = {
+    "exec": "exec_sampler:check_item"
+}
+
+
+def find_entry_points():
+    """return a dict of key prefix -> entry point of the samplers installed as entry points"""
+    try:
+        import pkg_resources
+    except ImportError:
+        return {}
+    return dict((entry_point.name, entry_point) for entry_point in pkg_resources.iter_entry_points(ENTRY_POINT_GROUP))
+
+
+def load_plugin(plugin):
+    """return the sampler factory (eg class) given a "module:class" string, an entry point or the factory itself"""
+    if isinstance(plugin, basestring):
+        module_name, class_name = plugin.split(":")
+        return getattr(importlib.import_module(module_name), class_name)
+    if hasattr(plugin, "load"):
+        return plugin.load()
+    return plugin
+
+
+def missing_sample(key, arg):
+    """return the error of a sample the sampler didn't return"""
+    return KeyError("no sample returned for {0} {1}".format(key, arg))
+
+
+def check_item(key, arg):
+    """raise ValueError if the key and arg aren't valid for the sampler of the key's prefix, see ITEM_CHECKS"""
+    sampler_name, _, subkey = key.partition(".")
+    check = ITEM_CHECKS.get(sampler_name)
+    if check is not None:
+        load_plugin(check)(subkey, arg)
+
 
 class Sampler:
+    """A Sampler gets samples from the sampler plugin for the prefix of each key, eg "net" for "net.ping".
+
+    A plugin is only imported and created the first time a sample of its prefix is needed, so the
+    samplers that aren't used (eg wemo, sensehat) cost nothing, and those that are don't hold up startup.
+    """
 
-    def __init__(self):
-        self.samplers = {
-            "net": NetSampler(),
-            "sensehat": SenseHatSampler(),
-            "system": SystemSampler(),
-            "wemo": WemoSampler()
-        }
+    def __init__(self, plugins=None):
+        """Args:
+
+            plugins (dict): optional, key prefix -> the sampler plugin, a "module:class" string or a factory
+                function (or class). By default the BUILTIN_SAMPLERS and any installed entry points
+        """
+        self._plugins = plugins
+        self._entry_points = None
+        # the samplers created so far, key prefix -> sampler
+        self.samplers = {}
+        # sampler name -> the Exception if the sampler failed to load
+        self._failed = {}
+        self._lock = Lock()
+
+    def _find_plugin(self, sampler_name):
+        if self._plugins is not None:
+            return self._plugins.get(sampler_name)
+        plugin = BUILTIN_SAMPLERS.get(sampler_name)
+        if plugin is None:
+            # entry points are only looked for if needed, as finding them is slow
+            if self._entry_points is None:
+                self._entry_points = find_entry_points()
+            plugin = self._entry_points.get(sampler_name)
+        return plugin
+
+    def get_sampler(self, sampler_name):
+        """Return the sampler for the given key prefix, loading it if necessary.
+
+        Raises ValueError if there is no such sampler, or it failed to load
+        """
+        sampler = self.samplers.get(sampler_name)
+        if sampler is not None:
+            return sampler
+
+        with self._lock:
+            sampler = self.samplers.get(sampler_name)
+            if sampler is None:
+                if sampler_name in self._failed:
+                    raise ValueError("sampler {0} failed to load: {1}".format(sampler_name, self._failed[sampler_name]))
+                plugin = self._find_plugin(sampler_name)
+                if plugin is None:
+                    raise ValueError("unknown sampler: {0}".format(sampler_name))
+                logging.info("loading sampler {0}".format(sampler_name))
+                try:
+                    sampler = load_plugin(plugin)()
+                except Exception as e:
+                    logging.exception("sampler {0} failed to load: {1}".format(sampler_name, e))
+                    self._failed[sampler_name] = e
+                    raise ValueError("sampler {0} failed to load: {1}".format(sampler_name, e))
+                self.samplers[sampler_name] = sampler
+        return sampler
 
     def get_sample(self, key, arg):
         """
@@ -19,16 +119,155 @@ class Sampler:
            |-----------------------|------------------------|
            | key                   | arg                    |
            |-----------------------+------------------------|
+           | exec.<name>           | <command>[|<param>]    |
            | net.ping              | google.com.au          |
            | sensehat.temperature  |                        |
+           | sensehat.temperature  | burst:16               |
+           | sensehat.temperature  | continuous:10          |
            | sensehat.humidity     |                        |
            | sensehat.pressure     |                        |
            | system.loadavg1       |                        |
            | system.loadavg5       |                        |
            | system.loadavg15      |                        |
+           | system.cpu            | cpu0 (default all)     |
+           | system.mem_used       |                        |
+           | system.net_rx_bytes   | eth0                   |
+           | system.disk_busy      | mmcblk0                |
            | wemo.power            | switch1                |
            | wemo.state            | switch1                |
            |-----------------------|------------------------|
         """
-        sampler_name, subkey = key.split(".")
-        return self.samplers[sampler_name].get_sample(subkey, arg)
+        sampler_name, _, subkey = key.partition(".")
+        sampler = self.get_sampler(sampler_name)
+        start_time = monotonic()
+        try:
+            return sampler.get_sample(subkey, arg)
+        finally:
+            self._record_time(sampler_name, start_time, 1)
+
+    def supports_batch(self, key):
+        """Return True if the sampler for the given key can get a batch of samples more efficiently than one by one.
+
+        This doesn't load the sampler (it is called from the polling loop). Until the sampler has been loaded
+        it is True, so the items due before then are sampled in one batch (see get_samples) which loads the
+        sampler, rather than each loading it in turn.
+        """
+        sampler_name, _, subkey = key.partition(".")
+        sampler = self.samplers.get(sampler_name)
+        if sampler is None:
+            return sampler_name not in self._failed
+        if hasattr(sampler, "supports_batch"):
+            return sampler.supports_batch(subkey)
+        return hasattr(sampler, "get_samples")
+
+    def get_samples(self, requests):
+        """
+        return samples for a batch of (key, arg) requests, as a dict of (key, arg) -> value.
+        If a sample fails its value is the Exception instead.
+
+        Identical requests are only sampled once. The requests are grouped by sampler, and samplers
+        that implement get_samples(requests) are given their whole group at once so they can satisfy
+        it with one underlying read.
+        """
+        groups = {}
+        for key, arg in set(requests):
+            sampler_name, _, subkey = key.partition(".")
+            groups.setdefault(sampler_name, []).append((subkey, arg))
+
+        results = {}
+        for sampler_name, subrequests in groups.items():
+            try:
+                sampler = self.get_sampler(sampler_name)
+                start_time = monotonic()
+                try:
+                    subresults = self._get_sampler_samples(sampler, subrequests)
+                finally:
+                    self._record_time(sampler_name, start_time, len(subrequests))
+            except Exception as e:
+                subresults = dict.fromkeys(subrequests, e)
+
+            for (subkey, arg), value in subresults.items():
+                results[(sampler_name + "." + subkey, arg)] = value
+        return results
+
+    def get_item_samples(self, requests):
+        """
+        return samples for a batch of (name, key, arg) requests from items, as a dict of name -> value.
+        If a sample fails its value is the Exception instead.
+
+        Samplers that keep state for each item (eg the previous counter, for a rate) implement
+        get_item_samples(requests) and are given their group of (name, subkey, arg) requests. The others are
+        sampled as by get_samples, so items with the same key and arg share a sample.
+        """
+        groups = {}
+        for name, key, arg in requests:
+            sampler_name, _, subkey = key.partition(".")
+            groups.setdefault(sampler_name, []).append((name, subkey, arg))
+
+        results = {}
+        for sampler_name, subrequests in groups.items():
+            try:
+                sampler = self.get_sampler(sampler_name)
+                start_time = monotonic()
+                num_requests = len(subrequests)
+                try:
+                    if hasattr(sampler, "get_item_samples"):
+                        item_results = sampler.get_item_samples(subrequests)
+                        for name, subkey, arg in subrequests:
+                            results[name] = item_results[name] if name in item_results else missing_sample(
+                                sampler_name + "." + subkey, arg)
+                        continue
+                    unique_requests = list(set((subkey, arg) for _, subkey, arg in subrequests))
+                    num_requests = len(unique_requests)
+                    subresults = self._get_sampler_samples(sampler, unique_requests)
+                finally:
+                    self._record_time(sampler_name, start_time, num_requests)
+            except Exception as e:
+                subresults = dict(((subkey, arg), e) for _, subkey, arg in subrequests)
+
+            # a sampler may return only some of the samples, in which case only the missing items fail
+            for name, subkey, arg in subrequests:
+                results[name] = subresults[(subkey, arg)] if (subkey, arg) in subresults else missing_sample(
+                    sampler_name + "." + subkey, arg)
+        return results
+
+    def forget_items(self, names):
+        """discard any state the samplers keep for the items with the given names, which have been deleted"""
+        for sampler in self.samplers.values():
+            if hasattr(sampler, "forget_items"):
+                sampler.forget_items(names)
+
+    def _record_time(self, sampler_name, start_time, num_requests):
+        """record the time taken by a call to a sampler (for num_requests samples) since start_time"""
+        metrics.histogram("sampler_time." + sampler_name).observe(monotonic() - start_time)
+        metrics.counter("sampler_requests." + sampler_name).inc(num_requests)
+
+    def _get_sampler_samples(self, sampler, requests):
+        """return samples from the given sampler for a batch of (subkey, arg) requests"""
+        if hasattr(sampler, "get_samples"):
+            return sampler.get_samples(requests)
+        results = {}
+        for subkey, arg in requests:
+            try:
+                results[(subkey, arg)] = sampler.get_sample(subkey, arg)
+            except Exception as e:
+                results[(subkey, arg)] = e
+        return results
+
+    def supports_async(self, key):
+        """return True if samples for the given key can be got without blocking, using get_sample_async.
+        This is False until the sampler has been loaded (by a batch, see supports_batch).
+        """
+        sampler_name, _, subkey = key.partition(".")
+        sampler = self.samplers.get(sampler_name)
+        return hasattr(sampler, "supports_async") and sampler.supports_async(subkey)
+
+    def get_sample_async(self, key, arg, callback):
+        """
+        start getting a sample for the given key and (optional) arg, without blocking.
+        callback(value, error) is called when the sample is complete, usually from another thread,
+        where error is an Exception if the sample failed.
+        Only available for keys where supports_async(key) returns True.
+        """
+        sampler_name, _, subkey = key.partition(".")
+        self.get_sampler(sampler_name).get_sample_async(subkey, arg, callback)
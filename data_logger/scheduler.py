@@ -0,0 +1,75 @@
+import heapq
+import itertools
+from clock import monotonic
+from threading import Condition
+
+class Scheduler:
+    """A Scheduler orders PollItems by their next_poll_time (a monotonic clock deadline).
+
+    It is a min-heap, so finding and removing the next due item costs O(log n) regardless of
+    how many items are scheduled. Items may be added from any thread; the polling loop
+    blocks in wait() until the next item is due.
+    """
+
+    def __init__(self):
+        self._heap = []
+        # tie breaker for items with identical deadlines, so the items themselves are never compared
+        self._counter = itertools.count()
+        self._condition = Condition()
+
+    def __len__(self):
+        return len(self._heap)
+
+    def add(self, item):
+        """Schedule the item at its next_poll_time, waking the polling loop in case it is now due sooner."""
+        with self._condition:
+            heapq.heappush(self._heap, (item.next_poll_time, next(self._counter), item))
+            self._condition.notify()
+
+    def add_many(self, items):
+        """Schedule many items at their next_poll_time, waking the polling loop once."""
+        with self._condition:
+            entries = [(item.next_poll_time, next(self._counter), item) for item in items]
+            if len(entries) > len(self._heap):
+                # cheaper to rebuild the heap, O(n), than to push each item, O(k log n)
+                self._heap.extend(entries)
+                heapq.heapify(self._heap)
+            else:
+                for entry in entries:
+                    heapq.heappush(self._heap, entry)
+            self._condition.notify()
+
+    def reschedule(self, items):
+        """Schedule the given items at their next_poll_time, without waking the polling loop.
+
+        This is used by the polling loop itself after dispatching items.
+        """
+        with self._condition:
+            for item in items:
+                heapq.heappush(self._heap, (item.next_poll_time, next(self._counter), item))
+
+    def pop_due(self, now):
+        """remove and return the list of items due at or before the given monotonic time"""
+        items_due = []
+        with self._condition:
+            while self._heap and self._heap[0][0] <= now:
+                items_due.append(heapq.heappop(self._heap)[2])
+        return items_due
+
+    def next_deadline(self):
+        """return the monotonic time the next item is due, or None if nothing is scheduled"""
+        with self._condition:
+            return self._heap[0][0] if self._heap else None
+
+    def wait(self, until):
+        """Block until the next item is due, or until the given monotonic time if that is sooner.
+
+        Returns early if an item is added in the meantime.
+        """
+        with self._condition:
+            deadline = until
+            if self._heap and self._heap[0][0] < deadline:
+                deadline = self._heap[0][0]
+            timeout = deadline - monotonic()
+            if timeout > 0:
+                self._condition.wait(timeout)
@@ -1,21 +1,64 @@
 import logging
+import math
+import random
+import time
+from threading import Lock
+from oversampling import BurstReader, ContinuousReader, parse_oversampling
+
+class SimulatedSenseHat:
+    """A stand-in for the SenseHat with noisy readings around slowly drifting values, for testing without the
+    hardware, eg SenseHatSampler(SimulatedSenseHat())
+    """
+
+    def __init__(self, noise=0.5, period=600.0):
+        self.noise = noise
+        self.period = period
+
+    def _drift(self):
+        return math.sin(2 * math.pi * time.time() / self.period)
+
+    def get_temperature(self):
+        return 25.0 + 2.0 * self._drift() + random.gauss(0, self.noise)
+
+    def get_humidity(self):
+        return 50.0 - 5.0 * self._drift() + random.gauss(0, self.noise * 4)
+
+    def get_pressure(self):
+        return 1013.0 + self._drift() + random.gauss(0, self.noise)
+
 
 class SenseHatSampler:
+    """Returns samples from the SenseHat sensors.
 
-    def __init__(self):
+    The readings are noisy, so an item can be oversampled by giving it an arg of "burst:<n>" (take n readings
+    each poll) or "continuous:<n>" (take n readings per second in the background), see oversampling.py. Its
+    samples are then the mean of the readings, with their stddev, min and max.
+    """
+
+    def __init__(self, sense=None):
+        """Args:
+
+            sense: optional, the sensors eg SimulatedSenseHat. By default the SenseHat
+        """
         # this only works if the raspberry pi sense_hat package is installed
-        self.sense = None
-        try:
-            from sense_hat import SenseHat
-            self.sense = SenseHat()
-
-            self.sample_funcs = {
-                "temperature": lambda: float(self.sense.get_temperature()),
-                "humidity": lambda: float(self.sense.get_humidity()),
-                "pressure": lambda: float(self.sense.get_pressure())
-            }
-        except ImportError:
-            logging.info("sense_hat package not found")
+        self.sense = sense
+        if self.sense is None:
+            try:
+                from sense_hat import SenseHat
+                self.sense = SenseHat()
+            except ImportError:
+                logging.info("sense_hat package not found")
+
+        self.sample_funcs = {
+            "temperature": lambda: float(self.sense.get_temperature()),
+            "humidity": lambda: float(self.sense.get_humidity()),
+            "pressure": lambda: float(self.sense.get_pressure())
+        }
+        # the sensors are read by the polling threads and the continuous readers, one at a time
+        self._sense_lock = Lock()
+        # (key, oversampling) -> BurstReader or ContinuousReader
+        self._readers = {}
+        self._readers_lock = Lock()
 
     def available(self):
         return self.sense is not None
@@ -24,8 +67,28 @@ class SenseHatSampler:
         if self.sense is None:
             raise ValueError("sense_hat is not available")
 
-        try:
-            func = self.sample_funcs[key]
-            return func()
-        except KeyError:
+        if key not in self.sample_funcs:
             raise ValueError("unknown key: {0}".format(key))
+        oversampling = parse_oversampling(arg)
+        if oversampling is None:
+            return self._read(key)
+        return self._get_reader(key, oversampling).get_sample()
+
+    def _read(self, key):
+        with self._sense_lock:
+            return self.sample_funcs[key]()
+
+    def _get_reader(self, key, oversampling):
+        with self._readers_lock:
+            reader = self._readers.get((key, oversampling))
+            # a continuous reader stops when its item isn't polled for a while, so may need restarting
+            if reader is None or (isinstance(reader, ContinuousReader) and not reader.is_alive()):
+                read = lambda: self._read(key)
+                mode, n = oversampling
+                if mode == "burst":
+                    reader = BurstReader(read, n)
+                else:
+                    reader = ContinuousReader(read, n, name="sensehat {0} reader".format(key))
+                    reader.start()
+                self._readers[(key, oversampling)] = reader
+        return reader
@@ -0,0 +1,450 @@
+"""Sharded polling, so that polling can use all the CPU cores rather than one (because of the GIL).
+
+The items are divided between several shards, each a worker process running its own Poller (and
+Sampler) over its share of the items. The shard of an item is chosen by a stable hash of its name.
+
+The coordinator (the ShardedPoller, in the main process) keeps the item registry and the history, so
+the REST API and the influx writer work as usual. It routes item additions and deletions to the
+owning shard over a pipe, and the shards return their samples through a SampleRing in shared memory,
+so samples are not pickled.
+
+The shard processes are forked by a spawner process, itself forked by the coordinator before any other
+threads are started. So a shard started while the coordinator's threads are running (to replace one that
+died) doesn't inherit a lock held by one of them, eg of a logging handler, and hang.
+"""
+import logging
+import mmap
+import os
+import struct
+import time
+import zlib
+from itertools import count
+from multiprocessing import Process, Pipe
+from _multiprocessing import Connection, sendfd, recvfd
+from threading import Thread, Lock
+from clock import monotonic
+from metrics import metrics
+from oversampling import Oversample
+from poller import Poller, Sample, RESULT_INTERVAL, ENGINE_THREADS, ENGINE_ASYNC
+
+# the number of samples a SampleRing can hold, must be a power of 2
+DEFAULT_RING_CAPACITY = 65536
+# how often a shard checks that the coordinator is still alive (seconds)
+ORPHAN_CHECK_INTERVAL = 1.0
+
+# the type of a sample value in a SampleRing, so the coordinator gets back the type the sampler returned
+VALUE_FLOAT = 0
+VALUE_INT = 1
+VALUE_BOOL = 2
+VALUE_OVERSAMPLE = 3  # a float with the stddev, min, max and count of its readings, see oversampling.py
+
+
+def shard_of(name, num_shards):
+    """return the index of the shard that polls the item with the given name"""
+    return (zlib.crc32(name.encode("utf-8")) & 0xffffffff) % num_shards
+
+
+class SampleRing:
+    """A SampleRing is a fixed size ring buffer of samples in shared memory, written by a shard process
+    and read by the coordinator.
+
+    There is one producer and one consumer so no lock is needed: the producer only advances the write
+    count and the consumer only advances the read count, each an aligned 32 bit word. A record is
+    written before the write count is advanced, so the consumer never sees a partial record. If the
+    ring is full new samples are dropped, and counted.
+    """
+    # write count, read count, dropped count
+    _header = struct.Struct("<III")
+    # timestamp, value, item id, value type, then the stddev, min, max and count of an oversampled value
+    _record = struct.Struct("<ddIB3xdddI4x")
+
+    def __init__(self, capacity=DEFAULT_RING_CAPACITY):
+        """Args:
+
+            capacity (int): the number of samples the ring can hold, a power of 2
+
+        Raises ValueError if the capacity is not a power of 2
+        """
+        if capacity <= 0 or capacity & (capacity - 1):
+            raise ValueError("ring capacity must be a power of 2: {0}".format(capacity))
+        self.capacity = capacity
+        # an anonymous mapping is shared with the processes forked after it is created
+        self._buffer = mmap.mmap(-1, self._header.size + capacity * self._record.size)
+
+    def _offset(self, n):
+        return self._header.size + (n % self.capacity) * self._record.size
+
+    def put(self, item_id, timestamp, value):
+        """add a sample (in the producer), returning False if it was dropped because the ring is full"""
+        write_count, read_count, dropped = self._header.unpack_from(self._buffer, 0)
+        if (write_count - read_count) & 0xffffffff >= self.capacity:
+            struct.pack_into("<I", self._buffer, 8, (dropped + 1) & 0xffffffff)
+            return False
+
+        stddev = minimum = maximum = 0.0
+        readings = 0
+        if isinstance(value, bool):
+            value_type = VALUE_BOOL
+        elif isinstance(value, (int, long)):
+            value_type = VALUE_INT
+        elif isinstance(value, Oversample):
+            value_type = VALUE_OVERSAMPLE
+            stddev, minimum, maximum, readings = value.stddev, value.min, value.max, value.count
+        else:
+            value_type = VALUE_FLOAT
+        self._record.pack_into(self._buffer, self._offset(write_count), timestamp, value, item_id, value_type,
+                               stddev, minimum, maximum, readings)
+        struct.pack_into("<I", self._buffer, 0, (write_count + 1) & 0xffffffff)
+        return True
+
+    def get_all(self):
+        """remove and return all the samples in the ring (in the consumer), a list of (item id, timestamp, value)"""
+        write_count, read_count, _ = self._header.unpack_from(self._buffer, 0)
+        samples = []
+        while read_count != write_count:
+            (timestamp, value, item_id, value_type,
+             stddev, minimum, maximum, readings) = self._record.unpack_from(self._buffer, self._offset(read_count))
+            if value_type == VALUE_INT:
+                value = int(value)
+            elif value_type == VALUE_BOOL:
+                value = bool(value)
+            elif value_type == VALUE_OVERSAMPLE:
+                value = Oversample(value, stddev, minimum, maximum, readings)
+            samples.append((item_id, timestamp, value))
+            read_count = (read_count + 1) & 0xffffffff
+        struct.pack_into("<I", self._buffer, 4, read_count)
+        return samples
+
+    def get_stats(self):
+        """return a dict of the capacity, the number of samples waiting and the number dropped"""
+        write_count, read_count, dropped = self._header.unpack_from(self._buffer, 0)
+        return {
+            "capacity": self.capacity,
+            "size": (write_count - read_count) & 0xffffffff,
+            "dropped": dropped
+        }
+
+
+def run_shard(index, conn, spawner_conn, ring, sampler):
+    """The main function of a shard process, forked by the spawner (see run_spawner).
+
+    Receives commands from the coordinator: ("add", items config), ("delete", names) and
+    ("run", (num_polling_threads, engine, pools_config)), which starts polling. The samples of the
+    items are put in the ring. Returns when the coordinator (or the spawner) goes away.
+    """
+    # the spawner's end of its pipe isn't used by the shard
+    spawner_conn.close()
+    spawner_pid = os.getppid()
+
+    poller = Poller(sampler)
+    # the coordinator keeps the history
+    poller.set_history_depth(0)
+    item_ids = {}  # item name -> item id, as assigned by the coordinator
+    non_numeric = set()  # the names of the items whose non-numeric samples have been dropped
+
+    def put_samples(samples):
+        for sample in samples:
+            item_id = item_ids.get(sample.name)
+            if item_id is None:
+                continue
+            if not isinstance(sample.value, (int, long, float)):
+                # the ring only holds numbers. Warn once per item, rather than for every sample
+                if sample.name not in non_numeric:
+                    non_numeric.add(sample.name)
+                    logging.warn("shard {0}: {1} has non-numeric samples (eg {2!r}), which are dropped when "
+                                 "sharded".format(index, sample.name, sample.value))
+                continue
+            ring.put(item_id, sample.timestamp, sample.value)
+
+    while True:
+        try:
+            if not conn.poll(ORPHAN_CHECK_INTERVAL):
+                # the spawner exits when the coordinator does
+                if os.getppid() != spawner_pid:
+                    return
+                continue
+            command, arg = conn.recv()
+        except (EOFError, IOError, KeyboardInterrupt):
+            return
+
+        try:
+            if command == "add":
+                for item_config in arg:
+                    item_ids[item_config["name"]] = item_config["id"]
+                poller.add_items(arg)
+            elif command == "delete":
+                poller.delete_items(arg)
+                for name in arg:
+                    item_ids.pop(name, None)
+                    non_numeric.discard(name)
+            elif command == "run":
+                num_polling_threads, engine, pools_config = arg
+                thread = Thread(target=poller.run, name="poller",
+                                args=(num_polling_threads, put_samples, engine, pools_config))
+                thread.daemon = True
+                thread.start()
+            else:
+                logging.error("shard {0}: unknown command: {1}".format(index, command))
+        except Exception as e:
+            logging.exception("shard {0}: {1} failed: {2}".format(index, command, e))
+
+
+def run_spawner(conn, coordinator_conn, rings, sampler):
+    """The main function of the spawner process, which forks the shard processes.
+
+    Receives the index of a shard to start, followed by the shard's end of its pipe to the coordinator
+    (as a file descriptor), forks the shard and replies with its pid. Returns when the coordinator goes away.
+    """
+    # the coordinator's end of the pipe is closed here, so the pipe closes when the coordinator exits
+    coordinator_conn.close()
+    while True:
+        # reap the shards that have died, so the coordinator sees they are no longer alive
+        try:
+            while os.waitpid(-1, os.WNOHANG)[0]:
+                pass
+        except OSError:
+            # no shards
+            pass
+        try:
+            if not conn.poll(ORPHAN_CHECK_INTERVAL):
+                continue
+            index = conn.recv()
+            shard_conn = Connection(recvfd(conn.fileno()))
+        except (EOFError, IOError, KeyboardInterrupt):
+            return
+
+        pid = os.fork()
+        if pid == 0:
+            try:
+                run_shard(index, shard_conn, conn, rings[index], sampler)
+            except Exception as e:
+                logging.exception("shard {0} failed: {1}".format(index, e))
+            finally:
+                os._exit(0)
+        # the shard has its own copy, and the shards forked later mustn't inherit it
+        shard_conn.close()
+        conn.send(pid)
+
+
+class Spawner:
+    """The spawner process, as seen from the coordinator, see run_spawner"""
+
+    def __init__(self, rings, sampler):
+        """Args:
+
+            rings (list): the SampleRing of each shard, by index
+            sampler (Sampler): the sampler used by the shards
+        """
+        conn, spawner_conn = Pipe()
+        self._process = Process(target=run_spawner, name="shard spawner", args=(spawner_conn, conn, rings, sampler))
+        self._process.daemon = True
+        self._process.start()
+        spawner_conn.close()
+        self._conn = conn
+        self._lock = Lock()
+
+    def spawn(self, index, shard_conn):
+        """Start a shard process with the given end of its pipe, returning its pid.
+
+        Raises IOError if the spawner has died
+        """
+        with self._lock:
+            try:
+                self._conn.send(index)
+                sendfd(self._conn.fileno(), shard_conn.fileno())
+                return self._conn.recv()
+            except (EOFError, IOError, OSError) as e:
+                raise IOError("shard spawner failed: {0}".format(e))
+
+
+class Shard:
+    """A Shard is a worker process polling a share of the items, as seen from the coordinator"""
+
+    def __init__(self, index, ring_capacity):
+        self.index = index
+        self.ring = SampleRing(ring_capacity)
+        self.restarts = 0
+        self.pid = None
+        self._conn = None
+
+    def start(self, spawner):
+        """start the shard process, forked by the spawner. Raises IOError if the spawner has died"""
+        conn, shard_conn = Pipe()
+        try:
+            self.pid = spawner.spawn(self.index, shard_conn)
+        except IOError:
+            conn.close()
+            raise
+        finally:
+            shard_conn.close()
+        self._conn = conn
+
+    def is_alive(self):
+        """return True if the shard process is running. A shard that has died is reaped by the spawner"""
+        if self.pid is None:
+            return False
+        try:
+            os.kill(self.pid, 0)
+        except OSError:
+            return False
+        return True
+
+    def send(self, command, arg):
+        """send a command to the shard process. If the process has died the command is lost (see restart)."""
+        try:
+            self._conn.send((command, arg))
+        except (IOError, OSError) as e:
+            logging.error("shard {0}: failed to send {1}: {2}".format(self.index, command, e))
+
+    def restart(self, spawner):
+        """start a new shard process to replace the dead one. Raises IOError if the spawner has died"""
+        self._conn.close()
+        self.restarts += 1
+        self.pid = None
+        self.start(spawner)
+
+    def get_stats(self):
+        stats = self.ring.get_stats()
+        stats["pid"] = self.pid
+        stats["alive"] = self.is_alive()
+        stats["restarts"] = self.restarts
+        return stats
+
+
+class ShardedPoller(Poller):
+    """A ShardedPoller is a Poller whose items are polled by several shard processes.
+
+    It is a drop-in replacement for the Poller: the items, their history and the results callback
+    are all in this (the coordinator) process. The spawner process, which forks the shard processes, is
+    started by the constructor, so it should be created before any other threads are started.
+    """
+
+    def __init__(self, num_shards, sampler=None, ring_capacity=DEFAULT_RING_CAPACITY):
+        """Args:
+
+            num_shards (int): the number of shard processes, eg the number of CPU cores
+            sampler (Sampler): optional, the sampler used by the shards, as for Poller
+            ring_capacity (int): the number of samples each shard can return per RESULT_INTERVAL
+        """
+        if num_shards < 1:
+            raise ValueError("there must be at least 1 shard: {0}".format(num_shards))
+        Poller.__init__(self, sampler)
+        self._shards = [Shard(i, ring_capacity) for i in range(num_shards)]
+        self._item_ids = {}  # item name -> item id
+        self._items_by_id = {}  # item id -> PollItem
+        self._next_item_id = count()
+        self._run_args = None
+        # serialises the commands sent to the shards
+        self._lock = Lock()
+
+        # the rings are created first, so they are shared with the spawner and the shards it forks
+        self._spawner = Spawner([shard.ring for shard in self._shards], sampler)
+        for shard in self._shards:
+            shard.start(self._spawner)
+
+        metrics.gauge("shard_samples_dropped", lambda: sum(s.ring.get_stats()["dropped"] for s in self._shards))
+        metrics.gauge("shard_restarts", lambda: sum(s.restarts for s in self._shards))
+
+    def _items_added(self, items):
+        """send the given (newly added) PollItems to their shards"""
+        with self._lock:
+            commands = {}  # shard index -> items config
+            for item in items:
+                item_id = next(self._next_item_id) & 0xffffffff
+                self._item_ids[item.name] = item_id
+                self._items_by_id[item_id] = item
+                commands.setdefault(shard_of(item.name, len(self._shards)), []).append(self._item_config(item, item_id))
+            for index, items_config in commands.items():
+                self._shards[index].send("add", items_config)
+
+    def _items_deleted(self, items):
+        """delete the given PollItems from their shards"""
+        with self._lock:
+            commands = {}  # shard index -> names
+            for item in items:
+                item.deleted = True
+                self._items_by_id.pop(self._item_ids.pop(item.name), None)
+                commands.setdefault(shard_of(item.name, len(self._shards)), []).append(item.name)
+            for index, names in commands.items():
+                self._shards[index].send("delete", names)
+
+    def _item_config(self, item, item_id):
+        # the shard only polls the item, deadband filtering is done here
+        return {"id": item_id, "name": item.name, "key": item.key, "arg": item.arg, "interval": item.interval,
+                "max_backoff": item.max_backoff}
+
+    def get_pool_stats(self):
+        """return a dict of shard name -> shard statistics (the WorkerPools are in the shard processes)"""
+        return dict(("shard {0}".format(shard.index), shard.get_stats()) for shard in self._shards)
+
+    def run(self, num_polling_threads, results_callback, engine=ENGINE_THREADS, pools_config=None):
+        """Start the shards polling, then collect their samples every RESULT_INTERVAL seconds and provide
+        them via results_callback(samples), as for Poller.run. A shard process that dies is restarted.
+
+        This method does not return.
+        """
+        if self._running:
+            raise Exception("Poller already running")
+        if engine not in (ENGINE_THREADS, ENGINE_ASYNC):
+            raise ValueError("unknown polling engine: {0}".format(engine))
+
+        self._running = True
+        with self._lock:
+            self._run_args = (num_polling_threads, engine, pools_config or {})
+            for shard in self._shards:
+                shard.send("run", self._run_args)
+
+        next_result_time = monotonic() + RESULT_INTERVAL
+        while True:
+            timeout = next_result_time - monotonic()
+            if timeout > 0:
+                time.sleep(timeout)
+
+            for shard in self._shards:
+                if not shard.is_alive():
+                    self._restart_shard(shard)
+
+            samples = self._filter_reports(self._collect_poll_results())
+            results_callback(samples)
+
+            next_result_time += RESULT_INTERVAL
+            now = monotonic()
+            if next_result_time <= now:
+                logging.warn("result processing overran the result interval {0} by {1} seconds".format(
+                    RESULT_INTERVAL, now - next_result_time + RESULT_INTERVAL))
+                next_result_time = now + RESULT_INTERVAL
+
+    def _restart_shard(self, shard):
+        """restart a dead shard process, and send it its items again"""
+        logging.error("shard {0} died, restarting".format(shard.index))
+        with self._lock:
+            try:
+                shard.restart(self._spawner)
+            except IOError as e:
+                # tried again at the next result interval
+                logging.error("shard {0} restart failed: {1}".format(shard.index, e))
+                return
+            items_config = [self._item_config(item, item_id) for item_id, item in self._items_by_id.items()
+                            if shard_of(item.name, len(self._shards)) == shard.index]
+            if items_config:
+                shard.send("add", items_config)
+            shard.send("run", self._run_args)
+
+    def _collect_poll_results(self):
+        """
+        return (and remove) the samples returned by the shards (a list of Samples)
+        does not block or wait for any results
+        """
+        samples = []
+        for shard in self._shards:
+            for item_id, timestamp, value in shard.ring.get_all():
+                item = self._items_by_id.get(item_id)
+                if item is None:
+                    # the item has been deleted since it was polled
+                    continue
+                item.last_value = value
+                item.last_sample_time = timestamp
+                samples.append(Sample(item.name, timestamp, value))
+
+        self._samples_collected(samples)
+        return samples
@@ -0,0 +1,317 @@
+"""A Sink writes line protocol points to a destination (eg InfluxDB, see influx_writer.py, or a SQLite archive,
+see sqlite_sink.py) from its own background thread, so a slow destination doesn't hold up polling or the other
+sinks.
+
+Each sink has its own bounded queue, batch size and flush interval, and an overflow policy for when its queue
+is full (because the destination is down or slower than the samples arrive):
+
+    block: put() waits for room in the queue. No points are lost, but the sink holds up polling
+    drop-oldest: the oldest queued points are discarded (and counted) to make room
+    spill: the points are appended to an on-disk Spool (by the sink's thread, so put() never waits on the disk),
+        and replayed once the destination catches up
+
+Points that fail to be written are likewise retried (block), discarded (drop-oldest) or spooled (spill), unless
+the destination rejected the batch itself (see is_rejected), which would fail again however often it was retried,
+so it is discarded and counted in points_rejected.
+"""
+import logging
+import time
+from collections import deque
+from clock import monotonic
+from metrics import metrics
+from Queue import Queue, Full, Empty
+from threading import Thread, Lock
+
+DEFAULT_BATCH_SIZE = 5000      # points
+DEFAULT_FLUSH_INTERVAL = 1.0   # seconds, the maximum age of a buffered point
+DEFAULT_QUEUE_SIZE = 1000      # result sets waiting for the writer
+DEFAULT_RETRY_INTERVAL = 10.0  # seconds between attempts to write to the destination when it is down
+REPLAY_BATCH_MULTIPLE = 4      # spooled points are replayed in batches of this many times batch_size
+
+OVERFLOW_BLOCK = "block"
+OVERFLOW_DROP_OLDEST = "drop-oldest"
+OVERFLOW_SPILL = "spill"
+OVERFLOW_POLICIES = (OVERFLOW_BLOCK, OVERFLOW_DROP_OLDEST, OVERFLOW_SPILL)
+
+
+class Sink(Thread):
+    """The base class of the sinks, which implement write_batch.
+
+    Points are queued by put(), accumulated across calls and written in one batch when batch_size points are
+    buffered or the oldest buffered point is flush_interval seconds old, whichever comes first.
+    """
+
+    def __init__(self, name, batch_size=DEFAULT_BATCH_SIZE, flush_interval=DEFAULT_FLUSH_INTERVAL,
+                 queue_size=DEFAULT_QUEUE_SIZE, overflow=None, spool=None, retry_interval=DEFAULT_RETRY_INTERVAL):
+        """Args:
+
+            name (str): the name of the sink, used for its metrics, eg "influx"
+            batch_size (int): flush when this many points are buffered
+            flush_interval (float): flush when the oldest buffered point is this old (seconds)
+            queue_size (int): the maximum number of result sets waiting to be buffered
+            overflow (str): what to do when the queue is full, one of OVERFLOW_POLICIES. By default spill if
+                there is a spool, otherwise drop-oldest
+            spool (Spool): where points are spilled, required by the spill policy
+            retry_interval (float): seconds between attempts to write to the destination while it is down
+
+        Raises ValueError if the overflow policy is invalid
+        """
+        super(Sink, self).__init__(name="{0} sink".format(name))
+        if overflow is None:
+            overflow = OVERFLOW_SPILL if spool is not None else OVERFLOW_DROP_OLDEST
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError("sink {0}: unknown overflow policy {1}".format(name, overflow))
+        if overflow == OVERFLOW_SPILL and spool is None:
+            raise ValueError("sink {0}: the spill overflow policy requires a spool".format(name))
+        self.sink_name = name
+        self._batch_size = batch_size
+        self._flush_interval = flush_interval
+        self._queue = Queue(queue_size)
+        self._overflow = overflow
+        self._spool = spool
+        self._retry_interval = retry_interval
+        self._down = False
+        self._next_retry_time = 0.0
+
+        self._buffer = []
+        self._buffer_time = None  # when the oldest point in the buffer was queued
+        # the batches put() couldn't queue, to be spilled to the spool by the sink's thread. At most queue_size are
+        # kept, in case the thread is held up (eg by a hung write)
+        self._overflow_batches = deque()
+        self._max_overflow_batches = queue_size
+
+        self._metrics_prefix = "sinks.{0}.".format(name)
+        self._write_latency = metrics.histogram(self._metrics_prefix + "write_latency")
+        metrics.gauge(self._metrics_prefix + "queue_size", self._queue.qsize)
+        metrics.gauge(self._metrics_prefix + "buffered_points", lambda: len(self._buffer))
+        metrics.gauge(self._metrics_prefix + "down", lambda: int(self._down))
+        metrics.gauge(self._metrics_prefix + "lag", self.get_lag)
+
+        self._stats_lock = Lock()
+        self._stats = {
+            "points_written": 0,
+            "batches_written": 0,
+            "write_errors": 0,
+            "points_dropped": 0,
+            "points_rejected": 0,
+            "points_spooled": 0,
+            "points_replayed": 0,
+            "last_batch_size": 0,
+            "max_batch_size": 0,
+            "last_flush_latency": 0.0,
+            "max_flush_latency": 0.0,
+            "total_flush_latency": 0.0,
+            "last_write_lag": 0.0,
+            "max_write_lag": 0.0
+        }
+        self.daemon = True
+
+    def write_batch(self, lines):
+        """write a list of line protocol points to the destination, raising an exception if they can't be written"""
+        raise NotImplementedError()
+
+    def is_rejected(self, error):
+        """Return True if the given exception from write_batch means the destination rejected the batch itself
+        (eg an invalid point), rather than being unavailable. By default every error means unavailable.
+        """
+        return False
+
+    def put(self, lines):
+        """Queue a list of line protocol points for writing.
+
+        If the queue is full this blocks, discards the oldest queued points, or spools the points, according
+        to the overflow policy.
+        """
+        if not lines:
+            return
+        item = (monotonic(), lines)
+        if self._overflow == OVERFLOW_BLOCK:
+            self._queue.put(item)
+            return
+        while True:
+            try:
+                self._queue.put_nowait(item)
+                return
+            except Full:
+                pass
+            if self._overflow == OVERFLOW_SPILL:
+                # spooling writes to disk, which would hold up the caller (the polling loop), so it is left
+                # to the sink's thread
+                if len(self._overflow_batches) >= self._max_overflow_batches:
+                    try:
+                        self._count("points_dropped", len(self._overflow_batches.popleft()))
+                    except IndexError:
+                        # the sink's thread has just spilled it
+                        pass
+                self._overflow_batches.append(lines)
+                return
+            try:
+                _, oldest_lines = self._queue.get_nowait()
+                self._count("points_dropped", len(oldest_lines))
+            except Empty:
+                pass
+
+    def get_lag(self):
+        """return how long (seconds) the oldest point waiting to be written has been waiting, not counting the spool"""
+        with self._queue.mutex:
+            oldest_time = self._queue.queue[0][0] if self._queue.queue else None
+        buffer_time = self._buffer_time
+        if buffer_time is not None:
+            oldest_time = buffer_time
+        if oldest_time is None:
+            return 0.0
+        return monotonic() - oldest_time
+
+    def get_stats(self):
+        """return a dict of write statistics"""
+        with self._stats_lock:
+            stats = dict(self._stats)
+        batches = stats["batches_written"]
+        stats["mean_batch_size"] = float(stats["points_written"]) / batches if batches else 0.0
+        stats["mean_flush_latency"] = stats["total_flush_latency"] / batches if batches else 0.0
+        stats["overflow"] = self._overflow
+        stats["queue_size"] = self._queue.qsize()
+        stats["buffered_points"] = len(self._buffer)
+        stats["overflow_batches"] = len(self._overflow_batches)
+        stats["lag"] = self.get_lag()
+        stats["down"] = self._down
+        if self._spool is not None:
+            stats["spool"] = self._spool.get_stats()
+        return stats
+
+    def run(self):
+        logging.info("{0} started, batch size {1}, flush interval {2}, overflow {3}".format(
+            self.name, self._batch_size, self._flush_interval, self._overflow))
+        while True:
+            try:
+                self._run_once()
+            except Exception as e:
+                # keep the sink running, eg if the spool can't be read
+                logging.exception("{0} failed: {1}".format(self.name, e))
+                time.sleep(self._retry_interval)
+
+    def _run_once(self):
+        """wait for points (or the flush interval), then flush the buffer or replay the spool if due"""
+        self._spill_overflow()
+        timeout = self._flush_interval
+        if self._buffer_time is not None:
+            timeout = max(0.0, self._buffer_time + self._flush_interval - monotonic())
+        if self._replay_pending():
+            # don't wait for more points, keep replaying the spool
+            timeout = 0.0
+        try:
+            queued_time, lines = self._queue.get(timeout=timeout)
+            if self._buffer_time is None:
+                self._buffer_time = queued_time
+            self._buffer.extend(lines)
+        except Empty:
+            pass
+
+        if len(self._buffer) >= self._batch_size or self._buffer_age() >= self._flush_interval:
+            self.flush()
+
+        if self._replay_pending():
+            self._replay_spool()
+
+    def flush(self):
+        """write the buffered points, in batches of at most batch_size points"""
+        while self._buffer:
+            # don't let the overflow build up in memory during a long flush
+            self._spill_overflow()
+            batch = self._buffer[:self._batch_size]
+            lag = self._buffer_age()
+            # don't wait on the destination while it's down, unless blocking
+            if not (self._down and not self._retry_due()) and self._write(batch):
+                del self._buffer[:self._batch_size]
+                with self._stats_lock:
+                    self._stats["last_write_lag"] = lag
+                    self._stats["max_write_lag"] = max(self._stats["max_write_lag"], lag)
+            elif self._overflow == OVERFLOW_BLOCK:
+                # keep the points until the retry. Meanwhile the queue fills up, and put() blocks
+                time.sleep(max(0.0, self._next_retry_time - monotonic()))
+            else:
+                del self._buffer[:self._batch_size]
+                self._spool_or_drop(batch)
+        self._buffer_time = None
+
+    def _spill_overflow(self):
+        """spool the batches that put() couldn't queue"""
+        points = 0
+        while self._overflow_batches:
+            lines = self._overflow_batches.popleft()
+            self._spool_or_drop(lines)
+            points += len(lines)
+        if points:
+            logging.warn("{0} queue full, {1} points spooled".format(self.name, points))
+
+    def _replay_pending(self):
+        """return True if there are spooled points which can be replayed now"""
+        if self._spool is None or (self._down and not self._retry_due()):
+            return False
+        return not self._spool.is_empty()
+
+    def _replay_spool(self):
+        """write the next large batch of spooled points"""
+        lines, position = self._spool.read(self._batch_size * REPLAY_BATCH_MULTIPLE)
+        if not lines or self._write(lines):
+            self._spool.commit(position)
+            self._count("points_replayed", len(lines))
+
+    def _retry_due(self):
+        return monotonic() >= self._next_retry_time
+
+    def _spool_or_drop(self, lines):
+        if self._spool is None:
+            self._count("points_dropped", len(lines))
+            return
+        try:
+            self._spool.append(lines)
+            self._count("points_spooled", len(lines))
+        except Exception as e:
+            logging.error("{0} failed to spool {1} points: {2}".format(self.name, len(lines), e))
+            self._count("points_dropped", len(lines))
+
+    def _buffer_age(self):
+        if self._buffer_time is None:
+            return 0.0
+        return monotonic() - self._buffer_time
+
+    def _write(self, lines):
+        """write the points with write_batch, returns True if successful or the batch was rejected (and discarded)"""
+        start = monotonic()
+        try:
+            self.write_batch(lines)
+        except Exception as e:
+            if self.is_rejected(e):
+                # retrying (or spooling) the batch would only fail again, and hold up the points behind it
+                logging.error("{0} write of {1} points rejected, discarded: {2}".format(self.name, len(lines), e))
+                self._count("points_rejected", len(lines))
+                return True
+            logging.error("{0} write of {1} points failed: {2}".format(self.name, len(lines), e))
+            self._count("write_errors", 1)
+            self._down = True
+            self._next_retry_time = monotonic() + self._retry_interval
+            return False
+        latency = monotonic() - start
+        self._write_latency.observe(latency)
+
+        if self._down:
+            logging.info("{0} write succeeded, {1} is up".format(self.name, self.sink_name))
+            self._down = False
+
+        with self._stats_lock:
+            stats = self._stats
+            stats["points_written"] += len(lines)
+            stats["batches_written"] += 1
+            stats["last_batch_size"] = len(lines)
+            stats["max_batch_size"] = max(stats["max_batch_size"], len(lines))
+            stats["last_flush_latency"] = latency
+            stats["max_flush_latency"] = max(stats["max_flush_latency"], latency)
+            stats["total_flush_latency"] += latency
+        metrics.counter(self._metrics_prefix + "points_written").inc(len(lines))
+        return True
+
+    def _count(self, name, n):
+        with self._stats_lock:
+            self._stats[name] += n
+        metrics.counter(self._metrics_prefix + name).inc(n)
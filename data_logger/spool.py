@@ -0,0 +1,215 @@
+import logging
+import mmap
+import os
+import struct
+from threading import Lock
+
+DEFAULT_SEGMENT_SIZE = 4 * 1024 * 1024   # bytes
+DEFAULT_MAX_SEGMENTS = 64                # so by default the spool uses at most 256MB of disk
+
+SEGMENT_SUFFIX = ".seg"
+CHECKPOINT_FILENAME = "checkpoint"
+
+# each record is a 4 byte little endian length followed by that many bytes of payload.
+# segments are preallocated (zero filled) so a zero length marks the end of the segment.
+_header = struct.Struct("<I")
+
+
+class Spool:
+    """A Spool is a durable, append-only queue of line protocol batches stored on local disk.
+
+    Batches that can't be written to influx are appended to the spool and replayed later.
+    The spool is a directory of fixed size segment files which are memory-mapped for appending.
+    When a segment is full a new one is started, and when there are more than max_segments the
+    oldest is discarded, so disk usage is bounded. The replay position is checkpointed to disk,
+    so batches are not replayed twice after a restart.
+    """
+
+    def __init__(self, directory, segment_size=DEFAULT_SEGMENT_SIZE, max_segments=DEFAULT_MAX_SEGMENTS):
+        """Args:
+
+            directory (str): the directory for the segment and checkpoint files
+            segment_size (int): the size of each segment file in bytes
+            max_segments (int): the maximum number of segment files
+        """
+        self._directory = directory
+        self._segment_size = segment_size
+        self._max_segments = max_segments
+        self._lock = Lock()
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        self._segments = self._list_segments()  # sequence numbers of the segment files, oldest first
+        self._read_position = self._load_checkpoint()
+
+        self._write_file = None
+        self._write_map = None
+        self._write_offset = 0
+        if self._segments:
+            self._open_segment(self._segments[-1])
+        else:
+            self._new_segment()
+
+    def append(self, lines):
+        """Append a batch (list) of line protocol points to the spool."""
+        payload = u"\n".join(lines).encode("utf-8")
+        size = _header.size + len(payload)
+        if size + _header.size > self._segment_size:
+            raise ValueError("batch of {0} bytes is too large for the spool segment size".format(size))
+
+        with self._lock:
+            # leave room for the end marker
+            if self._write_offset + size + _header.size > self._segment_size:
+                self._new_segment()
+
+            # write the payload before the length, so a torn write just looks like the end of the segment
+            offset = self._write_offset
+            self._write_map[offset + _header.size:offset + size] = payload
+            self._write_map[offset:offset + _header.size] = _header.pack(len(payload))
+            self._write_map.flush()
+            self._write_offset += size
+
+    def is_empty(self):
+        with self._lock:
+            return self._read_position == (self._segments[-1], self._write_offset)
+
+    def read(self, max_lines):
+        """Return (lines, position) for the next batches in the spool, up to about max_lines points.
+
+        The batches are not removed from the spool until commit(position) is called, so if the
+        replay fails they will be read again.
+        """
+        lines = []
+        with self._lock:
+            segment, offset = self._read_position
+            end = (self._segments[-1], self._write_offset)
+            first_segment = self._segments[0]
+        if segment < first_segment:
+            # the segment has been discarded since the position was committed
+            segment, offset = first_segment, 0
+
+        segment_file = None
+        try:
+            while (segment, offset) < end and len(lines) < max_lines:
+                if segment_file is None:
+                    try:
+                        segment_file = open(self._segment_path(segment), "rb")
+                    except IOError as e:
+                        # discarded (to bound the spool) while being read, so skip it
+                        logging.warn("spool segment {0} missing, skipped: {1}".format(segment, e))
+                        segment, offset = segment + 1, 0
+                        continue
+                segment_file.seek(offset)
+                header = segment_file.read(_header.size)
+                length = _header.unpack(header)[0] if len(header) == _header.size else 0
+                if length == 0:
+                    # end of this segment, move to the next one
+                    segment_file.close()
+                    segment_file = None
+                    segment, offset = segment + 1, 0
+                    continue
+                lines.extend(segment_file.read(length).decode("utf-8").split(u"\n"))
+                offset += _header.size + length
+        finally:
+            if segment_file is not None:
+                segment_file.close()
+
+        return lines, (segment, offset)
+
+    def commit(self, position):
+        """Mark everything before the given position (as returned by read) as replayed."""
+        with self._lock:
+            if position[0] < self._segments[0]:
+                # the oldest segments were discarded (by _new_segment) while being read
+                position = (self._segments[0], 0)
+            self._read_position = position
+            # delete the segments that have been completely replayed
+            while self._segments[0] < position[0]:
+                self._delete_segment(self._segments.pop(0))
+            self._save_checkpoint()
+
+    def get_stats(self):
+        with self._lock:
+            return {
+                "segments": len(self._segments),
+                "read_position": list(self._read_position),
+                "write_position": [self._segments[-1], self._write_offset]
+            }
+
+    def _segment_path(self, segment):
+        return os.path.join(self._directory, "{0:010d}{1}".format(segment, SEGMENT_SUFFIX))
+
+    def _list_segments(self):
+        segments = []
+        for filename in os.listdir(self._directory):
+            if filename.endswith(SEGMENT_SUFFIX):
+                segments.append(int(filename[:-len(SEGMENT_SUFFIX)]))
+        return sorted(segments)
+
+    def _open_segment(self, segment):
+        """open the given segment for appending, positioned after the last complete record"""
+        self._close_segment()
+        path = self._segment_path(segment)
+        if not os.path.exists(path):
+            with open(path, "wb") as f:
+                f.truncate(self._segment_size)
+        self._write_file = open(path, "r+b")
+        self._write_map = mmap.mmap(self._write_file.fileno(), self._segment_size)
+
+        offset = 0
+        while offset + _header.size <= self._segment_size:
+            length = _header.unpack_from(self._write_map, offset)[0]
+            if length == 0:
+                break
+            offset += _header.size + length
+        self._write_offset = offset
+
+    def _new_segment(self):
+        segment = self._segments[-1] + 1 if self._segments else 0
+        self._segments.append(segment)
+        self._open_segment(segment)
+
+        # bound the disk usage by discarding the oldest segment
+        if len(self._segments) > self._max_segments:
+            oldest = self._segments.pop(0)
+            logging.warn("spool full, discarding segment {0}".format(oldest))
+            self._delete_segment(oldest)
+            if self._read_position[0] <= oldest:
+                self._read_position = (self._segments[0], 0)
+                self._save_checkpoint()
+
+    def _close_segment(self):
+        if self._write_map is not None:
+            self._write_map.close()
+            self._write_file.close()
+            self._write_map = None
+            self._write_file = None
+
+    def _delete_segment(self, segment):
+        try:
+            os.remove(self._segment_path(segment))
+        except OSError as e:
+            logging.error("failed to delete spool segment {0}: {1}".format(segment, e))
+
+    def _load_checkpoint(self):
+        default = (self._segments[0], 0) if self._segments else (0, 0)
+        try:
+            with open(os.path.join(self._directory, CHECKPOINT_FILENAME)) as f:
+                segment, offset = [int(s) for s in f.read().split()]
+        except (IOError, ValueError):
+            return default
+        # the checkpointed segment may have been discarded since
+        if self._segments and segment < self._segments[0]:
+            return default
+        return segment, offset
+
+    def _save_checkpoint(self):
+        """write the checkpoint atomically, by writing a temp file then renaming it"""
+        path = os.path.join(self._directory, CHECKPOINT_FILENAME)
+        temp_path = path + ".tmp"
+        with open(temp_path, "w") as f:
+            f.write("{0} {1}\n".format(*self._read_position))
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(temp_path, path)
@@ -0,0 +1,105 @@
+import logging
+import sqlite3
+import time
+from clock import monotonic
+from sink import Sink, DEFAULT_FLUSH_INTERVAL, DEFAULT_QUEUE_SIZE, DEFAULT_RETRY_INTERVAL
+
+# SQLite inserts are cheap, so the batches are larger (and the transactions fewer) than for influx
+DEFAULT_SQLITE_BATCH_SIZE = 20000
+# the archive is bounded by deleting the points older than this (seconds), so it doesn't fill the disk
+DEFAULT_RETENTION = 7 * 24 * 3600
+# how often the old points are deleted (seconds)
+PRUNE_INTERVAL = 60.0
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS points (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,  -- the rowid, never reused after old points are deleted (see sync.py)
+    time INTEGER NOT NULL,  -- milliseconds since the epoch
+    line TEXT NOT NULL      -- the point in the influx line protocol
+);
+CREATE INDEX IF NOT EXISTS points_time ON points (time);
+"""
+
+
+class SQLiteSink(Sink):
+    """A SQLiteSink is a Sink that archives the points to a local SQLite database.
+
+    The points are kept in the influx line protocol, with their timestamps, so a range of the archive can
+    be replayed to influx. Each batch is inserted in one transaction.
+
+    The archive is bounded by its retention (the maximum age of its points) and optionally a maximum number of
+    points: the oldest points are deleted every PRUNE_INTERVAL. SQLite reuses the space they free, so the file
+    stops growing once the archive is full. Points deleted before they are synced (see sync.py) are not synced,
+    so the retention should be longer than the sync could be down for.
+    """
+
+    def __init__(self, path, batch_size=DEFAULT_SQLITE_BATCH_SIZE, flush_interval=DEFAULT_FLUSH_INTERVAL,
+                 queue_size=DEFAULT_QUEUE_SIZE, spool=None, retry_interval=DEFAULT_RETRY_INTERVAL,
+                 name="sqlite", overflow=None, retention=DEFAULT_RETENTION, max_points=None):
+        """Args:
+
+            path (str): the SQLite database file, created if necessary
+            name (str): the name of the sink
+            retention (float): points older than this (seconds) are deleted, 0 or None to keep them all
+            max_points (int): optional, the oldest points are deleted to keep at most this many
+
+        The other args are as for InfluxWriter.
+        """
+        super(SQLiteSink, self).__init__(name, batch_size=batch_size, flush_interval=flush_interval,
+                                         queue_size=queue_size, overflow=overflow, spool=spool,
+                                         retry_interval=retry_interval)
+        # the database file
+        self.path = path
+        # the connection is opened by the sink's thread, which is the only one to use it
+        self._connection = None
+        self._retention = retention
+        self._max_points = max_points
+        self._next_prune_time = 0.0
+
+    def _connect(self):
+        connection = sqlite3.connect(self.path)
+        # with write-ahead logging an insert doesn't wait for readers of the archive, and needs fewer fsyncs
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous=NORMAL")
+        connection.executescript(SCHEMA)
+        return connection
+
+    def is_rejected(self, error):
+        """return True if a point in the batch has no valid timestamp"""
+        return isinstance(error, (ValueError, IndexError))
+
+    def write_batch(self, lines):
+        """insert the points into the archive"""
+        if self._connection is None:
+            self._connection = self._connect()
+        try:
+            with self._connection:
+                # the timestamp is the last field of a line, and is never escaped
+                self._connection.executemany("INSERT INTO points (time, line) VALUES (?, ?)",
+                                             ((int(line.rsplit(" ", 1)[1]), line) for line in lines))
+        except sqlite3.Error:
+            # reconnect on the next write, in case the database file was replaced or the disk fixed
+            self._connection.close()
+            self._connection = None
+            raise
+        if monotonic() >= self._next_prune_time:
+            self._next_prune_time = monotonic() + PRUNE_INTERVAL
+            self._prune()
+
+    def _prune(self):
+        """delete the points beyond the retention or max_points"""
+        deleted = 0
+        try:
+            with self._connection:
+                if self._retention:
+                    cutoff = int((time.time() - self._retention) * 1000)
+                    deleted += self._connection.execute("DELETE FROM points WHERE time < ?", (cutoff,)).rowcount
+                if self._max_points:
+                    deleted += self._connection.execute(
+                        "DELETE FROM points WHERE rowid <= (SELECT MAX(rowid) FROM points) - ?", (self._max_points,)).rowcount
+        except sqlite3.Error as e:
+            # the points were written, so this isn't a write error. It is tried again at the next prune
+            logging.error("{0} failed to delete old points: {1}".format(self.name, e))
+            return
+        if deleted:
+            logging.info("{0} deleted {1} old points".format(self.name, deleted))
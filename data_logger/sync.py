@@ -0,0 +1,214 @@
+"""Incremental sync of the local SQLite archive (see sqlite_sink.py) to a central InfluxDB, eg in the cloud.
+
+New points are read from the archive in order of their rowid and sent in gzipped batches. The rowid of the
+last point sent (the high water mark) is saved to a checkpoint file after each batch is accepted, so after a
+dropped connection or a restart the sync resumes where it left off without resending. (A batch resent after
+a crash between sending it and saving the checkpoint just overwrites the same points in influx.) A batch that
+influx rejects (see influx_writer.is_rejected) would be rejected however often it was resent, so it is skipped
+and counted in points_rejected. Only transport errors and server errors are retried.
+
+Points are tagged (by default with the hostname) so a fleet of data loggers can share one central database.
+A bandwidth cap limits the average rate of the compressed batches, for metered or slow links.
+"""
+import logging
+import os
+import re
+import socket
+import sqlite3
+import time
+from threading import Thread, Lock
+from clock import monotonic
+from influx_writer import compress, escape_key, is_rejected
+from metrics import metrics
+
+DEFAULT_SYNC_BATCH_SIZE = 5000   # points
+DEFAULT_SYNC_INTERVAL = 10.0     # seconds between checks for new points, once the sync has caught up
+DEFAULT_RETRY_INTERVAL = 30.0    # seconds between attempts to send while the central database is unavailable
+
+# the measurement at the start of a line protocol point, up to the first unescaped comma or space
+_measurement = re.compile(r"(?:[^\\, ]|\\.)*")
+
+
+def add_tags(line, tags):
+    """return the line protocol point with the given tags (an already escaped ",key=value..." string) added"""
+    end = _measurement.match(line).end()
+    return line[:end] + tags + line[end:]
+
+
+class Throttle:
+    """Limits the average rate of bytes sent, by waiting before sending when ahead of the rate"""
+
+    def __init__(self, bytes_per_second):
+        self._bytes_per_second = float(bytes_per_second)
+        self._next_time = monotonic()
+
+    def wait(self, size):
+        """wait until size bytes can be sent"""
+        now = monotonic()
+        if self._next_time > now:
+            time.sleep(self._next_time - now)
+            now = self._next_time
+        self._next_time = now + size / self._bytes_per_second
+
+
+class Syncer(Thread):
+    """A Syncer sends the points in the archive to the central database from a background thread"""
+
+    def __init__(self, archive_path, client, database, checkpoint_path, tags=None,
+                 batch_size=DEFAULT_SYNC_BATCH_SIZE, max_bytes_per_second=None, interval=DEFAULT_SYNC_INTERVAL,
+                 retry_interval=DEFAULT_RETRY_INTERVAL):
+        """Args:
+
+            archive_path (str): the SQLite archive written by a SQLiteSink
+            client (InfluxDBClient): the client of the central database
+            database (str): the central database
+            checkpoint_path (str): the file where the high water mark is saved
+            tags (dict): optional, tags added to each point, by default {"host": <hostname>}
+            batch_size (int): the maximum number of points sent in each request
+            max_bytes_per_second (float): optional, the bandwidth cap (of the compressed requests)
+            interval (float): seconds between checks for new points once the sync has caught up
+            retry_interval (float): seconds between attempts to send while the central database is unavailable
+        """
+        super(Syncer, self).__init__(name="syncer")
+        self.daemon = True
+        self._archive_path = archive_path
+        self._client = client
+        self._database = database
+        self._checkpoint_path = checkpoint_path
+        if tags is None:
+            tags = {"host": socket.gethostname()}
+        self._tags = u"".join(u",{0}={1}".format(escape_key(k), escape_key(v)) for k, v in sorted(tags.items()))
+        self._batch_size = batch_size
+        self._throttle = Throttle(max_bytes_per_second) if max_bytes_per_second else None
+        self._interval = interval
+        self._retry_interval = retry_interval
+        # the connection is opened by the sync thread, which is the only one to use it
+        self._connection = None
+        self._high_water_mark = self._load_checkpoint()
+
+        self._stats_lock = Lock()
+        self._stats = {
+            "points_sent": 0,
+            "batches_sent": 0,
+            "bytes_sent": 0,
+            "bytes_uncompressed": 0,
+            "send_errors": 0,
+            "points_rejected": 0,
+            "last_sync_time": None
+        }
+        # the last rowid of the archive when it was last read
+        self._last_rowid = 0
+        metrics.gauge("sync.backlog", self.get_backlog)
+
+    def get_backlog(self):
+        """return the number of points in the archive still to be sent, as of the last read of the archive"""
+        return max(0, self._last_rowid - self._high_water_mark)
+
+    def get_stats(self):
+        """return a dict of sync statistics"""
+        with self._stats_lock:
+            stats = dict(self._stats)
+        stats["high_water_mark"] = self._high_water_mark
+        stats["backlog"] = self.get_backlog()
+        return stats
+
+    def run(self):
+        logging.info("syncer started, from rowid {0} of {1}".format(self._high_water_mark, self._archive_path))
+        while True:
+            try:
+                rows = self._read_batch()
+            except sqlite3.Error as e:
+                # eg the archive hasn't been created yet
+                logging.debug("failed to read the archive {0}: {1}".format(self._archive_path, e))
+                self._close()
+                rows = []
+            if not rows:
+                time.sleep(self._interval)
+                continue
+
+            if self._send([add_tags(line, self._tags) for _, line in rows]):
+                self._high_water_mark = rows[-1][0]
+                self._save_checkpoint()
+                if len(rows) < self._batch_size:
+                    # caught up
+                    time.sleep(self._interval)
+            else:
+                time.sleep(self._retry_interval)
+
+    def _read_batch(self):
+        """return the next batch of (rowid, line) rows of the archive after the high water mark"""
+        if self._connection is None:
+            self._connection = sqlite3.connect(self._archive_path)
+            # the rowids are never reused, even once the oldest points have been deleted (by the archive's
+            # retention), so the last rowid ever used is in sqlite_sequence
+            try:
+                row = self._connection.execute("SELECT seq FROM sqlite_sequence WHERE name = 'points'").fetchone()
+            except sqlite3.OperationalError:
+                row = None
+            (last_rowid,) = row or self._connection.execute("SELECT COALESCE(MAX(rowid), 0) FROM points").fetchone()
+            if last_rowid < self._high_water_mark:
+                # the archive has been replaced, so its rowids start again
+                logging.warn("archive {0} is behind the sync checkpoint, syncing it from the start".format(
+                    self._archive_path))
+                self._high_water_mark = 0
+        rows = self._connection.execute("SELECT rowid, line FROM points WHERE rowid > ? ORDER BY rowid LIMIT ?",
+                                        (self._high_water_mark, self._batch_size)).fetchall()
+        (self._last_rowid,) = self._connection.execute("SELECT COALESCE(MAX(rowid), 0) FROM points").fetchone()
+        return rows
+
+    def _close(self):
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+    def _send(self, lines):
+        """send the points to the central database, returns True if successful or the batch was rejected"""
+        body = u"\n".join(lines).encode("utf-8")
+        compressed = compress(body)
+        if self._throttle is not None:
+            self._throttle.wait(len(compressed))
+        try:
+            self._client.request("write", "POST",
+                                 params={"db": self._database, "precision": "ms"},
+                                 data=compressed, expected_response_code=204,
+                                 headers={"Content-Type": "application/octet-stream", "Content-Encoding": "gzip"})
+        except Exception as e:
+            if is_rejected(e):
+                # resending the batch would only be rejected again, and hold up the points behind it for good
+                logging.error("sync of {0} points rejected, skipped: {1}".format(len(lines), e))
+                with self._stats_lock:
+                    self._stats["points_rejected"] += len(lines)
+                metrics.counter("sync.points_rejected").inc(len(lines))
+                return True
+            logging.error("sync of {0} points failed: {1}".format(len(lines), e))
+            with self._stats_lock:
+                self._stats["send_errors"] += 1
+            metrics.counter("sync.send_errors").inc()
+            return False
+
+        with self._stats_lock:
+            stats = self._stats
+            stats["points_sent"] += len(lines)
+            stats["batches_sent"] += 1
+            stats["bytes_sent"] += len(compressed)
+            stats["bytes_uncompressed"] += len(body)
+            stats["last_sync_time"] = time.time()
+        metrics.counter("sync.points_sent").inc(len(lines))
+        metrics.counter("sync.bytes_sent").inc(len(compressed))
+        return True
+
+    def _load_checkpoint(self):
+        try:
+            with open(self._checkpoint_path) as f:
+                return int(f.read())
+        except (IOError, ValueError):
+            return 0
+
+    def _save_checkpoint(self):
+        """save the high water mark atomically, so a crash leaves either the old or the new one"""
+        temp_path = self._checkpoint_path + ".tmp"
+        with open(temp_path, "w") as f:
+            f.write(str(self._high_water_mark))
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(temp_path, self._checkpoint_path)
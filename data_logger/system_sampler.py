@@ -1,23 +1,249 @@
-from procfs import Proc
+import io
+import os
+from threading import Lock
+from clock import monotonic
+
+# key -> the load average period (minutes)
+LOADAVG_KEYS = {
+    "loadavg1": 1,
+    "loadavg5": 5,
+    "loadavg15": 15
+}
+# key -> the field of a cpu line of /proc/stat, as a percentage of the cpu time. "cpu" is the busy percentage
+CPU_KEYS = {
+    "cpu": None,
+    "cpu_user": 0,
+    "cpu_system": 2,
+    "cpu_iowait": 4
+}
+# key -> the field of /proc/meminfo, in bytes
+MEMORY_KEYS = {
+    "mem_total": "MemTotal",
+    "mem_available": "MemAvailable",
+    "mem_free": "MemFree",
+    "swap_free": "SwapFree"
+}
+# key -> the field of an interface line of /proc/net/dev, as a rate per second
+NET_KEYS = {
+    "net_rx_bytes": 0,
+    "net_rx_packets": 1,
+    "net_rx_errors": 2,
+    "net_tx_bytes": 8,
+    "net_tx_packets": 9,
+    "net_tx_errors": 10
+}
+# key -> (the field of a device line of /proc/diskstats (after the name), the multiplier), as a rate per second
+DISK_KEYS = {
+    "disk_reads": (0, 1),
+    "disk_read_bytes": (2, 512),  # sectors are always 512 bytes in diskstats
+    "disk_writes": (4, 1),
+    "disk_write_bytes": (6, 512),
+    "disk_busy": (9, 0.1)  # ms doing I/O per second, as a percentage
+}
+
+# the file each key is read from
+KEY_FILES = dict([(key, "loadavg") for key in LOADAVG_KEYS] +
+                 [(key, "stat") for key in CPU_KEYS] + [("context_switches", "stat")] +
+                 [(key, "meminfo") for key in MEMORY_KEYS] + [("mem_used", "meminfo"), ("mem_used_percent", "meminfo")] +
+                 [(key, "net/dev") for key in NET_KEYS] +
+                 [(key, "diskstats") for key in DISK_KEYS])
+
+# files read within this long of each other (seconds), eg for items of different intervals due in the same
+# tick, are only read and parsed once
+MAX_FILE_AGE = 0.05
+INITIAL_BUFFER_SIZE = 16 * 1024
+
+
+def parse_loadavg(text):
+    """return the 1,5,15 min load average as eg {1: 0.0, 5: 0.0, 15: 0.0}"""
+    fields = text.split()
+    return {1: float(fields[0]), 5: float(fields[1]), 15: float(fields[2])}
+
+def parse_stat(text):
+    """return a dict of cpu name (eg "cpu", "cpu0") -> list of times, plus "ctxt" -> the context switches"""
+    stat = {}
+    for line in text.splitlines():
+        if line.startswith("cpu"):
+            fields = line.split()
+            stat[fields[0]] = [int(field) for field in fields[1:]]
+        elif line.startswith("ctxt "):
+            stat["ctxt"] = int(line[5:])
+    return stat
+
+def parse_meminfo(text):
+    """return a dict of field -> value, in bytes where the unit is kB"""
+    meminfo = {}
+    for line in text.splitlines():
+        name, _, value = line.partition(":")
+        fields = value.split()
+        if fields:
+            meminfo[name] = int(fields[0]) * 1024 if len(fields) > 1 and fields[1] == "kB" else int(fields[0])
+    return meminfo
+
+def parse_net_dev(text):
+    """return a dict of interface name -> list of counters"""
+    interfaces = {}
+    # the first two lines are headings
+    for line in text.splitlines()[2:]:
+        name, _, counters = line.partition(":")
+        interfaces[name.strip()] = [int(counter) for counter in counters.split()]
+    return interfaces
+
+def parse_diskstats(text):
+    """return a dict of device name -> list of counters"""
+    devices = {}
+    for line in text.splitlines():
+        fields = line.split()
+        if len(fields) > 3:
+            devices[fields[2]] = [int(field) for field in fields[3:]]
+    return devices
+
+FILE_PARSERS = {
+    "loadavg": parse_loadavg,
+    "stat": parse_stat,
+    "meminfo": parse_meminfo,
+    "net/dev": parse_net_dev,
+    "diskstats": parse_diskstats
+}
+
+
+class ProcFile:
+    """A file in /proc, kept open and re-read from the start each time into a reused buffer"""
+
+    def __init__(self, name):
+        self.path = os.path.join("/proc", name)
+        self._file = io.FileIO(self.path, "r")
+        self._buffer = bytearray(INITIAL_BUFFER_SIZE)
+
+    def read(self):
+        """return the current content of the file"""
+        # python 2 has no os.pread, so seek then read
+        self._file.seek(0)
+        size = 0
+        while True:
+            if size == len(self._buffer):
+                self._buffer.extend(bytearray(len(self._buffer)))
+            n = self._file.readinto(memoryview(self._buffer)[size:])
+            if not n:
+                break
+            size += n
+        return str(self._buffer[:size])
+
 
 class SystemSampler:
+    """Returns samples of the load average, cpu, memory, network interfaces and disks, from /proc.
+
+    The files are kept open, and each is read and parsed once for a batch of items (see get_item_samples).
+    Rates (eg net_rx_bytes) are computed from the change of a counter since the previous sample of the item,
+    or since boot for its first sample, so items of the same counter at different intervals each get their own.
+    """
 
     def __init__(self):
-        self.proc = Proc()
-        self.sample_funcs = {
-            "loadavg1": lambda: self.get_loadavg()[1],
-            "loadavg5": lambda: self.get_loadavg()[5],
-            "loadavg15": lambda: self.get_loadavg()[15]
-        }
+        self._files = {}  # name -> ProcFile
+        self._parsed = {}  # file name -> (monotonic time read, parsed content)
+        self._previous = {}  # (item name, key, arg) -> (monotonic time, counter) of its previous sample, for rates
+        self._lock = Lock()
 
     def get_loadavg(self):
-    	"""returns the 1,5,15 min system load average as eg {1: 0.0, 5: 0.0, 15: 0.0}"""
-        # return just the 1,5,15 load average values
-        return self.proc.loadavg['average']
+        """returns the 1,5,15 min system load average as eg {1: 0.0, 5: 0.0, 15: 0.0}"""
+        with self._lock:
+            return self._read("loadavg")[1]
 
     def get_sample(self, key, arg):
+        value = self.get_samples([(key, arg)])[(key, arg)]
+        if isinstance(value, Exception):
+            raise value
+        return value
+
+    def get_samples(self, requests):
+        """return samples for a batch of (key, arg) requests, as a dict of (key, arg) -> value"""
+        return self.get_item_samples([((key, arg), key, arg) for key, arg in requests])
+
+    def get_item_samples(self, requests):
+        """return samples for a batch of (item name, key, arg) requests, as a dict of item name -> value,
+        reading and parsing each file once for the whole batch
+        """
+        results = {}
+        with self._lock:
+            for name, key, arg in requests:
+                try:
+                    file_name = KEY_FILES.get(key)
+                    if file_name is None:
+                        raise ValueError("unknown key: {0}".format(key))
+                    read_time, parsed = self._read(file_name)
+                    results[name] = self._get_value((name, key, arg), key, arg, parsed, read_time)
+                except Exception as e:
+                    results[name] = e
+        return results
+
+    def forget_items(self, names):
+        """discard the previous counters of the items with the given names"""
+        names = set(names)
+        with self._lock:
+            for item in [item for item in self._previous if item[0] in names]:
+                del self._previous[item]
+
+    def _read(self, file_name):
+        """return (time read, parsed content) of the file, reading it unless it was read just now"""
+        read_time, parsed = self._parsed.get(file_name, (None, None))
+        now = monotonic()
+        if read_time is None or now - read_time > MAX_FILE_AGE:
+            proc_file = self._files.get(file_name)
+            if proc_file is None:
+                proc_file = self._files[file_name] = ProcFile(file_name)
+            read_time, parsed = now, FILE_PARSERS[file_name](proc_file.read())
+            self._parsed[file_name] = (read_time, parsed)
+        return read_time, parsed
+
+    def _get_value(self, item, key, arg, parsed, read_time):
+        if key in LOADAVG_KEYS:
+            return parsed[LOADAVG_KEYS[key]]
+
+        if key in CPU_KEYS:
+            times = self._lookup(parsed, arg or "cpu", "cpu")
+            # idle and iowait are not busy (guest times are already included in user and nice)
+            total = sum(times[:8])
+            part = total - times[3] - times[4] if CPU_KEYS[key] is None else times[CPU_KEYS[key]]
+            (part_delta, total_delta) = self._delta(item, read_time, (part, total))[1]
+            return 100.0 * part_delta / total_delta if total_delta else 0.0
+        if key == "context_switches":
+            return self._rate(item, read_time, parsed["ctxt"])
+
+        if key == "mem_used":
+            return parsed["MemTotal"] - parsed["MemAvailable"]
+        if key == "mem_used_percent":
+            return 100.0 * (parsed["MemTotal"] - parsed["MemAvailable"]) / parsed["MemTotal"]
+        if key in MEMORY_KEYS:
+            return parsed[MEMORY_KEYS[key]]
+
+        if key in NET_KEYS:
+            return self._rate(item, read_time, self._lookup(parsed, arg, "network interface")[NET_KEYS[key]])
+
+        field, multiplier = DISK_KEYS[key]
+        return self._rate(item, read_time, self._lookup(parsed, arg, "disk")[field]) * multiplier
+
+    def _lookup(self, parsed, arg, description):
+        if not arg:
+            raise ValueError("{0} required as arg".format(description))
         try:
-            func = self.sample_funcs[key]
-            return func()
+            return parsed[arg]
         except KeyError:
-            raise ValueError("unknown key: {0}".format(key))
+            raise ValueError("unknown {0}: {1}".format(description, arg))
+
+    def _delta(self, item, read_time, counters):
+        """Return (elapsed seconds, tuple of counter deltas) since the previous sample of the item, where item
+        is its (name, key, arg).
+
+        For the first sample the deltas are since boot, when the counters were 0 and the monotonic clock started.
+        """
+        previous_time, previous_counters = self._previous.get(item, (0.0, (0,) * len(counters)))
+        self._previous[item] = (read_time, counters)
+        # a counter that went backwards was reset (eg a 32 bit counter wrapped, or a device was re-added)
+        deltas = tuple(counter - previous if counter >= previous else counter
+                       for counter, previous in zip(counters, previous_counters))
+        return read_time - previous_time, deltas
+
+    def _rate(self, item, read_time, counter):
+        """return the rate of change per second of the counter since the previous sample of the item"""
+        elapsed, (delta,) = self._delta(item, read_time, (counter,))
+        return delta / elapsed if elapsed > 0 else 0.0
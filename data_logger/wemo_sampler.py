@@ -1,34 +1,147 @@
 from ouimeaux.environment import Environment
+from threading import Thread, Event, Lock
+from clock import monotonic
 import logging
+import time
+
+# how often to search for new (or moved) WeMo devices (seconds)
+DEFAULT_REDISCOVERY_INTERVAL = 300.0
+# the shortest time between searches, however often switches stop responding (seconds)
+MIN_REDISCOVERY_INTERVAL = 30.0
+# how long each search for WeMo devices listens for responses (seconds)
+DISCOVERY_SECONDS = 1
+
+def parse_insight_params(params):
+    """Parse the InsightParams returned by a WeMo Insight switch into (state, power) where state is 0 or 1
+    and power is in W.
+
+    The params are "|" separated: state|lastchange|onfor|ontoday|ontotal|timeperiod|x|currentmw|... where
+    state is 0 (off), 1 (on) or 8 (on, standby).
+    """
+    fields = params.split("|")
+    state = 1 if int(fields[0]) else 0
+    # the current power is in mW, convert to W
+    power = float(fields[7]) / 1000.0
+    return state, power
+
 
 class WemoSampler:
+    """Returns samples from WeMo switches.
+
+    Devices are discovered by a background thread, at startup and then every rediscovery_interval
+    seconds, so sampling never waits for discovery. Switches are looked up by name once and cached;
+    a switch is dropped from the cache (and a rediscovery is triggered) when it stops responding, in
+    case it has gone or changed address.
+    """
 
-    def __init__(self):
+    def __init__(self, rediscovery_interval=DEFAULT_REDISCOVERY_INTERVAL):
         self.wemo_env = Environment()
         self.wemo_env.start()
-        # TODO: run discovery periodically instead of just on startup to
-        # discover new devices that have been enabled?
-        self.discover()
+        self._rediscovery_interval = rediscovery_interval
+        self._switches = {}  # switch name -> device
+        self._lock = Lock()
+        self._rediscover = Event()
+        self._discovery_thread = Thread(target=self._discover_periodically, name="wemo discovery")
+        self._discovery_thread.daemon = True
+        self._discovery_thread.start()
 
     def discover(self):
         logging.info("searching for WeMo devices")
-        self.wemo_env.discover(seconds=1)
+        self.wemo_env.discover(seconds=DISCOVERY_SECONDS)
         logging.info("WeMo devices found: {0}".format(self.wemo_env.devices))
+        # the devices may have been replaced, so look them up again
+        with self._lock:
+            self._switches = {}
+
+    def _discover_periodically(self):
+        while True:
+            earliest_next_time = monotonic() + MIN_REDISCOVERY_INTERVAL
+            try:
+                self.discover()
+            except Exception as e:
+                logging.error("WeMo discovery failed: {0}".format(e))
+            self._rediscover.wait(self._rediscovery_interval)
+            self._rediscover.clear()
+            delay = earliest_next_time - monotonic()
+            if delay > 0:
+                time.sleep(delay)
 
     def get_switch(self, switch_name):
-        return self.wemo_env.get_switch(switch_name)
+        switch = self._switches.get(switch_name)
+        if switch is None:
+            switch = self.wemo_env.get_switch(switch_name)
+            with self._lock:
+                self._switches[switch_name] = switch
+        return switch
+
+    def invalidate_switch(self, switch_name):
+        """forget the cached switch, eg because it stopped responding, and search for devices again soon"""
+        with self._lock:
+            self._switches.pop(switch_name, None)
+        self._rediscover.set()
+
+    def get_samples(self, requests):
+        """return samples for a batch of (key, arg) requests.
+
+        Each switch is looked up once for the whole batch, and if both its power and state are requested
+        they are read together, with one request to the switch.
+        """
+        keys_by_switch = {}  # switch name -> set of keys
+        for key, arg in requests:
+            keys_by_switch.setdefault(arg, set()).add(key)
+
+        results = {}
+        for arg, keys in keys_by_switch.items():
+            try:
+                switch = self.get_switch(arg) if arg else None
+            except Exception as e:
+                results.update(((key, arg), e) for key in keys)
+                continue
+            if "power" in keys and "state" in keys and hasattr(switch, "insight"):
+                keys.difference_update(["power", "state"])
+                try:
+                    state, power = self.get_insight_sample(arg)
+                    results[("power", arg)] = power
+                    results[("state", arg)] = state
+                except Exception as e:
+                    results[("power", arg)] = e
+                    results[("state", arg)] = e
+            for key in keys:
+                try:
+                    results[(key, arg)] = self.get_switch_sample(switch, key, arg)
+                except Exception as e:
+                    results[(key, arg)] = e
+        return results
 
     def get_sample(self, key, arg):
+        switch = self.get_switch(arg) if arg else None
+        return self.get_switch_sample(switch, key, arg)
+
+    def get_insight_sample(self, switch_name):
+        """return (state, power) of the named Insight switch, read with one request"""
+        switch = self.get_switch(switch_name)
+        if not hasattr(switch, "insight"):
+            raise ValueError("not a WeMo Insight switch: {0}".format(switch_name))
+        try:
+            params = switch.insight.GetInsightParams()["InsightParams"]
+        except Exception:
+            self.invalidate_switch(switch_name)
+            raise
+        return parse_insight_params(params)
+
+    def get_switch_sample(self, switch, key, arg):
+        """return the sample for the given key from the given switch, which is None if there is no arg"""
         if key == "power":
             if not arg:
                 raise ValueError("wemo.power requires arg (switch name)")
-            switch = self.get_switch(arg)
-            # current_power seems to be in mW, convert to W
-            return switch.current_power / 1000.0
+            return self.get_insight_sample(arg)[1]
         elif key == "state":
             if not arg:
                 raise ValueError("wemo.state requires arg (switch name)")
-            switch = self.get_switch(arg)
-            return switch.get_state()
+            try:
+                return switch.get_state()
+            except Exception:
+                self.invalidate_switch(arg)
+                raise
         else:
             raise ValueError("unknown key: {0}".format(key))